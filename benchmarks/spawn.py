@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Compares the gprun modes (``spawn``, ``preexec`` and ``exec``).
+
+* latency: the time from calling ``gprun`` until ``true`` exits
+* rss: the resident memory of the process tree left running by
+  ``gprun ... sleep``, i.e. the wrapper (if any) and the command
+
+Usage::
+
+    python benchmarks/spawn.py [-n 200] [-u USERSPEC]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from gdockutils.gprun import gprun, MODES, NATIVE_SPAWN  # noqa: E402
+
+
+def run_once(mode, userspec):
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            gprun(
+                userspec=userspec, command=['true'], mode=mode,
+                start_new_session=False
+            )
+        except SystemExit as e:
+            os._exit(e.code)
+        finally:
+            os._exit(1)
+    os.waitpid(pid, 0)
+    return time.perf_counter() - start
+
+
+def rss_kb(pid):
+    """The summed VmRSS of ``pid`` and its descendants."""
+    total = 0
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1])
+        with open('/proc/%d/task/%d/children' % (pid, pid)) as f:
+            children = [int(c) for c in f.read().split()]
+    except FileNotFoundError:
+        return total
+    return total + sum(rss_kb(c) for c in children)
+
+
+def tree_rss(mode, userspec):
+    code = (
+        'from gdockutils.gprun import gprun; '
+        'gprun(userspec=%r, command=["sleep", "5"], mode=%r, '
+        'start_new_session=False)' % (userspec, mode)
+    )
+    proc = subprocess.Popen(
+        [sys.executable, '-c', code], env=dict(os.environ, PYTHONPATH=ROOT)
+    )
+    try:
+        time.sleep(1)
+        return rss_kb(proc.pid)
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares the spawn latency and RSS of the gprun modes.'
+    )
+    parser.add_argument('-n', '--number', type=int, default=200)
+    parser.add_argument('-u', '--userspec')
+    args = parser.parse_args()
+
+    print('native spawn supported: %s' % NATIVE_SPAWN)
+    for mode in MODES:
+        times = [run_once(mode, args.userspec) for _ in range(args.number)]
+        print('{:>8}: latency median {:7.2f} ms, p90 {:7.2f} ms, '
+              'tree rss {:7d} kB'.format(
+                  mode, statistics.median(times) * 1000,
+                  sorted(times)[int(len(times) * 0.9)] * 1000,
+                  tree_rss(mode, args.userspec)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Measures the cold start time of every console script of gdockutils.
+
+Each script is started ``--repeat`` times with ``--help`` in a fresh
+interpreter and the median wall time is reported together with the
+cumulative ``-X importtime`` of the ``gdockutils`` modules. The run fails
+(exit code 1) if a script goes over the wall time budget or imports a
+module it should not need.
+
+Usage::
+
+    python benchmarks/startup.py [--repeat 10] [--budget-ms 300] [--json]
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# modules that must not be imported just to start the given script
+FORBIDDEN = {
+    'gprun': ['yaml', 'gdockutils.db', 'gdockutils.prepare'],
+    'readsecret': ['yaml', 'gdockutils.db', 'gdockutils.prepare'],
+    'createsecret': ['yaml', 'gdockutils.db'],
+    'prepare': ['yaml', 'gdockutils.db'],
+    'ask': ['yaml', 'gdockutils.db', 'gdockutils.secret'],
+}
+DEFAULT_FORBIDDEN = ['yaml']
+
+CODE = '''
+import sys
+sys.argv = [{name!r}, '--help']
+from {module} import {func}
+try:
+    {func}()
+except (SystemExit, Exception):
+    # the interactive scripts fail without a terminal or config files
+    pass
+print(repr(sorted(sys.modules)), file=sys.stderr)
+'''
+
+
+def console_scripts():
+    with open(os.path.join(ROOT, 'setup.py')) as f:
+        setup = f.read()
+    return re.findall(r"'(\w+)=([\w.]+):(\w+)'", setup)
+
+
+def run_script(name, module, func, importtime=False):
+    cmd = [sys.executable]
+    if importtime:
+        cmd += ['-X', 'importtime']
+    cmd += ['-c', CODE.format(name=name, module=module, func=func)]
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as cwd:
+        proc = subprocess.run(
+            cmd, cwd=cwd, env=env, stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+    elapsed = time.perf_counter() - start
+    if proc.returncode:
+        raise Exception('%s failed:\n%s' % (name, proc.stderr))
+    return elapsed, proc.stderr
+
+
+def parse_importtime(stderr):
+    """Returns the cumulative import time (us) of the gdockutils modules."""
+    total = 0
+    for line in stderr.splitlines():
+        m = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)', line)
+        # only the top level imports, their cumulative time includes the rest
+        if m and not m.group(2) and m.group(3).startswith('gdockutils'):
+            total += int(m.group(1))
+    return total
+
+
+def measure(name, module, func, repeat):
+    times = [run_script(name, module, func)[0] for _ in range(repeat)]
+    _, stderr = run_script(name, module, func, importtime=True)
+    modules = eval(stderr.strip().splitlines()[-1])
+    return {
+        'script': name,
+        'wall_ms': round(statistics.median(times) * 1000, 1),
+        'import_ms': round(parse_importtime(stderr) / 1000, 1),
+        'modules': len(modules),
+        'forbidden': sorted(
+            set(FORBIDDEN.get(name, DEFAULT_FORBIDDEN)) & set(modules)
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures the startup time of the console scripts.'
+    )
+    parser.add_argument('-r', '--repeat', type=int, default=10)
+    parser.add_argument(
+        '-b', '--budget-ms', type=float, default=300,
+        help='the maximum median wall time of a script'
+    )
+    parser.add_argument(
+        '--json', action='store_true', help='print the results as json'
+    )
+    parser.add_argument(
+        'scripts', nargs='*', help='the scripts to measure (default: all)'
+    )
+    args = parser.parse_args()
+
+    failed = False
+    results = []
+    for name, module, func in console_scripts():
+        if args.scripts and name not in args.scripts:
+            continue
+        r = measure(name, module, func, args.repeat)
+        r['over_budget'] = r['wall_ms'] > args.budget_ms
+        failed = failed or r['over_budget'] or bool(r['forbidden'])
+        results.append(r)
+        if not args.json:
+            print('{script:>16} {wall_ms:>8.1f} ms  imports {import_ms:>7.1f}'
+                  ' ms  {modules:>4} modules{flag}'.format(
+                      flag=(' OVER BUDGET' if r['over_budget'] else '') + (
+                          ' FORBIDDEN: ' + ', '.join(r['forbidden'])
+                          if r['forbidden'] else ''
+                      ), **r))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Compares the cost of resolving a userspec in gprun with the old approach
+(scanning ``grp.getgrall()`` and calling ``grp.getgrnam()`` for every
+matching group) and the cached ``os.getgrouplist`` based resolver.
+
+Usage::
+
+    python benchmarks/userspec.py [-n 1000] [USERSPEC]
+"""
+
+import argparse
+import grp
+import os
+import pwd
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gdockutils import getpwnam, getpwuid, getgrnam, grouplist  # noqa: E402
+from gdockutils.gprun import get_userspec  # noqa: E402
+
+
+def legacy_groups(username):
+    return [
+        grp.getgrnam(gr.gr_name).gr_gid
+        for gr in grp.getgrall()
+        if username in gr.gr_mem
+    ]
+
+
+def legacy(spec):
+    pw = pwd.getpwnam(spec)
+    return pw.pw_uid, legacy_groups(pw.pw_name)
+
+
+def clear_caches():
+    for f in (getpwnam, getpwuid, getgrnam, grouplist):
+        f.cache_clear()
+
+
+def bench(f, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measures the cost of resolving a userspec.'
+    )
+    parser.add_argument('-n', '--number', type=int, default=1000)
+    parser.add_argument('userspec', nargs='?', default='root')
+    args = parser.parse_args()
+    spec, n = args.userspec, args.number
+
+    print('groups in the database: %d' % len(grp.getgrall()))
+    print('legacy getgrall scan:   %8.1f us' % bench(lambda: legacy(spec), n))
+
+    def uncached():
+        clear_caches()
+        get_userspec(spec)
+    print('getgrouplist, uncached: %8.1f us' % bench(uncached, n))
+    print('getgrouplist, cached:   %8.1f us' % bench(
+        lambda: get_userspec(spec), n
+    ))
+
+
+if __name__ == '__main__':
+    main()
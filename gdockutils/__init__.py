@@ -1,9 +1,9 @@
+import functools
 import sys
 import subprocess
 import os
 import pwd
 import grp
-import shutil
 
 
 def get(env_var, default):
@@ -11,6 +11,13 @@ def get(env_var, default):
 
 
 SECRET_CONF_FILE = get('GDOCKUTILS_SECRET_CONF_FILE', 'conf/secrets.yml')
+RESOURCE_CONF_FILE = get(
+    'GDOCKUTILS_RESOURCE_CONF_FILE', 'conf/resources.yml'
+)
+SECRET_MANIFEST_CACHE_FILE = get(
+    'GDOCKUTILS_SECRET_MANIFEST_CACHE_FILE',
+    os.path.join(get('TMPDIR', '/tmp'), 'gdockutils-secrets-manifest.json')
+)
 SECRET_DIR = get('GDOCKUTILS_SECRET_DIR', '/run/secrets')
 BACKUP_DIR = get('GDOCKUTILS_BACKUP_DIR', 'backup')
 DATA_FILES_DIR = get('GDOCKUTILS_DATA_FILES_DIR', '/data/files')
@@ -20,7 +27,12 @@ BACKUP_FILE_PREFIX = get(
 )
 PG_HBA_ORIG = get('GDOCKUTILS_PG_HBA_ORIG', 'conf/pg_hba.conf')
 POSTGRESCONF_ORIG = get('GDOCKUTILS_POSTGRESCONF_ORIG', 'conf/postgresql.conf')
+# tune postgres for the memory and cpu limits of the container
+POSTGRES_AUTOTUNE = get('GDOCKUTILS_POSTGRES_AUTOTUNE', '1') not in ('', '0')
 SECRET_DATABASE_FILE = get('GDOCKUTILS_SECRET_DATABASE_FILE', '.secret.env')
+SECRETD_SOCKET = get(
+    'GDOCKUTILS_SECRETD_SOCKET', '/run/gdockutils/secretd.sock'
+)
 SECRET_SOURCE_DIR = get('GDOCKUTILS_SECRET_SOURCE_DIR', '.files')
 PGDATA = get(
     'GDOCKUTILS_PGDATA',
@@ -29,6 +41,11 @@ PGDATA = get(
 DATABASE_NAME = get('GDOCKUTILS_DATABASE_NAME', 'django')
 DATABASE_USER = get('GDOCKUTILS_DATABASE_USER', 'django')
 DATABASE_HOST = get('GDOCKUTILS_DATABASE_HOST', 'postgres')
+DATABASE_PORT = get('GDOCKUTILS_DATABASE_PORT', get('PGPORT', '5432'))
+# seconds, 0 waits forever
+DATABASE_WAIT_TIMEOUT = get('GDOCKUTILS_DATABASE_WAIT_TIMEOUT', '0')
+METRICS_FILE = get('GDOCKUTILS_METRICS_FILE', '')
+METRICS_INTERVAL = get('GDOCKUTILS_METRICS_INTERVAL', '0')
 DEBUG = get('GDOCKUTILS_DEBUG', '')
 
 
@@ -37,6 +54,14 @@ def read_secret_from_file(secret):
         return f.read()
 
 
+def load_yaml(path):
+    """Loads a yaml file with the C loader, if available."""
+    import yaml
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=loader)
+
+
 def printerr(s, end='\n'):
     print(s, file=sys.stderr, end=end)
 
@@ -61,12 +86,38 @@ def get_param(var, env_var, default):
     return default
 
 
+# The passwd and group databases can be slow (LDAP, sssd), so lookups are
+# cached for the lifetime of the process.
+@functools.lru_cache(maxsize=None)
+def getpwnam(name):
+    return pwd.getpwnam(name)
+
+
+@functools.lru_cache(maxsize=None)
+def getpwuid(uid):
+    return pwd.getpwuid(uid)
+
+
+@functools.lru_cache(maxsize=None)
+def getgrnam(name):
+    return grp.getgrnam(name)
+
+
+@functools.lru_cache(maxsize=None)
+def grouplist(username, gid):
+    """
+    Returns the gids of all the groups ``username`` is a member of
+    (including ``gid``, its primary group).
+    """
+    return tuple(os.getgrouplist(username, gid))
+
+
 def uid(spec):
     try:
         return int(spec)
     except ValueError:
         try:
-            pw = pwd.getpwnam(spec)
+            pw = getpwnam(spec)
         except KeyError:
             raise Exception('User %r does not exist' % spec)
         else:
@@ -78,7 +129,7 @@ def gid(spec):
         return int(spec)
     except ValueError:
         try:
-            gr = grp.getgrnam(spec)
+            gr = getgrnam(spec)
         except KeyError:
             raise Exception('Group %r does not exist' % spec)
         else:
@@ -91,11 +142,12 @@ def parseuidgid(spec):
     if len(spec) == 2:
         return u, gid(spec[1])
     elif len(spec) == 1:
-        pw = pwd.getpwuid(u)
+        pw = getpwuid(u)
         return u, pw.pw_gid
 
 
 def cp(source, dest, _uid=-1, _gid=-1, mode=None):
+    import shutil
     shutil.copyfile(source, dest)
     os.chown(dest, uid(_uid), gid(_gid))
     os.chmod(dest, mode)
@@ -113,5 +165,9 @@ class SecretAlreadyExists(Exception):
     pass
 
 
+class SecretAccessDenied(Exception):
+    pass
+
+
 class NoChoiceError(Exception):
     pass
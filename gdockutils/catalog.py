@@ -0,0 +1,242 @@
+import fcntl
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from datetime import datetime
+
+from . import BACKUP_DIR, printerr
+from .stream import EXTENSIONS, codec_of, manifest_path, read_manifest
+
+CATALOG_FILE = 'catalog.json'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def catalog_path(backup_dir=None):
+    return os.path.join(backup_dir or BACKUP_DIR, CATALOG_FILE)
+
+
+@contextmanager
+def _locked(backup_dir=None):
+    with open(catalog_path(backup_dir) + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _write(backups, backup_dir=None):
+    from .materialize import write_atomic
+    backups = sorted(backups, key=lambda b: (b['created'], b['name']))
+    write_atomic(
+        catalog_path(backup_dir),
+        json.dumps({'backups': backups}, indent=2, sort_keys=True).encode()
+    )
+
+
+def format_of(name):
+    """
+    Returns the ``pg_dump`` format of a database backup by its name, or
+    ``None`` if it is not a backup.
+    """
+    codec = codec_of(name)
+    if codec:
+        name = name[:-len(EXTENSIONS[codec])]
+    if name.endswith('.backup'):
+        return 'custom'
+    if name.endswith('.backup.sql'):
+        return 'plain'
+    if name.endswith('.backup.d') and not codec:
+        return 'directory'
+    return None
+
+
+def tree_size(path):
+    """The size of a file or of the files under a directory."""
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    size = 0
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                size += tree_size(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+
+def entry(name, database_format, backup_dir=None, server_version=None):
+    """
+    Returns the catalog entry of the database backup ``BACKUP_DIR/db/name``
+    from its sidecar manifest (the size of directory format backups is
+    computed).
+    """
+    path = os.path.join(backup_dir or BACKUP_DIR, 'db', name)
+    manifest = read_manifest(path) or {}
+    created = manifest.get('created') or datetime.utcfromtimestamp(
+        os.path.getmtime(path)
+    ).strftime(TIME_FORMAT)
+    return {
+        'name': name,
+        'format': database_format,
+        'compression': manifest.get('compression'),
+        'size': manifest['size'] if 'size' in manifest else tree_size(path),
+        'sha256': manifest.get('sha256'),
+        'seconds': manifest.get('seconds'),
+        'created': created,
+        'server_version': server_version,
+    }
+
+
+def rebuild(backup_dir=None):
+    """
+    Builds the catalog from the backups in ``BACKUP_DIR/db`` (and their
+    manifests) and returns its entries. The server version is unknown for
+    these.
+    """
+    db_dir = os.path.join(backup_dir or BACKUP_DIR, 'db')
+    backups = []
+    with _locked(backup_dir):
+        try:
+            names = os.listdir(db_dir)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            database_format = format_of(name)
+            if database_format:
+                backups.append(entry(name, database_format, backup_dir))
+        _write(backups, backup_dir)
+    return load(backup_dir)
+
+
+def load(backup_dir=None):
+    """
+    Returns the entries of the catalog, oldest first. A missing catalog is
+    rebuilt from ``BACKUP_DIR/db``; see ``sync`` for backups added or
+    removed by hand.
+    """
+    try:
+        with open(catalog_path(backup_dir)) as f:
+            return json.load(f)['backups']
+    except FileNotFoundError:
+        return rebuild(backup_dir)
+
+
+def sync(backup_dir=None):
+    """
+    Brings the catalog up to date with the names in ``BACKUP_DIR/db`` (a
+    single ``listdir``, the known backups are not looked at): backups
+    copied there by hand are added, the ones deleted by hand are dropped.
+    Returns the entries, oldest first.
+    """
+    load(backup_dir)
+    try:
+        names = set(os.listdir(os.path.join(backup_dir or BACKUP_DIR, 'db')))
+    except FileNotFoundError:
+        names = set()
+    with _locked(backup_dir):
+        with open(catalog_path(backup_dir)) as f:
+            backups = json.load(f)['backups']
+        known = set(b['name'] for b in backups)
+        new = [
+            entry(name, format_of(name), backup_dir)
+            for name in sorted(names - known) if format_of(name)
+        ]
+        if new or known - names:
+            backups = [b for b in backups if b['name'] in names] + new
+            _write(backups, backup_dir)
+    return load(backup_dir)
+
+
+def add(item, backup_dir=None):
+    """Adds (or replaces) an entry of the catalog."""
+    load(backup_dir)
+    with _locked(backup_dir):
+        with open(catalog_path(backup_dir)) as f:
+            backups = json.load(f)['backups']
+        backups = [b for b in backups if b['name'] != item['name']]
+        backups.append(item)
+        _write(backups, backup_dir)
+
+
+def select(backups, last=0, daily=0, weekly=0, monthly=0):
+    """
+    Applies a retention policy to the catalog entries ``backups``: the
+    ``last`` newest ones are kept, and the newest one of each of the
+    ``daily`` / ``weekly`` / ``monthly`` most recent days / ISO weeks /
+    months that have backups.
+
+    Returns a dict mapping the names of the kept backups to the reasons
+    (``['last', 'daily', ...]``).
+    """
+    newest = sorted(
+        backups, key=lambda b: (b['created'], b['name']), reverse=True
+    )
+    keep = {}
+    for b in newest[:last]:
+        keep.setdefault(b['name'], []).append('last')
+    for reason, count, bucket in [
+        ('daily', daily, lambda t: t.date()),
+        ('weekly', weekly, lambda t: t.isocalendar()[:2]),
+        ('monthly', monthly, lambda t: (t.year, t.month)),
+    ]:
+        seen = set()
+        for b in newest:
+            if len(seen) >= count:
+                break
+            key = bucket(datetime.strptime(b['created'], TIME_FORMAT))
+            if key not in seen:
+                seen.add(key)
+                keep.setdefault(b['name'], []).append(reason)
+    return keep
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    try:
+        os.unlink(manifest_path(path))
+    except FileNotFoundError:
+        pass
+
+
+def prune(
+    last=0, daily=0, weekly=0, monthly=0, dry_run=False, backup_dir=None
+):
+    """
+    Deletes the database backups not kept by the retention policy (see
+    ``select``) with their manifests and catalog entries. Returns the
+    names of the deleted (with ``dry_run``: to be deleted) backups.
+
+    Example::
+
+        from gdockutils.catalog import prune
+
+        prune(last=3, daily=7, weekly=4, monthly=12, dry_run=True)
+    """
+    load(backup_dir)
+    with _locked(backup_dir):
+        with open(catalog_path(backup_dir)) as f:
+            backups = json.load(f)['backups']
+        keep = select(backups, last, daily, weekly, monthly)
+        removed = []
+        for b in backups:
+            if b['name'] in keep:
+                printerr('keep   %s (%s)' % (
+                    b['name'], ', '.join(keep[b['name']])
+                ))
+            else:
+                printerr('delete %s%s' % (
+                    b['name'], ' (dry run)' if dry_run else ''
+                ))
+                removed.append(b['name'])
+                if not dry_run:
+                    _remove(os.path.join(
+                        backup_dir or BACKUP_DIR, 'db', b['name']
+                    ))
+        if not dry_run:
+            _write([b for b in backups if b['name'] in keep], backup_dir)
+    return removed
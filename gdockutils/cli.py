@@ -1,17 +1,14 @@
+# Every function here is a console script entry point. They import the
+# modules they need when called, so that e.g. gprun does not pay for
+# importing the db or yaml machinery at startup.
 import argparse
+import os
 import sys
 
-from .certificates import create
-from .gprun import gprun as _gprun
-from .db import ensure_db as _ensure_db
-from .db import backup as _backup
-from .db import restore as _restore
-from . import DATABASE_NAME, DATABASE_USER
-from .secret import createsecret as _createsecret
-from .secret import readsecret as _readsecret
+from . import DATABASE_NAME, DATABASE_USER, SECRETD_SOCKET
 from . import SecretAlreadyExists, SecretDatabaseNotFound, SecretDoesNotExist
-from . import printerr
-from . prepare import prepare as _prepare
+from . import SecretAccessDenied
+from . import printerr, load_yaml
 
 
 def createcerts():
@@ -32,6 +29,8 @@ def createcerts():
     if not args.hostname:
         parser.error('At least one host name must be specified.')
 
+    from .certificates import create
+
     create(args.hostname, args.ip)
 
 
@@ -40,8 +39,16 @@ def gprun():
         description=(
             'Runs the specified command using different user/group.\n'
             'On SIGTERM and SIGINT, sends the specified signal to the process.'
+            '\nWith --supervise or several "--" separated command groups, '
+            'runs and supervises several processes.'
         ),
-        usage='gprun [-h] [-u USERSPEC] [-s STOPSIGNAL] command [...]'
+        usage=(
+            'gprun [-h] [-u USERSPEC] [-s STOPSIGNAL]\n'
+            '             [--secret NAME[:ENVVAR|:fd]] command [...]\n'
+            '       gprun [-h] --supervise CONF\n'
+            '       gprun [-h] [options] -- [program options] command [...] '
+            '-- ...'
+        )
     )
     parser.add_argument(
         '-u', '--userspec',
@@ -54,27 +61,202 @@ def gprun():
         '-s', '--stopsignal',
         help='the name of the signal to send to the process'
     )
+    parser.add_argument(
+        '--stop-sequence', metavar='SIGNAL[:SECONDS],...',
+        help=(
+            'escalate on SIGTERM/SIGINT, e.g. SIGINT:10,SIGTERM:5,SIGKILL '
+            '(sent to the process group with -n)'
+        )
+    )
     parser.add_argument(
         '-n', '--newsession',
-        help='backs up files from /data/files/ to BACKUP_DIR/files',
+        help='start the process in a new session',
         action='store_true'
     )
+    parser.add_argument(
+        '--secret', action='append', metavar='NAME[:ENVVAR|:fd]',
+        help=(
+            'pass the secret to the process in an inherited file descriptor '
+            '(NAME_FILE or ENVVAR will be set to /proc/self/fd/N, NAME_FD '
+            'to N with :fd); with -u before Python 3.8 only :fd works'
+        )
+    )
+    parser.add_argument(
+        '-m', '--mode', choices=['spawn', 'preexec', 'exec'],
+        default='spawn',
+        help=(
+            'spawn: switch user/group without running Python code between '
+            'fork and exec, if supported (default); preexec: switch in a '
+            'preexec function; exec: replace gprun with the command'
+        )
+    )
+    parser.add_argument(
+        '-x', '--exec', dest='mode', action='store_const', const='exec',
+        help='the same as --mode exec'
+    )
+    resources = parser.add_argument_group(
+        'resources',
+        'Limits and priorities of the process. These override the settings '
+        'of the profile.'
+    )
+    resources.add_argument(
+        '--profile',
+        help='use the resource profile of this name from conf/resources.yml'
+    )
+    resources.add_argument(
+        '--cpus', metavar='LIST',
+        help='the CPUs the process may run on, e.g. 0-3,6'
+    )
+    resources.add_argument(
+        '--nofile', metavar='SOFT[:HARD]',
+        help='the maximum number of open files'
+    )
+    resources.add_argument(
+        '--memlock', metavar='SOFT[:HARD]',
+        help='the maximum amount of locked memory, e.g. 64m or unlimited'
+    )
+    resources.add_argument(
+        '--nice', type=int, help='the niceness of the process'
+    )
+    resources.add_argument(
+        '--ionice', metavar='CLASS[:LEVEL]',
+        help='the I/O scheduling class: idle, best-effort or realtime'
+    )
+    resources.add_argument(
+        '--oom-score-adj', type=int, metavar='N',
+        help='the OOM killer score adjustment (-1000 to 1000)'
+    )
+    metrics = parser.add_argument_group(
+        'metrics',
+        'Record the wall time and the resource usage of every run.'
+    )
+    metrics.add_argument(
+        '--metrics', metavar='FILE',
+        help=(
+            'append JSON lines to this file, or update it as a Prometheus '
+            'textfile if it ends with .prom (default: '
+            '$GDOCKUTILS_METRICS_FILE)'
+        )
+    )
+    metrics.add_argument(
+        '--metrics-interval', metavar='SECONDS', type=float,
+        help='also sample /proc/<pid> (I/O, threads, RSS) this often'
+    )
+    metrics.add_argument(
+        '--job', help='the job name in the metrics (default: the command)'
+    )
+    parser.add_argument(
+        '--supervise', metavar='CONF',
+        help=(
+            'run the programs defined in the "programs" section of this '
+            'yaml file'
+        )
+    )
     parser.add_argument(
         'command',
         nargs=argparse.REMAINDER,
         # nargs='+',
-        help='the command to run'
+        help=(
+            'the command to run; command groups starting with "--" may '
+            'have their own -u, -s, --stop-sequence, --secret, --profile, '
+            '--restart and --name options'
+        )
     )
     args = parser.parse_args()
+    args.resources = _resources(args)
+
+    groups = None
+    if args.command and args.command[0] == '--':
+        groups = [[]]
+        for arg in args.command[1:]:
+            if arg == '--':
+                groups.append([])
+            else:
+                groups[-1].append(arg)
+        groups = [g for g in groups if g]
+        # a single group without options of its own is a plain command
+        if len(groups) == 1 and not groups[0][0].startswith('-'):
+            args.command, groups = groups[0], None
+
+    if args.supervise or groups:
+        if args.supervise and groups:
+            parser.error('--supervise cannot be used with command groups')
+        if args.mode == 'exec':
+            parser.error('exec mode cannot be used with multiple programs')
+
+        from .supervisor import Program, supervise, load_programs
+
+        if args.supervise:
+            programs = load_programs(args.supervise)
+        else:
+            programs = [
+                Program(**vars(_program_args(g, args))) for g in groups
+            ]
+        if not programs:
+            parser.error('No programs given')
+        supervise(
+            programs, metrics=args.metrics,
+            metrics_interval=args.metrics_interval
+        )
+        return
+
     if not args.command:
         parser.error('No command given')
 
+    from .gprun import gprun as _gprun
+
     _gprun(
         userspec=args.userspec,
         stopsignal=args.stopsignal,
         start_new_session=args.newsession,
-        command=args.command
+        command=args.command,
+        secrets=args.secret,
+        mode=args.mode,
+        resources=args.resources,
+        metrics=args.metrics,
+        metrics_interval=args.metrics_interval,
+        job=args.job,
+        stop_sequence=args.stop_sequence
+    )
+
+
+def _resources(args):
+    from .resources import KEYS, load_profile
+
+    resources = load_profile(args.profile) if args.profile else {}
+    for key in KEYS:
+        if getattr(args, key) is not None:
+            resources[key] = getattr(args, key)
+    return resources or None
+
+
+def _program_args(group, defaults):
+    parser = argparse.ArgumentParser(
+        prog='gprun ... --', add_help=False,
+        description='Options of a supervised program.'
+    )
+    parser.add_argument('-u', '--userspec', default=defaults.userspec)
+    parser.add_argument('-s', '--stopsignal', default=defaults.stopsignal)
+    parser.add_argument('--stop-sequence', default=defaults.stop_sequence)
+    parser.add_argument(
+        '--secret', action='append', dest='secrets',
+        default=defaults.secret
+    )
+    parser.add_argument(
+        '--profile', dest='resources', default=defaults.resources
+    )
+    parser.add_argument(
+        '-r', '--restart', default='on-failure',
+        choices=['always', 'on-failure', 'never']
     )
+    parser.add_argument('--name')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args(group)
+    if not args.command:
+        parser.error('No command given')
+    if args.name is None:
+        args.name = os.path.basename(args.command[0])
+    return args
 
 
 def ensure_db():
@@ -95,6 +277,8 @@ def ensure_db():
     )
     args = parser.parse_args()
 
+    from .db import ensure_db as _ensure_db
+
     _ensure_db(args.database, args.user)
 
 
@@ -107,8 +291,8 @@ def backup():
     parser.add_argument(
         '-d', '--database_format',
         help='Creates a database backup to BACKUP_DIR/db using the given '
-             'format (custom or plain).',
-        choices=['custom', 'plain']
+             'format (custom, plain or directory).',
+        choices=['custom', 'plain', 'directory']
     )
     parser.add_argument(
         '-f', '--files',
@@ -123,11 +307,32 @@ def backup():
         '--backup_gid',
         help='the gid of the backup user',
     )
+    parser.add_argument(
+        '-c', '--compress', choices=['gzip', 'xz', 'zstd'],
+        help='compress a custom or plain format backup in parallel'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='the number of parallel jobs of a directory format backup, '
+             'of the compression or of the snapshot hashing (default: the '
+             'number of available CPUs)'
+    )
+    parser.add_argument(
+        '-s', '--snapshot',
+        help='take a deduplicated snapshot of the files to '
+             'BACKUP_DIR/snapshots instead of mirroring them (flag)',
+        action='store_true'
+    )
     args = parser.parse_args()
+    if args.snapshot and not args.files:
+        parser.error('--snapshot needs --files')
+
+    from .db import backup as _backup
 
     _backup(
         args.database_format, args.files,
-        args.backup_uid, args.backup_gid
+        args.backup_uid, args.backup_gid, args.jobs, args.compress,
+        args.snapshot
     )
 
 
@@ -161,11 +366,69 @@ def restore():
         help='the owner of the created database',
         default=DATABASE_USER
     )
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='the number of parallel jobs restoring a custom or directory '
+             'format backup or a snapshot (default: the number of available '
+             'CPUs)'
+    )
+    parser.add_argument(
+        '-s', '--snapshot', metavar='ID',
+        help='restore the files from this snapshot instead of BACKUP_DIR/files'
+    )
     args = parser.parse_args()
+    if args.snapshot and not args.files:
+        parser.error('--snapshot needs --files')
+
+    from .db import restore as _restore
 
     _restore(
         args.db_backup_file, args.files,
-        args.drop_db, args.create_db, args.owner
+        args.drop_db, args.create_db, args.owner, args.jobs, args.snapshot
+    )
+
+
+def prune():
+    parser = argparse.ArgumentParser(
+        description=(
+            'Deletes the database backups in BACKUP_DIR/db not kept by the '
+            'retention policy, using the backup catalog.'
+        ),
+    )
+    parser.add_argument(
+        '-l', '--keep-last', type=int, default=0,
+        help='keep the given number of newest backups'
+    )
+    parser.add_argument(
+        '-d', '--keep-daily', type=int, default=0,
+        help='keep the newest backup of the given number of last days'
+    )
+    parser.add_argument(
+        '-w', '--keep-weekly', type=int, default=0,
+        help='keep the newest backup of the given number of last weeks'
+    )
+    parser.add_argument(
+        '-m', '--keep-monthly', type=int, default=0,
+        help='keep the newest backup of the given number of last months'
+    )
+    parser.add_argument(
+        '-n', '--dry-run',
+        help='only print what would be deleted (flag)',
+        action='store_true'
+    )
+    args = parser.parse_args()
+    if not (
+        args.keep_last or args.keep_daily or args.keep_weekly or
+        args.keep_monthly
+    ):
+        parser.error('no retention policy given, this would delete all '
+                     'backups')
+
+    from .catalog import prune as _prune
+
+    _prune(
+        args.keep_last, args.keep_daily, args.keep_weekly, args.keep_monthly,
+        args.dry_run
     )
 
 
@@ -193,16 +456,60 @@ def createsecret():
         '-v', '--value',
         help='use the given value'
     )
+    group.add_argument(
+        '-b', '--batch',
+        help=(
+            'create all the secrets defined in this yaml file in one '
+            'transaction (secret: {fromfile|random|value: ...})'
+        )
+    )
+    group.add_argument(
+        '-g', '--generate-missing',
+        help=(
+            'create a random value for every secret defined in '
+            'conf/secrets.yml but missing from the secret database'
+        ),
+        action='store_true'
+    )
     parser.add_argument(
-        'secret',
+        '-l', '--length', type=int, default=32,
+        help='the length of the generated secrets (default: 32)'
+    )
+    parser.add_argument(
+        '-c', '--charset',
+        help=(
+            'the characters of the random secrets '
+            '(default: ascii letters, digits and punctuation)'
+        )
+    )
+    parser.add_argument(
+        'secret', nargs='?',
         help='the name of the secret'
     )
     args = parser.parse_args()
-    try:
-        _createsecret(
-            args.secret,
-            args.fromfile, args.random, args.value, args.force
+    multiple = args.batch is not None or args.generate_missing
+    if not multiple and args.secret is None:
+        parser.error('the name of the secret is required')
+    if multiple and args.secret is not None:
+        parser.error(
+            'no secret name can be given with --batch or --generate-missing'
         )
+    from .secret import createsecret as _createsecret
+    from .secret import createsecrets as _createsecrets
+    from .secret import generate_missing as _generate_missing
+
+    try:
+        if args.generate_missing:
+            for secret in _generate_missing(args.length, args.charset):
+                printerr('created %s' % secret)
+        elif args.batch is not None:
+            specs = load_yaml(args.batch) or {}
+            _createsecrets(specs, args.force)
+        else:
+            _createsecret(
+                args.secret,
+                args.fromfile, args.random, args.value, args.force
+            )
     except (SecretAlreadyExists, SecretDatabaseNotFound) as e:
         printerr(e.args[0])
         sys.exit(1)
@@ -223,9 +530,13 @@ def readsecret():
         help='the name of the secret'
     )
     args = parser.parse_args()
+    from .secret import readsecret as _readsecret
+
     try:
         ret = _readsecret(args.secret, args.store)
-    except (SecretDoesNotExist, SecretDatabaseNotFound) as e:
+    except (
+        SecretDoesNotExist, SecretDatabaseNotFound, SecretAccessDenied
+    ) as e:
         printerr(e.args[0])
         sys.exit(1)
     sys.stdout.buffer.write(ret)
@@ -247,9 +558,92 @@ def prepare():
         help='secrets will be owned by the given user:group',
     )
     parser.add_argument(
-        'service',
-        help='the service to prepare'
+        '-m', '--user-map', action='append', default=[],
+        help=(
+            'secrets of the given service will be owned by the given '
+            'user:group, in the form service=user[:group] (repeatable)'
+        )
+    )
+    parser.add_argument(
+        '--split',
+        help='put the secrets of each service into /run/secrets/<service>',
+        action='store_true'
+    )
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='the number of services to prepare in parallel'
+    )
+    parser.add_argument(
+        'service', nargs='+',
+        help='the service(s) to prepare'
     )
     args = parser.parse_args()
 
-    _prepare(args.service, args.wait, args.user)
+    user_map = {}
+    for m in args.user_map:
+        service, sep, spec = m.partition('=')
+        if not sep or not service or not spec:
+            parser.error('invalid --user-map: %r' % m)
+        user_map[service] = spec
+
+    from .prepare import prepare_services as _prepare_services
+
+    _prepare_services(
+        args.service, args.wait, user_map, args.user, args.split, args.jobs
+    )
+
+
+def secretd():
+    parser = argparse.ArgumentParser(
+        description=(
+            'Serves the secret database (./.secret.env) over a Unix domain '
+            'socket. Processes get only the secrets assigned to their user '
+            'in conf/secrets.yml.'
+        ),
+    )
+    parser.add_argument(
+        '-s', '--socket',
+        help='the path of the socket (default: %s)' % SECRETD_SOCKET,
+        default=SECRETD_SOCKET
+    )
+    parser.add_argument(
+        '-i', '--interval', type=float, default=1.0,
+        help='check the files for changes this often (seconds)'
+    )
+    args = parser.parse_args()
+
+    import signal
+    from .secretd import serve
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve(args.socket, args.interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def secretstatus():
+    parser = argparse.ArgumentParser(
+        description=(
+            'Prints the defined, present, missing and orphaned secrets and '
+            'the coverage of each service as json.'
+        ),
+    )
+    parser.add_argument(
+        '-c', '--check',
+        help='exit with 1 if any of the defined secrets is missing',
+        action='store_true'
+    )
+    args = parser.parse_args()
+
+    import json
+    from .secret import secretstatus as _secretstatus
+
+    try:
+        status = _secretstatus()
+    except SecretDatabaseNotFound as e:
+        printerr(e.args[0])
+        sys.exit(1)
+    print(json.dumps(status, indent=2))
+    if args.check and status['missing']:
+        sys.exit(1)
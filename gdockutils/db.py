@@ -1,16 +1,32 @@
+import json
+import math
 import os
+import re
+import subprocess
 import time
-from hashlib import md5 as _md5
+from hashlib import md5 as _md5, sha256
 
-from . import get_param, uid, gid, printerr, run, cp
+from . import get_param, uid, gid, printerr, run
 from . import (
     POSTGRESCONF_ORIG, PG_HBA_ORIG, BACKUP_DIR, DATA_FILES_DIR,
     BACKUP_FILE_PREFIX, PGDATA, DATABASE_NAME, DATABASE_USER, DATABASE_HOST,
-    DEBUG
+    DATABASE_PORT, DATABASE_WAIT_TIMEOUT, POSTGRES_AUTOTUNE, DEBUG
 )
+from . import catalog
 from .prepare import prepare
-from .secret import readsecret
+from .secret import readsecret, readsecrets
 from .gprun import gprun
+from .perms import chown_tree, normalize, Rules
+from .materialize import state_digest, disk_digest, write_atomic
+from .limits import cpu_count
+from .stream import (
+    EXTENSIONS, codec_of, describe, read_stream, verify, write_stream
+)
+
+# the state ensure_db applied last time
+FINGERPRINT_FILE = '.gdockutils-fingerprint.json'
+# included by the deployed postgresql.conf
+AUTO_CONF_FILE = 'gdockutils.auto.conf'
 
 
 DB_ENV = {
@@ -34,114 +50,437 @@ def md5(s):
     return _md5(s.encode()).hexdigest()
 
 
+def _read_fingerprint():
+    try:
+        with open(os.path.join(PGDATA, FINGERPRINT_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _size(n):
+    kb = int(n) // 1024
+    return '%dMB' % (kb // 1024) if kb >= 1024 else '%dkB' % max(kb, 64)
+
+
+def pg_version(pgdata=None):
+    """
+    Returns the major version of the cluster in ``pgdata`` (default:
+    ``PGDATA``) as a tuple, e.g. ``(9, 6)`` or ``(10,)``, or ``None`` if it
+    is not initialized.
+    """
+    try:
+        with open(os.path.join(pgdata or PGDATA, 'PG_VERSION')) as f:
+            return tuple(int(x) for x in f.read().strip().split('.'))
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+# the first major version knowing a parameter, the others are older
+SETTING_VERSIONS = {
+    'min_wal_size': (9, 5),
+    'max_wal_size': (9, 5),
+    'max_parallel_workers_per_gather': (9, 6),
+    'max_parallel_workers': (10,),
+    'max_parallel_maintenance_workers': (11,),
+}
+
+
+def postgres_settings(
+    memory, cpus, rotational=None, max_connections=100, version=None
+):
+    """
+    Computes the memory, parallelism, WAL and planner settings of a web
+    application database from the available ``memory`` (bytes), the number
+    of ``cpus`` and the storage type (``None`` is handled as SSD). Returns
+    a list of ``(name, value)`` pairs.
+
+    :param tuple version: the major version of the server (see
+      ``pg_version``); parameters it does not know are left out, as
+      postgres refuses to start with them. ``None`` means the newest.
+    """
+    shared_buffers = memory // 4
+    workers = max(1, cpus)
+    per_gather = min(4, max(1, math.ceil(workers / 2)))
+    settings = [
+        ('shared_buffers', _size(shared_buffers)),
+        ('effective_cache_size', _size(memory * 3 // 4)),
+        ('maintenance_work_mem', _size(min(memory // 16, 2 << 30))),
+        ('work_mem', _size(
+            (memory - shared_buffers) // (max_connections * 3) // per_gather
+        )),
+        ('wal_buffers', _size(
+            min(16 << 20, max(shared_buffers * 3 // 100, 64 << 10))
+        )),
+    ]
+    if memory < 4 << 30:
+        settings += [('min_wal_size', '256MB'), ('max_wal_size', '1GB')]
+    else:
+        settings += [('min_wal_size', '1GB'), ('max_wal_size', '4GB')]
+    settings += [('checkpoint_completion_target', '0.9')]
+    if workers >= 4:
+        # the background workers share max_worker_processes (8 by default)
+        settings += [
+            ('max_worker_processes', str(max(8, workers))),
+            ('max_parallel_workers', str(workers)),
+            ('max_parallel_workers_per_gather', str(per_gather)),
+            ('max_parallel_maintenance_workers', str(per_gather)),
+        ]
+    if rotational:
+        settings += [
+            ('random_page_cost', '4'), ('effective_io_concurrency', '2')
+        ]
+    else:
+        settings += [
+            ('random_page_cost', '1.1'), ('effective_io_concurrency', '200')
+        ]
+    if version is not None:
+        settings = [
+            (name, value) for name, value in settings
+            if SETTING_VERSIONS.get(name, ()) <= version
+        ]
+    return settings
+
+
+def auto_conf(postgresql_conf):
+    """
+    Returns the content of ``gdockutils.auto.conf``, the settings computed
+    from the cgroup limits of the container and the storage of ``PGDATA``.
+    """
+    if not POSTGRES_AUTOTUNE:
+        return b'# automatic tuning is disabled\n'
+    from .limits import memory_limit, rotational
+
+    max_connections = re.findall(
+        rb'^\s*max_connections\s*=\s*(\d+)', postgresql_conf, re.MULTILINE
+    )
+    memory, cpus, rot = memory_limit(), cpu_count(), rotational(PGDATA)
+    lines = [
+        '# generated by gdockutils, postgresql.conf overrides these',
+        '# memory: %s, cpus: %d, storage: %s' % (
+            _size(memory), cpus, {True: 'rotational', False: 'ssd'}.get(
+                rot, 'unknown'
+            )
+        ),
+    ] + ['%s = %s' % s for s in postgres_settings(
+        memory, cpus, rot,
+        int(max_connections[-1]) if max_connections else 100, pg_version()
+    )]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def deploy_config(u, g):
+    """
+    Writes the config files into ``PGDATA``, unless they are already there
+    with the right owner and mode. ``postgresql.conf`` includes the
+    generated ``gdockutils.auto.conf`` first, so its own settings win.
+    Returns the digests of the contents.
+    """
+    files = {}
+    for orig, name in (
+        (PG_HBA_ORIG, 'pg_hba.conf'), (POSTGRESCONF_ORIG, 'postgresql.conf')
+    ):
+        with open(orig, 'rb') as f:
+            files[name] = f.read()
+    files[AUTO_CONF_FILE] = auto_conf(files['postgresql.conf'])
+    files['postgresql.conf'] = (
+        "include_if_exists = '%s'\n" % AUTO_CONF_FILE
+    ).encode() + files['postgresql.conf']
+
+    digests = {}
+    for name, content in sorted(files.items()):
+        dest = os.path.join(PGDATA, name)
+        if disk_digest(dest, len(content)) != state_digest(
+            content, u, g, 0o600
+        ):
+            printerr('updating %s' % dest)
+            write_atomic(dest, content, u, g, 0o600)
+        digests[name] = sha256(content).hexdigest()
+    return digests
+
+
+def _psql(psql, commands, check=True):
+    """
+    Runs ``commands`` in one ``psql`` session. With ``check``, it stops at
+    the first error and ``False`` is returned if there was one.
+    """
+    cmd = list(psql)
+    if check:
+        cmd += ['-v', 'ON_ERROR_STOP=1']
+    for command in commands:
+        cmd += ['-c', command]
+    try:
+        run(cmd)
+    except subprocess.CalledProcessError:
+        if check:
+            return False
+    return True
+
+
 def ensure_db(db, user):
     """
-    Initialize the database, set up users and passwords
+    Initialize the database, set up users and passwords.
+
+    The applied state (config file digests, role password hashes, database
+    name and owner) is recorded in ``PGDATA/.gdockutils-fingerprint.json``.
+    Only the roles and the database whose state changed are set up, and the
+    temporary server is not started at all if nothing changed. Delete the
+    file to set up everything again. A step that failed is not recorded,
+    so it is retried next time, and an ``Exception`` is raised once the
+    temporary server is stopped.
     """
     os.makedirs(PGDATA, exist_ok=True)
     os.chmod(PGDATA, 0o700)
+    PG_VERSION = os.path.join(PGDATA, 'PG_VERSION')
+    initialized = (
+        os.path.isfile(PG_VERSION) and os.path.getsize(PG_VERSION) > 0
+    )
     u, g = uid('postgres'), gid('postgres')
-    for root, dirs, files in os.walk(PGDATA):
-        os.chown(root, u, g)
+    # initdb needs an empty directory, the marker is written only later
+    chown_tree(PGDATA, u, g, marker=initialized)
 
-    PG_VERSION = os.path.join(PGDATA, 'PG_VERSION')
-    if not os.path.isfile(PG_VERSION) or os.path.getsize(PG_VERSION) == 0:
+    if not initialized:
         gprun(userspec='postgres', command=['initdb'], sys_exit=False)
+    old = _read_fingerprint() if initialized else {}
 
-    dest = os.path.join(PGDATA, 'pg_hba.conf')
-    cp(PG_HBA_ORIG, dest, 'postgres', 'postgres', 0o600)
-
-    dest = os.path.join(PGDATA, 'postgresql.conf')
-    cp(POSTGRESCONF_ORIG, dest, 'postgres', 'postgres', 0o600)
+    fingerprint = {'config': deploy_config(u, g)}
 
     prepare('postgres')
 
-    dbpass = readsecret('DB_PASSWORD_POSTGRES', decode=True)
-    dbpass_postgres = "'md5%s'" % md5(dbpass + 'postgres')
-    dbpass = readsecret('DB_PASSWORD_DJANGO', decode=True)
-    dbpass_django = "'md5%s'" % md5(dbpass + user)
-    dbpass = readsecret('DB_PASSWORD_EXPLORER', decode=True)
-    dbpass_explorer = "'md5%s'" % md5(dbpass + 'explorer')
-
-    # start postgres locally
-    gprun(userspec='postgres', sys_exit=False, command=[
-        'pg_ctl',
-        '-o', "-c listen_addresses='127.0.0.1'",
-        '-o', "-c log_statement=none",
-        '-o', "-c log_connections=off",
-        '-o', "-c log_disconnections=off",
-        '-w', 'start'
-    ])
-
-    run([
-        'psql', '-h', '127.0.0.1', '-U', 'postgres',
-        '-c', 'ALTER ROLE postgres ENCRYPTED PASSWORD %s' % dbpass_postgres,
-        '-c', 'CREATE ROLE %s' % user,
-        '-c', 'ALTER ROLE %s '
-              'ENCRYPTED PASSWORD %s LOGIN SUPERUSER' % (user, dbpass_django),
-        '-c', 'CREATE ROLE explorer',
-        '-c', 'ALTER ROLE explorer '
-              'ENCRYPTED PASSWORD %s LOGIN' % dbpass_explorer,
-        '-c', '\c postgres %s' % user,
-        '-c', 'CREATE DATABASE %s' % db,
-        '-c', '\c %s %s' % (db, user),
-        '-c', 'REVOKE CREATE ON SCHEMA public FROM public',
-        '-c', 'GRANT SELECT ON ALL TABLES IN SCHEMA public TO explorer',
-        '-c', 'ALTER DEFAULT PRIVILEGES FOR USER django IN SCHEMA public '
-              'GRANT SELECT ON TABLES TO explorer'
-    ])
-
-    # stop the internally started postgres
-    gprun(userspec='postgres', sys_exit=False, command=[
-        'pg_ctl', 'stop', '-s', '-w', '-m', 'fast'
+    passwords = readsecrets([
+        'DB_PASSWORD_POSTGRES', 'DB_PASSWORD_DJANGO', 'DB_PASSWORD_EXPLORER'
     ])
+    hashes = {
+        'postgres': "'md5%s'" % md5(
+            passwords['DB_PASSWORD_POSTGRES'].decode() + 'postgres'
+        ),
+        user: "'md5%s'" % md5(passwords['DB_PASSWORD_DJANGO'].decode() + user),
+        'explorer': "'md5%s'" % md5(
+            passwords['DB_PASSWORD_EXPLORER'].decode() + 'explorer'
+        ),
+    }
+    fingerprint['roles'] = dict(
+        (role, sha256(h.encode()).hexdigest()) for role, h in hashes.items()
+    )
+    fingerprint['database'] = [db, user]
+
+    changed = [
+        role for role in hashes
+        if old.get('roles', {}).get(role) != fingerprint['roles'][role]
+    ]
+    role_steps = []
+    if 'postgres' in changed:
+        role_steps.append(('postgres', [
+            'ALTER ROLE postgres ENCRYPTED PASSWORD %s' % hashes['postgres']
+        ]))
+    if user in changed:
+        role_steps.append((user, [
+            'ALTER ROLE %s ENCRYPTED PASSWORD %s LOGIN SUPERUSER' % (
+                user, hashes[user]
+            ),
+        ]))
+    if 'explorer' in changed:
+        role_steps.append(('explorer', [
+            'ALTER ROLE explorer '
+            'ENCRYPTED PASSWORD %s LOGIN' % hashes['explorer'],
+        ]))
+    database_changed = old.get('database') != fingerprint['database']
+    if database_changed:
+        changed.append('database %s' % db)
+
+    # the parts that were not (successfully) applied keep their old state,
+    # so they are tried again next time
+    applied = {
+        'config': fingerprint['config'],
+        'roles': dict(
+            (role, value) for role, value in fingerprint['roles'].items()
+            if role not in changed
+        ),
+    }
+    for role, value in old.get('roles', {}).items():
+        if role in changed:
+            applied['roles'][role] = value
+    if 'database' in old:
+        applied['database'] = old['database']
+    failed = []
+
+    if changed:
+        printerr('setting up %s' % ', '.join(changed))
+        # start postgres locally
+        gprun(userspec='postgres', sys_exit=False, command=[
+            'pg_ctl',
+            '-o', "-c listen_addresses='127.0.0.1'",
+            '-o', "-c log_statement=none",
+            '-o', "-c log_connections=off",
+            '-o', "-c log_disconnections=off",
+            '-w', 'start'
+        ])
+        try:
+            psql = ['psql', '-h', '127.0.0.1', '-U', 'postgres']
+            # these fail if the role exists already, the errors are expected
+            creates = [
+                'CREATE ROLE %s' % role
+                for role in (user, 'explorer') if role in changed
+            ]
+            if creates:
+                _psql(psql, creates, check=False)
+            for role, commands in role_steps:
+                if _psql(psql, commands):
+                    applied['roles'][role] = fingerprint['roles'][role]
+                else:
+                    failed.append('role %s' % role)
+            if database_changed:
+                _psql(psql, [
+                    '\\c postgres %s' % user, 'CREATE DATABASE %s' % db
+                ], check=False)
+                if _psql(psql, [
+                    '\\c %s %s' % (db, user),
+                    'REVOKE CREATE ON SCHEMA public FROM public',
+                    'GRANT SELECT ON ALL TABLES IN SCHEMA public TO explorer',
+                    'ALTER DEFAULT PRIVILEGES FOR USER django IN SCHEMA '
+                    'public GRANT SELECT ON TABLES TO explorer',
+                ]):
+                    applied['database'] = fingerprint['database']
+                else:
+                    failed.append('database %s' % db)
+        finally:
+            # stop the internally started postgres
+            gprun(userspec='postgres', sys_exit=False, command=[
+                'pg_ctl', 'stop', '-s', '-w', '-m', 'fast'
+            ])
+    else:
+        printerr('roles and database are up to date')
+
+    if applied != old:
+        write_atomic(
+            os.path.join(PGDATA, FINGERPRINT_FILE),
+            json.dumps(applied, indent=2, sort_keys=True).encode(),
+            u, g, 0o600
+        )
+    if failed:
+        raise Exception('setting up %s failed' % ', '.join(failed))
     set_files_perms()
 
 
 def set_backup_perms(backup_uid, backup_gid):
     os.makedirs(os.path.join(BACKUP_DIR, 'db'), exist_ok=True)
     os.makedirs(os.path.join(BACKUP_DIR, 'files'), exist_ok=True)
-
-    for root, dirs, files in os.walk(BACKUP_DIR):
-        os.chown(root, backup_uid, backup_gid)
-        os.chmod(root, 0o700)
-        for f in files:
-            path = os.path.join(root, f)
-            os.chown(path, backup_uid, backup_gid)
-            os.chmod(path, 0o600)
-    os.chmod(BACKUP_DIR, 0o755)
+    stats = normalize(
+        BACKUP_DIR, Rules(backup_uid, backup_gid, 0o700, 0o600, 0o755)
+    )
+    printerr('%s permissions: %s' % (BACKUP_DIR, stats))
 
 
 def set_files_perms():
     os.makedirs(DATA_FILES_DIR, exist_ok=True)
-    u, g = uid('django'), gid('nginx')
-    for root, dirs, files in os.walk(DATA_FILES_DIR):
-        os.chown(root, u, g)
-        os.chmod(root, 0o2750)
-        for f in files:
-            path = os.path.join(root, f)
-            os.chown(path, u, g)
-            os.chmod(path, 0o640)
-
-
-def wait_for_db():
-    while True:
-        silent = not DEBUG
-        env = get_db_env()
+    stats = normalize(
+        DATA_FILES_DIR, Rules(uid('django'), gid('nginx'), 0o2750, 0o640)
+    )
+    printerr('%s permissions: %s' % (DATA_FILES_DIR, stats))
+
+
+def wait_for_db(timeout=None):
+    """
+    Waits until the database accepts connections (probed without spawning
+    processes or authenticating, see ``gdockutils.pgprobe``), then checks
+    once with ``psql`` that we can log in. Returns the seconds it took.
+
+    :param float timeout: give up after this many seconds (default:
+      ``GDOCKUTILS_DATABASE_WAIT_TIMEOUT``, ``0`` waits forever).
+    """
+    from .pgprobe import wait
+
+    env = get_db_env()
+    if timeout is None:
+        timeout = float(DATABASE_WAIT_TIMEOUT or 0) or None
+    return wait(
+        env['PGHOST'], int(DATABASE_PORT), env['PGUSER'], env['PGDATABASE'],
+        check=lambda: run(
+            ['psql', '-c', 'select 1'], silent=not DEBUG, env=env
+        ),
+        timeout=timeout, sslrootcert=env['PGSSLROOTCERT']
+    )
+
+
+def server_version():
+    """Returns the version of the database server, ``None`` on errors."""
+    try:
+        return subprocess.check_output(
+            ['psql', '-X', '-t', '-A', '-c', 'SHOW server_version'],
+            env=get_db_env(), universal_newlines=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError) as e:
+        printerr('could not get the server version: %s' % e)
+        return None
+
+
+def _dump_to(cmd, path, env, **kwargs):
+    """Streams the output of ``cmd`` to ``path`` (see ``write_stream``)."""
+    printerr('%s > %s' % (' '.join(cmd), path))
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, env=env)
+
+    def check():
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    try:
+        return write_stream(proc.stdout, path, check=check, **kwargs)
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    finally:
+        proc.stdout.close()
+
+
+def _restore_from(cmd, path, env):
+    """Streams the decompressed ``path`` to the stdin of ``cmd``."""
+    printerr('%s < %s' % (' '.join(cmd), path))
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, env=env)
+    try:
+        read_stream(path, proc.stdin)
+    except BrokenPipeError:
+        # the command failed, its exit code tells more
+        pass
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
         try:
-            run(['psql', '-c', 'select 1'], silent=silent, env=env)
-        except Exception:
-            printerr('db not ready yet')
-            time.sleep(1)
-        else:
-            printerr('db ready')
-            break
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        proc.wait()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
 
 
 def backup(
     database_format=None, files=None,
-    backup_uid=None, backup_gid=None
+    backup_uid=None, backup_gid=None, jobs=None, compression=None,
+    snapshot=False
 ):
+    """
+    Backs up the database to ``BACKUP_DIR/db`` and/or the files to
+    ``BACKUP_DIR/files``.
+
+    :param str database_format: ``custom``, ``plain`` or ``directory``. The
+      ``directory`` format is dumped by ``jobs`` parallel connections.
+    :param int jobs: defaults to the number of CPUs available to the
+      container.
+    :param str compression: ``gzip``, ``xz`` or ``zstd``. The output of
+      ``pg_dump`` is compressed by ``jobs`` processes on the fly (see
+      ``gdockutils.stream.write_stream``). Not for the directory format.
+
+    :param bool snapshot: take a deduplicated snapshot of the files into
+      ``BACKUP_DIR/snapshots`` (see ``gdockutils.snapshot.create``) instead
+      of mirroring them to ``BACKUP_DIR/files``.
+
+    A sidecar manifest (``<backup>.json``) records the size, the sha256
+    and the duration of every custom and plain format backup. Every
+    database backup is added to the catalog (see ``gdockutils.catalog``)
+    with these and the server version.
+    """
     default_uid = 0  # default is root to be on the safe side
     backup_uid = uid(get_param(backup_uid, 'BACKUP_UID', default_uid))
     backup_gid = gid(get_param(backup_gid, 'BACKUP_GID', backup_uid))
@@ -156,12 +495,43 @@ def backup(
         )
         if database_format == 'plain':
             filename += '.sql'
+        elif database_format == 'directory':
+            filename += '.d'
         filename = os.path.join(BACKUP_DIR, 'db', filename)
-
-        cmd = ['pg_dump', '-v', '-F', database_format, '-f', filename]
-        run(cmd, env=get_db_env(), log_command=True)
-
-    if files:
+        jobs = jobs or cpu_count()
+        version = server_version()
+        start = time.monotonic()
+
+        if compression:
+            if database_format == 'directory':
+                raise Exception('directory backups cannot be compressed')
+            filename += EXTENSIONS[compression]
+            cmd = ['pg_dump', '-v', '-F', database_format]
+            if database_format == 'custom':
+                # compressed by us, in parallel
+                cmd += ['-Z', '0']
+            _dump_to(
+                cmd, filename, get_db_env(), codec=compression, jobs=jobs
+            )
+        else:
+            cmd = ['pg_dump', '-v', '-F', database_format, '-f', filename]
+            if database_format == 'directory':
+                cmd += ['-j', str(jobs)]
+            run(cmd, env=get_db_env(), log_command=True)
+            if database_format != 'directory':
+                describe(filename, time.monotonic() - start)
+
+        item = catalog.entry(
+            os.path.basename(filename), database_format, BACKUP_DIR, version
+        )
+        if item['seconds'] is None:
+            item['seconds'] = round(time.monotonic() - start, 3)
+        catalog.add(item, BACKUP_DIR)
+
+    if files and snapshot:
+        from .snapshot import create
+        create(jobs=jobs or cpu_count())
+    elif files:
         source = DATA_FILES_DIR
         if source[-1] != '/':
             source += '/'
@@ -176,18 +546,47 @@ def backup(
 
 def restore(
     db_backup_file=None, files=None,
-    drop_db=DATABASE_NAME, create_db=DATABASE_NAME, owner=DATABASE_USER
+    drop_db=DATABASE_NAME, create_db=DATABASE_NAME, owner=DATABASE_USER,
+    jobs=None, snapshot=None
 ):
+    """
+    Restores a database backup from ``BACKUP_DIR/db`` and/or the files from
+    ``BACKUP_DIR/files``. Custom and directory format backups are restored
+    by ``jobs`` parallel connections (default: the number of CPUs available
+    to the container). Compressed backups are decompressed on the fly into
+    ``pg_restore`` or ``psql``, without temporary files. Backups with a
+    manifest are checked against its checksum before the database is
+    dropped.
+
+    If ``snapshot`` (an id) is given, the files are rebuilt from that
+    snapshot in ``BACKUP_DIR/snapshots`` instead.
+    """
     if db_backup_file:
         wait_for_db()
         db_backup_file = os.path.join(BACKUP_DIR, 'db', db_backup_file)
-        if db_backup_file.endswith('.backup'):
+        codec = codec_of(db_backup_file)
+        base = db_backup_file
+        if codec:
+            base = db_backup_file[:-len(EXTENSIONS[codec])]
+        if not os.path.isdir(db_backup_file) and not verify(db_backup_file):
+            printerr('%s has no manifest, the checksum is not verified'
+                     % db_backup_file)
+        if codec and base.endswith('.backup'):
+            # parallel restore needs a seekable file
+            _restore_from([
+                'pg_restore', '-d', 'postgres', '--exit-on-error', '--verbose',
+                '--clean', '--create'
+            ], db_backup_file, get_db_env())
+        elif db_backup_file.endswith('.backup') or os.path.isdir(
+            db_backup_file
+        ):
             cmd = [
                 'pg_restore', '-d', 'postgres', '--exit-on-error', '--verbose',
-                '--clean', '--create', db_backup_file
+                '--clean', '--create', '-j', str(jobs or cpu_count()),
+                db_backup_file
             ]
             run(cmd, log_command=True, env=get_db_env())
-        elif db_backup_file.endswith('.backup.sql'):
+        elif base.endswith('.backup.sql'):
             drop_db = get_param(drop_db, 'DROP_DB', 'django')
             create_db = get_param(create_db, 'CREATE_DB', drop_db)
             owner = get_param(owner, 'OWNER', 'django')
@@ -196,12 +595,21 @@ def restore(
                 '-c', 'DROP DATABASE %s' % drop_db,
                 '-c', 'CREATE DATABASE %s OWNER %s' % (create_db, owner)
             ], env=get_db_env(u='postgres', d='postgres'))
-            run([
+            cmd = [
                 'psql', '-v', 'ON_ERROR_STOP=1', '-U', owner, '-d', create_db,
-                '-f', db_backup_file
-            ], env=get_db_env(u=owner, d=create_db))
-
-    if files:
+                '-f', '-' if codec else db_backup_file
+            ]
+            env = get_db_env(u=owner, d=create_db)
+            if codec:
+                _restore_from(cmd, db_backup_file, env)
+            else:
+                run(cmd, env=env)
+
+    if files and snapshot:
+        from .snapshot import restore as restore_snapshot
+        restore_snapshot(snapshot, jobs=jobs or cpu_count())
+        set_files_perms()
+    elif files:
         cmd = [
             'rsync', '-v', '-a', '--delete', '--stats',
             os.path.join(BACKUP_DIR, 'files/'), DATA_FILES_DIR
@@ -1,11 +1,14 @@
-import pwd
-import grp
+import fcntl
 import os
 import subprocess
 import signal
 import sys
+import threading
+import time
 
-from . import DEBUG, printerr
+from . import DEBUG, printerr, getpwnam, getpwuid, getgrnam, grouplist
+from . import METRICS_FILE, METRICS_INTERVAL
+from .metrics import Sampler, collect, wait, write
 
 
 def get_userspec(spec):
@@ -25,14 +28,14 @@ def get_userspec(spec):
         uid = int(uspec)
     except ValueError:
         try:
-            pw = pwd.getpwnam(uspec)
+            pw = getpwnam(uspec)
         except KeyError:
             raise Exception('user %r does not exist' % uspec)
         else:
             uid, username, homedir = pw.pw_uid, pw.pw_name, pw.pw_dir
     else:
         try:
-            pw = pwd.getpwuid(uid)
+            pw = getpwuid(uid)
             username, homedir = pw.pw_name, pw.pw_dir
         except KeyError:
             username, homedir = None, None
@@ -40,22 +43,18 @@ def get_userspec(spec):
     if gspec is None:
         # we try to set additional groups based on the user pwd
         try:
-            pw = pwd.getpwuid(uid)
+            pw = getpwuid(uid)
             gid = pw.pw_gid
         except KeyError:
             gid, groups = None, None
         else:
-            groups = [
-                grp.getgrnam(gr.gr_name).gr_gid
-                for gr in grp.getgrall()
-                if username in gr.gr_mem
-            ]
+            groups = list(grouplist(username, gid))
     else:
         try:
             gid = int(gspec)
         except ValueError:
             try:
-                gr = grp.getgrnam(gspec)
+                gr = getgrnam(gspec)
             except KeyError:
                 raise Exception('group %r does not exist' % gspec)
             else:
@@ -65,9 +64,273 @@ def get_userspec(spec):
     return uid, username, homedir, gid, groups
 
 
+# Python 3.8+
+HAS_MEMFD = hasattr(os, 'memfd_create')
+
+
+def secret_fd(value):
+    """
+    Returns a readable file descriptor holding ``value``: a sealed
+    ``memfd`` where available, the read end of a pipe otherwise.
+    """
+    if HAS_MEMFD:
+        fd = os.memfd_create(
+            'secret', os.MFD_CLOEXEC | getattr(os, 'MFD_ALLOW_SEALING', 0)
+        )
+        view = memoryview(value)
+        while view:
+            view = view[os.write(fd, view):]
+        os.lseek(fd, 0, os.SEEK_SET)
+        if hasattr(fcntl, 'F_ADD_SEALS'):
+            fcntl.fcntl(fd, fcntl.F_ADD_SEALS, (
+                fcntl.F_SEAL_SEAL | fcntl.F_SEAL_SHRINK |
+                fcntl.F_SEAL_GROW | fcntl.F_SEAL_WRITE
+            ))
+        return fd
+
+    r, w = os.pipe()
+    try:
+        if len(value) > 65536:
+            raise Exception('secret is too large to be passed in a pipe')
+        os.write(w, value)
+    except BaseException:
+        os.close(r)
+        raise
+    finally:
+        os.close(w)
+    return r
+
+
+def get_secret_fds(specs, uid=None):
+    """
+    Reads the secrets given by ``specs`` (``NAME[:ENVVAR|:fd]``) and puts
+    each into a file descriptor. Returns the list of file descriptors and
+    the environment variables telling the child where to find them:
+
+    * ``NAME``: ``NAME_FILE=/proc/self/fd/N``
+    * ``NAME:ENVVAR``: ``ENVVAR=/proc/self/fd/N``
+    * ``NAME:fd``: ``NAME_FD=N``
+
+    Without ``memfd_create`` (before Python 3.8) the secrets are passed in
+    pipes, which only their owner can open through ``/proc/self/fd/N``, so
+    if the child runs as another ``uid`` only ``NAME:fd`` is accepted.
+    """
+    from .secret import readsecrets
+
+    parsed = [spec.partition(':')[::2] for spec in specs]
+    if not HAS_MEMFD and uid not in (None, os.geteuid()):
+        for name, target in parsed:
+            if target != 'fd':
+                raise Exception(
+                    'secret %s: /proc/self/fd/N cannot be opened by uid %d '
+                    'without memfd_create (Python 3.8+), use %s:fd'
+                    % (name, uid, name)
+                )
+    values = readsecrets([name for name, target in parsed])
+    fds, env = [], {}
+    try:
+        for name, target in parsed:
+            fd = secret_fd(values[name])
+            fds.append(fd)
+            if target == 'fd':
+                env['%s_FD' % name] = str(fd)
+            else:
+                env[target or '%s_FILE' % name] = '/proc/self/fd/%d' % fd
+    except BaseException:
+        for fd in fds:
+            os.close(fd)
+        raise
+    return fds, env
+
+
+def get_signal(name):
+    if name is None:
+        return None
+    try:
+        return getattr(signal, name)
+    except AttributeError:
+        raise Exception('bad signal: %r' % name)
+
+
+def parse_stop_sequence(spec):
+    """
+    ``'SIGINT:10,SIGTERM:5,SIGKILL'`` ->
+    ``[(SIGINT, 10.0), (SIGTERM, 5.0), (SIGKILL, None)]``
+
+    A list of ``(name, timeout)`` pairs is accepted as well.
+    """
+    if not spec:
+        return None
+    if isinstance(spec, str):
+        spec = [p.strip().partition(':')[::2] for p in spec.split(',')]
+    sequence = []
+    for name, timeout in spec:
+        try:
+            timeout = float(timeout) if timeout not in ('', None) else None
+        except ValueError:
+            raise Exception('bad stop timeout: %r' % timeout)
+        sequence.append((get_signal(name), timeout))
+    return sequence
+
+
+class Stopper:
+    """
+    Sends the signals of a stop sequence using ``kill``, each one after the
+    timeout of the previous one elapsed, and measures how long every phase
+    took.
+    """
+
+    def __init__(self, sequence, kill, name=None):
+        self.sequence = sequence
+        self.kill = kill
+        self.prefix = '%s: ' % name if name else ''
+        self.phases = []
+        self.deadline = None
+
+    def next(self, now=None):
+        """Sends the next signal; returns ``False`` if there is none left."""
+        now = time.monotonic() if now is None else now
+        self.deadline = None
+        if len(self.phases) >= len(self.sequence):
+            return False
+        signum, timeout = self.sequence[len(self.phases)]
+        self.phases.append((signum, now))
+        if timeout is not None:
+            self.deadline = now + timeout
+        printerr('%ssending %s' % (self.prefix, signal.Signals(signum).name))
+        try:
+            self.kill(signum)
+        except ProcessLookupError:
+            pass
+        return True
+
+    def report(self, now=None):
+        """
+        Returns the ``(signal name, seconds)`` of the phases, the last one
+        ending ``now`` (when the process exited), and logs them.
+        """
+        now = time.monotonic() if now is None else now
+        ends = [started for _, started in self.phases[1:]] + [now]
+        phases = [
+            (signal.Signals(signum).name, round(end - started, 3))
+            for (signum, started), end in zip(self.phases, ends)
+        ]
+        printerr('%sstopped in %.3fs (%s)' % (
+            self.prefix, sum(s for _, s in phases),
+            ', '.join('%s: %.3fs' % p for p in phases)
+        ))
+        return phases
+
+
+# subprocess can switch user/group natively (without running Python code
+# between fork and exec) since Python 3.9
+NATIVE_SPAWN = sys.version_info >= (3, 9)
+MODES = ('spawn', 'preexec', 'exec')
+
+
+def child_setup(userspec=None, secrets=None, resources=None):
+    """
+    Returns the ``(uid, gid, groups, env, fds, profile)`` a child process
+    should run with, ``profile`` being the compiled ``resources`` or
+    ``None``. The caller must close ``fds`` once the child is started.
+    """
+    uid, username, homedir, gid, groups = get_userspec(userspec)
+    profile = None
+    if resources:
+        from .resources import compile_profile
+        profile = compile_profile(resources)
+
+    env = os.environ.copy()
+    if username is not None:
+        env['USER'] = username
+    if homedir is not None:
+        env['HOME'] = homedir
+    if uid is not None:
+        env['UID'] = str(uid)
+
+    fds = []
+    if secrets:
+        fds, secret_env = get_secret_fds(secrets, uid)
+        env.update(secret_env)
+    return uid, gid, groups, env, fds, profile
+
+
+def drop_privileges(uid, gid, groups, profile=None):
+    if profile:
+        from .resources import apply_profile
+        apply_profile(profile)
+    if groups is not None:
+        os.setgroups(groups)
+    if gid:
+        os.setgid(gid)
+    if uid:
+        os.setuid(uid)
+
+
+def spawn(
+    command, userspec=None, start_new_session=True, secrets=None,
+    mode='spawn', resources=None
+):
+    """
+    Starts ``command`` as the user/group given by ``userspec`` and returns
+    the ``subprocess.Popen`` object. ``secrets`` are passed in inherited
+    file descriptors (see ``get_secret_fds``), ``resources`` is a resource
+    profile (see ``gdockutils.resources.compile_profile``).
+
+    In ``spawn`` mode the user and groups are switched by ``subprocess``
+    itself where supported, otherwise (and in ``preexec`` mode, or when a
+    resource profile has to be applied) by a ``preexec_fn``.
+    """
+    uid, gid, groups, env, fds, profile = child_setup(
+        userspec, secrets, resources
+    )
+    kwargs = {}
+    if mode == 'spawn' and NATIVE_SPAWN and not profile:
+        if uid is not None:
+            kwargs['user'] = uid
+        if gid is not None:
+            kwargs['group'] = gid
+        if groups is not None:
+            kwargs['extra_groups'] = groups
+    else:
+        kwargs['preexec_fn'] = lambda: drop_privileges(
+            uid, gid, groups, profile
+        )
+
+    try:
+        return subprocess.Popen(
+            command, env=env, start_new_session=start_new_session,
+            pass_fds=fds, **kwargs
+        )
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def execute(
+    command, userspec=None, start_new_session=False, secrets=None,
+    resources=None
+):
+    """
+    Replaces the current process with ``command`` running as the user/group
+    given by ``userspec``. Does not return.
+    """
+    uid, gid, groups, env, fds, profile = child_setup(
+        userspec, secrets, resources
+    )
+    for fd in fds:
+        os.set_inheritable(fd, True)
+    if start_new_session:
+        os.setsid()
+    drop_privileges(uid, gid, groups, profile)
+    os.execvpe(command[0], command, env)
+
+
 def gprun(
     userspec=None, stopsignal=None, command=[],
-    sys_exit=True, start_new_session=True
+    sys_exit=True, start_new_session=True, secrets=None, mode='spawn',
+    resources=None, metrics=None, metrics_interval=None, job=None,
+    stop_sequence=None
 ):
     """
     Runs the specified command using different user/group. On SIGTERM and
@@ -81,6 +344,31 @@ def gprun(
     :param list command: the same as in ``subprocess.run()``.
     :param bool sys_exit: if set to ``False``, the system will not exit when
       the subprocess exits.
+    :param list secrets: secrets to pass to the subprocess as inherited
+      file descriptors instead of files on disk, in the form
+      ``NAME[:ENVVAR|:fd]`` (see ``get_secret_fds``).
+    :param str mode: ``spawn`` (the default) starts the subprocess without
+      running Python code between fork and exec where supported,
+      ``preexec`` always switches user/group in a ``preexec_fn``, ``exec``
+      replaces the current process with the command, leaving no wrapper
+      behind (no stop signal can be used then).
+    :param dict resources: resource settings applied to the subprocess
+      before it is started: ``cpus`` (``0-3,6``), ``nofile`` and
+      ``memlock`` (``soft[:hard]``), ``nice``, ``ionice`` (``idle``,
+      ``best-effort:7``) and ``oom_score_adj``.
+    :param str metrics: the file to write the wall time and the resource
+      usage of the subprocess to (see ``gdockutils.metrics.write``),
+      ``GDOCKUTILS_METRICS_FILE`` by default. Not used in exec mode.
+    :param float metrics_interval: if set, ``/proc/<pid>`` of the subprocess
+      is also sampled this often (``GDOCKUTILS_METRICS_INTERVAL``).
+    :param str job: the name of the job in the metrics (default: the name
+      of the command).
+    :param str stop_sequence: escalate on ``SIGTERM`` and ``SIGINT``:
+      ``SIGINT:10,SIGTERM:5,SIGKILL`` sends ``SIGINT``, then ``SIGTERM`` if
+      the process is still running after 10 seconds, then ``SIGKILL`` after
+      5 more seconds. The signals are sent to the process group if the
+      process runs in a new session. The duration of every phase is logged
+      and recorded in the metrics. Cannot be used with ``stopsignal``.
 
     Example::
 
@@ -88,42 +376,56 @@ def gprun(
 
         gprun(userspec='postgres', command=['initdb'], sys_exit=False)
     """
-    uid, username, homedir, gid, groups = get_userspec(userspec)
     if DEBUG:
         printerr('gprun params: {}, {}, {}'.format(
             userspec, stopsignal, start_new_session
         ))
+    if mode not in MODES:
+        raise Exception('bad mode: %r' % mode)
+    sig = get_signal(stopsignal)
+    sequence = parse_stop_sequence(stop_sequence)
+    if sig is not None and sequence:
+        raise Exception('stopsignal and stop_sequence cannot be used together')
+    if mode == 'exec':
+        if sig is not None or sequence:
+            raise Exception('a stop signal cannot be used in exec mode')
+        execute(command, userspec, start_new_session, secrets, resources)
+    metrics = METRICS_FILE if metrics is None else metrics
+    if metrics_interval is None:
+        metrics_interval = float(METRICS_INTERVAL or 0)
+    started = time.monotonic()
+    proc = spawn(
+        command, userspec, start_new_session, secrets, mode, resources
+    )
+    sampler = None
+    if metrics and metrics_interval:
+        sampler = Sampler(proc.pid, metrics_interval).start()
 
-    def preexec():
-        if groups is not None:
-            os.setgroups(groups)
-        if gid:
-            os.setgid(gid)
-        if uid:
-            os.setuid(uid)
+    def kill(signum):
+        if proc.returncode is not None:
+            return
+        if start_new_session:
+            os.killpg(proc.pid, signum)
+        else:
+            proc.send_signal(signum)
 
-    env = os.environ.copy()
-    if username is not None:
-        env['USER'] = username
-    if homedir is not None:
-        env['HOME'] = homedir
-    if uid is not None:
-        env['UID'] = str(uid)
+    stopper = Stopper(sequence, kill) if sequence else None
+    exited = threading.Event()
 
-    if stopsignal is not None:
-        try:
-            sig = getattr(signal, stopsignal)
-        except AttributeError:
-            raise Exception('bad signal: %r' % stopsignal)
-    else:
-        sig = None
+    def escalate():
+        while not exited.is_set() and stopper.next():
+            if stopper.deadline is None:
+                return
+            exited.wait(stopper.deadline - time.monotonic())
 
-    proc = subprocess.Popen(
-        command, preexec_fn=preexec, env=env,
-        start_new_session=start_new_session
-    )
+    escalation = threading.Thread(target=escalate, daemon=True)
 
     def handler(signum, frame):
+        if stopper:
+            # further signals do not restart the sequence
+            if escalation.ident is None:
+                escalation.start()
+            return
         to_send = sig if sig is not None else signum
         if DEBUG:
             printerr('sending signal to process: {}'.format(to_send))
@@ -132,6 +434,21 @@ def gprun(
     signal.signal(signal.SIGTERM, handler)
     signal.signal(signal.SIGINT, handler)
 
-    returncode = proc.wait()
+    returncode, rusage = wait(proc)
+    exited.set()
+    phases = None
+    if stopper and escalation.ident is not None:
+        escalation.join()
+        phases = stopper.report()
+    if metrics:
+        record = collect(
+            job or os.path.basename(command[0]), command, returncode,
+            time.monotonic() - started, rusage,
+            sampler.stop() if sampler else None
+        )
+        if phases:
+            record['stop_phases'] = phases
+            record['stop_seconds'] = round(sum(s for _, s in phases), 3)
+        write(record, metrics)
     if sys_exit:
         sys.exit(returncode)
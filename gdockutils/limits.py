@@ -0,0 +1,106 @@
+import math
+import os
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+# cgroup v1 reports no limit as a huge number rounded to the page size
+UNLIMITED = 1 << 60
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return None
+
+
+def _cgroup_dirs(controller, root=CGROUP_ROOT, proc='/proc/self/cgroup'):
+    """
+    Returns the directories that may hold the limits of the ``controller``
+    (``None`` for the unified v2 hierarchy) of the current process, the
+    most specific first. Inside a container with a private cgroup
+    namespace the path in ``/proc/self/cgroup`` is ``/`` anyway.
+    """
+    base = root if controller is None else os.path.join(root, controller)
+    dirs = []
+    for line in (_read(proc) or '').splitlines():
+        _, controllers, path = line.split(':', 2)
+        if controller is None and controllers == '' or (
+            controller in controllers.split(',')
+        ):
+            dirs.append(os.path.join(base, path.lstrip('/')))
+    dirs.append(base)
+    return dirs
+
+
+def memory_limit(root=CGROUP_ROOT, proc='/proc/self/cgroup'):
+    """
+    Returns the memory available to the container in bytes: the cgroup
+    (v2 or v1) memory limit or the physical memory, whichever is lower.
+    """
+    limits = [os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')]
+    for d in _cgroup_dirs(None, root, proc):
+        value = _read(os.path.join(d, 'memory.max'))
+        if value is not None:
+            if value != 'max':
+                limits.append(int(value))
+            break
+    else:
+        for d in _cgroup_dirs('memory', root, proc):
+            value = _read(os.path.join(d, 'memory.limit_in_bytes'))
+            if value is not None:
+                if int(value) < UNLIMITED:
+                    limits.append(int(value))
+                break
+    return min(limits)
+
+
+def cpu_limit(root=CGROUP_ROOT, proc='/proc/self/cgroup'):
+    """
+    Returns the number of CPUs available to the container (possibly
+    fractional): the cgroup (v2 or v1) CPU quota or the CPUs the process
+    may run on, whichever is lower.
+    """
+    limits = [len(os.sched_getaffinity(0))]
+    for d in _cgroup_dirs(None, root, proc):
+        value = _read(os.path.join(d, 'cpu.max'))
+        if value is not None:
+            quota, period = value.split()
+            if quota != 'max':
+                limits.append(int(quota) / int(period))
+            break
+    else:
+        for d in _cgroup_dirs('cpu', root, proc):
+            quota = _read(os.path.join(d, 'cpu.cfs_quota_us'))
+            period = _read(os.path.join(d, 'cpu.cfs_period_us'))
+            if quota is not None and period is not None:
+                if int(quota) > 0:
+                    limits.append(int(quota) / int(period))
+                break
+    return min(limits)
+
+
+def cpu_count(root=CGROUP_ROOT, proc='/proc/self/cgroup'):
+    """``cpu_limit`` rounded up to a whole number of CPUs."""
+    return max(1, math.ceil(cpu_limit(root, proc)))
+
+
+def rotational(path, sysfs='/sys'):
+    """
+    Returns whether ``path`` is stored on a rotational disk, according to
+    the block device holding it, or ``None`` if that cannot be told (for
+    example on overlay or network file systems).
+    """
+    dev = os.stat(path).st_dev
+    device = os.path.join(
+        sysfs, 'dev', 'block', '%d:%d' % (os.major(dev), os.minor(dev))
+    )
+    if not os.path.exists(device):
+        return None
+    device = os.path.realpath(device)
+    # partitions have no queue, their disk does
+    for d in (device, os.path.dirname(device)):
+        value = _read(os.path.join(d, 'queue', 'rotational'))
+        if value is not None:
+            return value == '1'
+    return None
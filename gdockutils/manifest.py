@@ -0,0 +1,75 @@
+import json
+import os
+
+from . import SECRET_CONF_FILE, SECRET_MANIFEST_CACHE_FILE, load_yaml
+from .materialize import write_atomic
+
+_cache = {}
+
+
+def _key(path):
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_mtime_ns, st.st_size]
+
+
+def compile_manifest(doc):
+    """
+    Turns the parsed ``secrets.yml`` (secret -> services) into a manifest
+    with both the ``secrets`` (secret -> services) and the inverted
+    ``services`` (service -> secrets) index.
+    """
+    secrets, services = {}, {}
+    for secret, _services in (doc or {}).items():
+        secrets[secret] = list(_services or [])
+        for service in secrets[secret]:
+            services.setdefault(service, []).append(secret)
+    return {'secrets': secrets, 'services': services}
+
+
+def _read_cache(cache_file, key):
+    try:
+        with open(cache_file, 'rb') as f:
+            st = os.fstat(f.fileno())
+            # only trust a cache file nobody else could have written
+            if st.st_uid not in (0, os.geteuid()) or st.st_mode & 0o022:
+                return None
+            cached = json.loads(f.read().decode())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get('key') != key:
+        return None
+    return cached
+
+
+def _write_cache(cache_file, manifest):
+    try:
+        write_atomic(
+            cache_file, json.dumps(manifest).encode(), mode=0o644
+        )
+    except OSError:
+        pass
+
+
+def load_manifest(path=None, cache_file=None):
+    """
+    Returns the compiled manifest of ``conf/secrets.yml``.
+
+    The manifest is cached in memory and in ``SECRET_MANIFEST_CACHE_FILE``
+    (as JSON), keyed on the path, mtime and size of the yaml file. The yaml
+    file is only parsed (with the C loader, if available) when the cache
+    is stale.
+    """
+    path = path or SECRET_CONF_FILE
+    cache_file = cache_file or SECRET_MANIFEST_CACHE_FILE
+    key = _key(path)
+    cached = _cache.get(path)
+    if cached is not None and cached['key'] == key:
+        return cached
+
+    manifest = _read_cache(cache_file, key)
+    if manifest is None:
+        manifest = compile_manifest(load_yaml(path))
+        manifest['key'] = key
+        _write_cache(cache_file, manifest)
+    _cache[path] = manifest
+    return manifest
@@ -0,0 +1,99 @@
+import os
+import stat as _stat
+import tempfile
+from hashlib import sha256
+
+
+def state_digest(content, uid, gid, mode):
+    """
+    Returns a digest of the complete state of a secret file: its content,
+    owner, group and permission bits.
+    """
+    h = sha256()
+    h.update(('%d:%d:%o\0' % (uid, gid, mode)).encode())
+    h.update(content)
+    return h.hexdigest()
+
+
+def disk_digest(fn, size=None):
+    """
+    Returns the ``state_digest`` of the regular file ``fn`` or ``None`` if it
+    does not exist (or is not a regular file). If ``size`` is given and the
+    file has a different size, ``''`` is returned without reading the file.
+    """
+    try:
+        st = os.lstat(fn)
+    except FileNotFoundError:
+        return None
+    if not _stat.S_ISREG(st.st_mode):
+        return None
+    if size is not None and st.st_size != size:
+        return ''
+    with open(fn, 'rb') as f:
+        content = f.read()
+    return state_digest(
+        content, st.st_uid, st.st_gid, _stat.S_IMODE(st.st_mode)
+    )
+
+
+def write_atomic(fn, content, uid=None, gid=None, mode=0o600, fsync=False):
+    """
+    Writes ``content`` to ``fn`` through a temporary file in the same
+    directory. Owner and mode are set on the temporary file, so readers see
+    either the old or the new file, never a partially written one.
+    """
+    d, name = os.path.split(fn)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, dir=d or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+            f.flush()
+            if uid is not None or gid is not None:
+                os.fchown(
+                    f.fileno(),
+                    -1 if uid is None else uid, -1 if gid is None else gid
+                )
+            os.fchmod(f.fileno(), mode)
+            if fsync:
+                os.fsync(f.fileno())
+        os.rename(tmp, fn)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def materialize(desired, directory, managed=()):
+    """
+    Brings ``directory`` to the desired state.
+
+    :param dict desired: maps file names to ``(content, uid, gid, mode)``
+      tuples.
+    :param str directory: the directory to write into.
+    :param managed: names that may be deleted from ``directory`` if they
+      are not in ``desired``. Other files are never touched.
+
+    Only the files whose content, owner or mode differ are rewritten. Returns
+    a dict with the sorted lists of ``written``, ``unchanged`` and
+    ``removed`` names.
+    """
+    os.makedirs(directory, exist_ok=True)
+    ret = {'written': [], 'unchanged': [], 'removed': []}
+    for name, (content, uid, gid, mode) in sorted(desired.items()):
+        fn = os.path.join(directory, name)
+        want = state_digest(content, uid, gid, mode)
+        if disk_digest(fn, size=len(content)) == want:
+            ret['unchanged'].append(name)
+            continue
+        write_atomic(fn, content, uid, gid, mode)
+        ret['written'].append(name)
+
+    for name in sorted(set(managed) - set(desired)):
+        try:
+            os.unlink(os.path.join(directory, name))
+        except FileNotFoundError:
+            continue
+        ret['removed'].append(name)
+    return ret
@@ -0,0 +1,209 @@
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+
+from . import METRICS_FILE, printerr
+
+# (key, prometheus help) of the values written for every job
+METRICS = [
+    ('exit_code', 'The exit code of the last run.'),
+    ('wall_seconds', 'Wall clock time of the last run.'),
+    ('user_seconds', 'User CPU time of the last run.'),
+    ('system_seconds', 'System CPU time of the last run.'),
+    ('max_rss_bytes', 'Peak resident set size of the last run.'),
+    ('minor_faults', 'Minor page faults of the last run.'),
+    ('major_faults', 'Major page faults of the last run.'),
+    ('block_input_ops', 'Filesystem input operations of the last run.'),
+    ('block_output_ops', 'Filesystem output operations of the last run.'),
+    ('voluntary_ctx_switches', 'Voluntary context switches of the last run.'),
+    (
+        'involuntary_ctx_switches',
+        'Involuntary context switches of the last run.'
+    ),
+    ('sampled_rss_peak_bytes', 'Peak RSS seen by the /proc sampler.'),
+    ('sampled_threads_peak', 'Peak thread count seen by the /proc sampler.'),
+    ('read_bytes', 'Bytes read from storage (from /proc/<pid>/io).'),
+    ('write_bytes', 'Bytes written to storage (from /proc/<pid>/io).'),
+    ('stop_seconds', 'Time from the first stop signal to the exit.'),
+    ('last_run_timestamp_seconds', 'The time the last run finished.'),
+]
+PROM_LINE = re.compile(r'^(gdockutils_job_\w+)\{job="((?:[^"\\]|\\.)*)"\} ')
+
+
+def exitcode(status):
+    """Converts a wait status to a ``Popen.returncode`` style exit code."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def wait(proc):
+    """
+    Waits for a ``subprocess.Popen`` process with ``os.wait4`` and returns
+    its exit code and resource usage.
+    """
+    _, status, rusage = os.wait4(proc.pid, 0)
+    # the process was reaped by us, Popen must not wait for it
+    proc.returncode = exitcode(status)
+    return proc.returncode, rusage
+
+
+class Sampler:
+    """
+    Samples ``/proc/<pid>`` every ``interval`` seconds in a thread, to
+    record what ``rusage`` does not tell: the I/O done and the thread count.
+    """
+
+    def __init__(self, pid, interval):
+        self.pid = pid
+        self.interval = interval
+        self.values = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stops the sampler; must be called right after the process exits."""
+        self.stopped.set()
+        self.thread.join()
+        return self.values
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sample()
+            except OSError:
+                # the process is gone (or /proc is not readable)
+                return
+            self.stopped.wait(self.interval)
+
+    def sample(self):
+        values = self.values
+        with open('/proc/%d/status' % self.pid) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key == 'VmRSS':
+                    rss = int(value.split()[0]) * 1024
+                    values['sampled_rss_peak_bytes'] = max(
+                        rss, values.get('sampled_rss_peak_bytes', 0)
+                    )
+                elif key == 'Threads':
+                    values['sampled_threads_peak'] = max(
+                        int(value), values.get('sampled_threads_peak', 0)
+                    )
+        try:
+            with open('/proc/%d/io' % self.pid) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in ('read_bytes', 'write_bytes'):
+                        values[key] = int(value)
+        except PermissionError:
+            pass
+
+
+def collect(job, command, returncode, wall, rusage, sampled=None):
+    """Returns the record of a finished job."""
+    record = {
+        'job': job,
+        'command': list(command),
+        'exit_code': returncode,
+        'wall_seconds': round(wall, 6),
+        'user_seconds': rusage.ru_utime,
+        'system_seconds': rusage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux
+        'max_rss_bytes': rusage.ru_maxrss * 1024,
+        'minor_faults': rusage.ru_minflt,
+        'major_faults': rusage.ru_majflt,
+        'block_input_ops': rusage.ru_inblock,
+        'block_output_ops': rusage.ru_oublock,
+        'voluntary_ctx_switches': rusage.ru_nvcsw,
+        'involuntary_ctx_switches': rusage.ru_nivcsw,
+        'last_run_timestamp_seconds': round(time.time(), 3),
+    }
+    record.update(sampled or {})
+    return record
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n'
+    )
+
+
+def prometheus(records):
+    """
+    Renders the records (the last one of every job) in the Prometheus text
+    exposition format.
+    """
+    lines = []
+    for key, help in METRICS:
+        samples = [
+            (r['job'], r[key]) for r in records if r.get(key) is not None
+        ]
+        if not samples:
+            continue
+        name = 'gdockutils_job_%s' % key
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s gauge' % name)
+        for job, value in samples:
+            lines.append('%s{job="%s"} %s' % (name, _escape(job), value))
+    return '\n'.join(lines) + '\n'
+
+
+def _read_prometheus(f):
+    records = {}
+    for line in f.read().splitlines():
+        m = PROM_LINE.match(line)
+        if not m:
+            continue
+        job = re.sub(r'\\(.)', lambda m: {'n': '\n'}.get(m[1], m[1]), m[2])
+        record = records.setdefault(job, {'job': job})
+        record[m[1][len('gdockutils_job_'):]] = line[m.end():]
+    return records
+
+
+def write(record, path=None):
+    """
+    Writes a job record to ``path`` (``GDOCKUTILS_METRICS_FILE`` by
+    default). Files ending with ``.prom`` are Prometheus textfiles (for the
+    node exporter textfile collector) holding the last run of every job,
+    any other file gets one JSON object appended per run.
+
+    Errors are reported, but never fail the job.
+    """
+    from .materialize import write_atomic
+
+    path = path or METRICS_FILE
+    if not path:
+        return
+    try:
+        if not path.endswith('.prom'):
+            line = json.dumps(record, sort_keys=True) + '\n'
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+            return
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(path) as f:
+                    records = _read_prometheus(f)
+            except FileNotFoundError:
+                records = {}
+            records[record['job']] = record
+            write_atomic(
+                path,
+                prometheus(sorted(records.values(), key=lambda r: r['job']))
+                .encode(),
+                mode=0o644
+            )
+    except OSError as e:
+        printerr('could not write metrics to %s: %s' % (path, e))
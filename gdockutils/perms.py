@@ -0,0 +1,183 @@
+import os
+import stat as _stat
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from . import printerr, DEBUG
+
+# written into a tree once its ownership is known to be right
+OWNER_MARKER = '.gdockutils-owner'
+
+
+class Rules:
+    """
+    The desired state of a tree for ``normalize``. ``None`` means "do not
+    care".
+
+    :param int uid: the owner of every entry.
+    :param int gid: the group of every entry.
+    :param int dir_mode: the permission bits of the directories.
+    :param int file_mode: the permission bits of the regular files.
+    :param int root_mode: the permission bits of the top directory
+      (default: ``dir_mode``).
+    """
+
+    def __init__(
+        self, uid=None, gid=None, dir_mode=None, file_mode=None,
+        root_mode=None
+    ):
+        self.uid = -1 if uid is None else uid
+        self.gid = -1 if gid is None else gid
+        self.dir_mode = dir_mode
+        self.file_mode = file_mode
+        self.root_mode = dir_mode if root_mode is None else root_mode
+
+
+class Stats:
+    def __init__(self, scanned=0, changed=0, seconds=0.0):
+        self.scanned = scanned
+        self.changed = changed
+        self.seconds = seconds
+
+    def __str__(self):
+        return '%d scanned, %d changed in %.2fs' % (
+            self.scanned, self.changed, self.seconds
+        )
+
+
+def _scan(directory, visit):
+    """
+    Visits the entries of ``directory``. Returns the subdirectories to
+    descend into and the number of entries scanned and changed.
+    """
+    subdirs = []
+    scanned = changed = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            st = entry.stat(follow_symlinks=False)
+            scanned += 1
+            if visit(entry.path, st):
+                changed += 1
+            if _stat.S_ISDIR(st.st_mode):
+                subdirs.append(entry.path)
+    return subdirs, scanned, changed
+
+
+def walk(path, visit, jobs=None):
+    """
+    Calls ``visit(path, stat_result)`` for ``path`` and every entry under
+    it, without following symbolic links (``path`` itself may be one).
+    ``visit`` returns ``True`` if it changed the entry.
+
+    Directories are scanned by a pool of ``jobs`` threads (``1`` scans in
+    the calling thread), every subdirectory being a separate task. Returns
+    the number of entries scanned and changed.
+    """
+    scanned = 1
+    changed = 1 if visit(path, os.stat(path)) else 0
+    if jobs == 1:
+        pending = [path]
+        while pending:
+            subdirs, s, c = _scan(pending.pop(), visit)
+            pending.extend(subdirs)
+            scanned += s
+            changed += c
+        return scanned, changed
+
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = {executor.submit(_scan, path, visit)}
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, s, c = future.result()
+                scanned += s
+                changed += c
+                futures.update(
+                    executor.submit(_scan, d, visit) for d in subdirs
+                )
+    return scanned, changed
+
+
+def normalize(path, rules, jobs=None):
+    """
+    Brings the owner and the permission bits of ``path`` and everything
+    under it to the state described by ``rules`` (a ``Rules`` instance).
+    Only the entries that differ are changed, everything else costs a
+    single ``lstat``. Symbolic links are chowned, not followed.
+
+    Returns a ``Stats`` instance.
+
+    Example::
+
+        from gdockutils.perms import Rules, normalize
+
+        print(normalize('/data/files', Rules(1000, 101, 0o2750, 0o640)))
+    """
+    start = time.monotonic()
+    uid, gid = rules.uid, rules.gid
+
+    def visit(p, st):
+        changed = False
+        if uid not in (-1, st.st_uid) or gid not in (-1, st.st_gid):
+            os.chown(p, uid, gid, follow_symlinks=p == path)
+            changed = True
+        if p == path:
+            mode = rules.root_mode
+        elif _stat.S_ISDIR(st.st_mode):
+            mode = rules.dir_mode
+        elif _stat.S_ISREG(st.st_mode):
+            mode = rules.file_mode
+        else:
+            return changed
+        # chown clears the setuid/setgid bits of regular files
+        if mode is not None and (
+            _stat.S_IMODE(st.st_mode) != mode or changed and mode & 0o6000
+        ):
+            os.chmod(p, mode)
+            changed = True
+        return changed
+
+    scanned, changed = walk(path, visit, jobs)
+    return Stats(scanned, changed, time.monotonic() - start)
+
+
+def _marker_ok(path, uid, gid):
+    try:
+        st = os.stat(path)
+        with open(os.path.join(path, OWNER_MARKER)) as f:
+            content = f.read().strip()
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    return (st.st_uid, st.st_gid) == (uid, gid) and (
+        content == '%d:%d' % (uid, gid)
+    )
+
+
+def chown_tree(path, uid, gid, jobs=None, marker=False):
+    """
+    Makes ``uid:gid`` the owner of ``path`` and everything under it (see
+    ``normalize``).
+
+    :param int jobs: the number of threads scanning the directories.
+    :param bool marker: if set, a marker file is written into ``path``
+      after it was fixed and the whole walk is skipped next time, if the
+      marker and the owner of ``path`` still match. Changes made below
+      ``path`` by others are not noticed then.
+
+    Returns the number of entries changed.
+    """
+    if marker and _marker_ok(path, uid, gid):
+        if DEBUG:
+            printerr('%s: ownership marker found' % path)
+        return 0
+
+    stats = normalize(path, Rules(uid, gid), jobs)
+    if DEBUG:
+        printerr('%s: %s' % (path, stats))
+    if marker:
+        from .materialize import write_atomic
+        write_atomic(
+            os.path.join(path, OWNER_MARKER),
+            ('%d:%d\n' % (uid, gid)).encode(), uid, gid, 0o600
+        )
+    return stats.changed
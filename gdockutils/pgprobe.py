@@ -0,0 +1,152 @@
+import os
+import random
+import socket
+import struct
+import time
+
+from . import printerr, DEBUG
+
+SSL_REQUEST = struct.pack('!ii', 8, 80877103)
+PROTOCOL_VERSION = 3 << 16
+# the server is starting up, shutting down or in recovery
+CANNOT_CONNECT_NOW = '57P03'
+
+READY = 'ready'
+STARTING = 'starting'
+UNAVAILABLE = 'unavailable'
+
+
+def _recv_exact(sock, n):
+    buf = b''
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError('connection closed by the server')
+        buf += chunk
+    return buf
+
+
+def _ssl_context(sslrootcert):
+    import ssl
+
+    context = ssl.create_default_context()
+    # like sslmode=verify-ca: the certificate is checked, the host name is not
+    context.check_hostname = False
+    if sslrootcert and os.path.isfile(sslrootcert):
+        context.load_verify_locations(sslrootcert)
+    else:
+        # nothing is sent that a server could misuse, so the probe works
+        # without the CA certificate too
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def probe(
+    host, port=5432, user='postgres', database='postgres', timeout=2.0,
+    sslrootcert=None
+):
+    """
+    Checks whether the server accepts connections, the way ``pg_isready``
+    does: sends an ``SSLRequest`` (switching to TLS if the server supports
+    it) and a startup packet, and looks at the first message of the
+    server. Nothing is authenticated.
+
+    Returns ``READY`` if the server asked for authentication (or refused
+    the connection for any other reason than being unavailable),
+    ``STARTING`` if it answered with ``57P03`` (starting up, shutting down
+    or in recovery), ``UNAVAILABLE`` if it could not be reached.
+    """
+    try:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    except OSError as e:
+        if DEBUG:
+            printerr('probe: %s' % e)
+        return UNAVAILABLE
+    try:
+        sock.sendall(SSL_REQUEST)
+        answer = _recv_exact(sock, 1)
+        if answer == b'S':
+            sock = _ssl_context(sslrootcert).wrap_socket(
+                sock, server_hostname=host
+            )
+        elif answer != b'N':
+            return UNAVAILABLE
+
+        params = b''.join(
+            k.encode() + b'\0' + v.encode() + b'\0'
+            for k, v in (('user', user), ('database', database))
+        ) + b'\0'
+        sock.sendall(
+            struct.pack('!ii', 8 + len(params), PROTOCOL_VERSION) + params
+        )
+        msgtype, length = struct.unpack('!ci', _recv_exact(sock, 5))
+        if msgtype == b'R':
+            return READY
+        if msgtype != b'E':
+            return UNAVAILABLE
+        # ErrorResponse: (field type, null terminated value) pairs
+        fields = _recv_exact(sock, length - 4).split(b'\0')
+        code = dict((f[:1], f[1:]) for f in fields if f).get(b'C', b'')
+        if DEBUG:
+            printerr('probe: server error %s' % code.decode())
+        return STARTING if code.decode() == CANNOT_CONNECT_NOW else READY
+    except (OSError, struct.error) as e:
+        if DEBUG:
+            printerr('probe: %s' % e)
+        return UNAVAILABLE
+    finally:
+        sock.close()
+
+
+def wait(
+    host, port=5432, user='postgres', database='postgres', check=None,
+    timeout=None, initial_delay=0.05, max_delay=2.0, sslrootcert=None
+):
+    """
+    Waits until the server accepts connections and ``check`` (an
+    authenticated query, for example) succeeds.
+
+    The server is probed with ``probe``; ``check`` is only called once the
+    probe succeeded. The delay between the attempts grows exponentially from
+    ``initial_delay`` up to ``max_delay``, with random jitter. Returns the
+    seconds it took for the server to become ready, raises an ``Exception``
+    if that did not happen in ``timeout`` seconds.
+
+    Example::
+
+        from gdockutils.pgprobe import wait
+
+        wait('postgres', user='django', database='django', timeout=60)
+    """
+    start = time.monotonic()
+    attempt = 0
+    last = None
+    while True:
+        status = probe(
+            host, port, user, database, timeout=max_delay,
+            sslrootcert=sslrootcert
+        )
+        if status == READY and check is not None:
+            try:
+                check()
+            except Exception as e:
+                status = 'check failed: %s' % e
+        if status == READY:
+            elapsed = time.monotonic() - start
+            printerr('db ready in %.2fs' % elapsed)
+            return elapsed
+        if status != last:
+            printerr('db not ready yet (%s)' % status)
+            last = status
+
+        delay = min(max_delay, initial_delay * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+        attempt += 1
+        if timeout is not None:
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                raise Exception(
+                    'db not ready in %ss (%s)' % (timeout, status)
+                )
+            delay = min(delay, remaining)
+        time.sleep(delay)
@@ -1,31 +1,142 @@
 #!/usr/bin/env python3
 
+import fcntl
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
-import yaml
+from .secret import readsecrets
+from .materialize import materialize, write_atomic
+from .manifest import load_manifest
+from . import SECRET_DIR, parseuidgid
 
-from .secret import readsecret
-from . import SECRET_CONF_FILE, SECRET_DIR, parseuidgid
+# the secrets each service got last time in the shared SECRET_DIR
+CLAIMS_FILE = '.gdockutils-services.json'
 
 
 def defined_secrets():
-    with open(SECRET_CONF_FILE, 'r') as f:
-        doc = yaml.load(f)
-    return sorted(doc)
+    return sorted(load_manifest()['secrets'])
+
+
+def _read_claims():
+    try:
+        with open(os.path.join(SECRET_DIR, CLAIMS_FILE)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
 
 
 def prepare(service, wait=False, user=None):
-    user = user or service
-    u, g = parseuidgid(user)
-    os.makedirs(SECRET_DIR, exist_ok=True)
-    with open(SECRET_CONF_FILE, 'r') as f:
-        doc = yaml.load(f)
-    for secret, _services in doc.items():
-        if _services and service in _services:
-            readsecret(
-                secret,
-                store=':'.join([secret, str(u), str(g), '400']),
-                secret_dir=SECRET_DIR
+    prepare_services(
+        [service], wait=wait, user_map={service: user} if user else None
+    )
+
+
+def prepare_services(
+    services, wait=False, user_map=None, user=None, split=False, jobs=None
+):
+    """
+    Mounts the secrets of several services (as files) at once, parsing
+    ``conf/secrets.yml`` and the secret database only once.
+
+    :param list services: the services to prepare.
+    :param dict user_map: maps service names to userspecs
+      (``(uid|username)[:(gid|groupname)]``) owning their secrets.
+    :param str user: the userspec of the services missing from
+      ``user_map``. Defaults to the name of the service.
+    :param bool split: put the secrets of each service into its own
+      ``SECRET_DIR/<service>`` directory instead of ``SECRET_DIR``.
+    :param int jobs: the number of threads used to write the directories.
+
+    In the shared ``SECRET_DIR``, a secret needed by services with
+    different owners is an error. The secrets each service got are recorded
+    there, so that a secret is only removed once no service prepared into
+    it needs it anymore; preparing one service never removes the secrets
+    of another; concurrent runs are serialized with an ``fcntl`` lock on
+    ``SECRET_DIR/.gdockutils-services.json.lock``. A ``SECRET_DIR/<service>``
+    directory belongs to its service alone.
+
+    Example::
+
+        from gdockutils.prepare import prepare_services
+
+        prepare_services(['django', 'nginx'], user_map={'nginx': '0:4430'})
+    """
+    user_map = user_map or {}
+    manifest = load_manifest()
+    assigned = dict(
+        (service, manifest['services'].get(service, []))
+        for service in services
+    )
+    values = readsecrets(
+        sorted(set(s for secrets in assigned.values() for s in secrets))
+    )
+
+    targets = []
+    shared = {}
+    for service in services:
+        u, g = parseuidgid(user_map.get(service) or user or service)
+        desired = {}
+        for secret in assigned[service]:
+            desired[secret] = (values[secret], u, g, 0o400)
+            if split:
+                continue
+            if secret in shared and shared[secret][1:3] != (u, g):
+                raise Exception(
+                    'Secret %s is needed by services with different owners.'
+                    % secret
+                )
+            shared[secret] = desired[secret]
+        if split:
+            targets.append((desired, os.path.join(SECRET_DIR, service)))
+    if not split:
+        targets.append((shared, SECRET_DIR))
+
+    claims = {}
+    managed = {}
+
+    def _materialize(target):
+        return materialize(target[0], target[1], managed=managed[target[1]])
+
+    with ExitStack() as stack:
+        if split:
+            # secrets defined for other services only are removed
+            for desired, directory in targets:
+                managed[directory] = manifest['secrets']
+        else:
+            # held until the claims are written back
+            os.makedirs(SECRET_DIR, exist_ok=True)
+            lock = stack.enter_context(
+                open(os.path.join(SECRET_DIR, CLAIMS_FILE + '.lock'), 'a')
+            )
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            claims = _read_claims()
+            others = set(
+                secret
+                for service, secrets in claims.items()
+                if service not in services
+                for secret in secrets
+            )
+            previous = set(
+                secret
+                for service in services for secret in claims.get(service, [])
+            )
+            managed[SECRET_DIR] = previous - others
+            claims.update(
+                (service, sorted(assigned[service])) for service in services
+            )
+
+        if jobs and jobs > 1 and len(targets) > 1:
+            with ThreadPoolExecutor(jobs) as executor:
+                list(executor.map(_materialize, targets))
+        else:
+            for target in targets:
+                _materialize(target)
+        if not split:
+            write_atomic(
+                os.path.join(SECRET_DIR, CLAIMS_FILE),
+                json.dumps(claims, indent=2, sort_keys=True).encode()
             )
     if wait:
         from .db import wait_for_db
@@ -0,0 +1,138 @@
+import os
+import platform
+import resource
+
+from . import RESOURCE_CONF_FILE, load_yaml
+
+# ioprio_set has no wrapper in the os module
+IOPRIO_SET = {
+    'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314,
+    'ppc64le': 273, 's390x': 282,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IONICE_CLASSES = {
+    'none': 0, 'realtime': 1, 'rt': 1, 'best-effort': 2, 'be': 2, 'idle': 3,
+}
+SIZE_SUFFIXES = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+KEYS = ('cpus', 'nofile', 'memlock', 'nice', 'ionice', 'oom_score_adj')
+
+
+def parse_cpus(spec):
+    """``'0-3,6'`` -> ``{0, 1, 2, 3, 6}``"""
+    cpus = set()
+    for part in str(spec).split(','):
+        first, sep, last = part.strip().partition('-')
+        try:
+            if sep:
+                cpus.update(range(int(first), int(last) + 1))
+            else:
+                cpus.add(int(first))
+        except ValueError:
+            raise Exception('bad cpu list: %r' % spec)
+    return cpus
+
+
+def parse_size(spec):
+    spec = str(spec).strip().lower()
+    if spec == 'unlimited':
+        return resource.RLIM_INFINITY
+    mul = SIZE_SUFFIXES.get(spec[-1:], 1)
+    try:
+        return int(spec[:-1] if mul != 1 else spec) * mul
+    except ValueError:
+        raise Exception('bad limit: %r' % spec)
+
+
+def parse_limit(spec):
+    """``'1024'``, ``'1024:4096'`` or ``'unlimited'`` -> ``(soft, hard)``"""
+    soft, sep, hard = str(spec).partition(':')
+    soft = parse_size(soft)
+    return soft, parse_size(hard) if sep else soft
+
+
+def parse_ionice(spec):
+    """``'idle'``, ``'best-effort:7'`` or ``'realtime:0'`` -> ioprio"""
+    cls, sep, level = str(spec).partition(':')
+    try:
+        cls = IONICE_CLASSES[cls]
+        level = int(level) if sep else (4 if cls in (1, 2) else 0)
+    except (KeyError, ValueError):
+        raise Exception('bad ionice: %r' % spec)
+    return (cls << IOPRIO_CLASS_SHIFT) | level
+
+
+def load_profile(name, path=None):
+    """
+    Loads a profile from the ``profiles`` section of
+    ``conf/resources.yml``::
+
+        profiles:
+          postgres:
+            cpus: 0-3
+            nofile: 65536
+            oom_score_adj: -500
+          batch:
+            nice: 10
+            ionice: idle
+    """
+    doc = load_yaml(path or RESOURCE_CONF_FILE) or {}
+    try:
+        return dict((doc.get('profiles') or {})[name] or {})
+    except KeyError:
+        raise Exception('resource profile %r does not exist' % name)
+
+
+def compile_profile(profile):
+    """
+    Validates a profile (a dict with the keys ``cpus``, ``nofile``,
+    ``memlock``, ``nice``, ``ionice`` and ``oom_score_adj``) and converts it
+    to the values ``apply_profile`` needs, so nothing has to be parsed in
+    the child process.
+    """
+    unknown = set(profile) - set(KEYS)
+    if unknown:
+        raise Exception('unknown resource setting: %s' % ', '.join(unknown))
+    ret = {}
+    if profile.get('cpus') is not None:
+        ret['cpus'] = parse_cpus(profile['cpus'])
+    for key in ('nofile', 'memlock'):
+        if profile.get(key) is not None:
+            ret[key] = parse_limit(profile[key])
+    for key in ('nice', 'oom_score_adj'):
+        if profile.get(key) is not None:
+            ret[key] = int(profile[key])
+    if profile.get('ionice') is not None:
+        try:
+            nr = IOPRIO_SET[platform.machine()]
+        except KeyError:
+            raise Exception('ionice is not supported on this platform')
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        ret['ionice'] = (libc, nr, parse_ionice(profile['ionice']))
+    return ret
+
+
+def apply_profile(compiled):
+    """
+    Applies a compiled profile to the current process. Called in the child
+    before the privileges are dropped, so limits can be raised and the
+    priority can be increased.
+    """
+    if 'oom_score_adj' in compiled:
+        with open('/proc/self/oom_score_adj', 'w') as f:
+            f.write(str(compiled['oom_score_adj']))
+    if 'nofile' in compiled:
+        resource.setrlimit(resource.RLIMIT_NOFILE, compiled['nofile'])
+    if 'memlock' in compiled:
+        resource.setrlimit(resource.RLIMIT_MEMLOCK, compiled['memlock'])
+    if 'cpus' in compiled:
+        os.sched_setaffinity(0, compiled['cpus'])
+    if 'nice' in compiled:
+        os.setpriority(os.PRIO_PROCESS, 0, compiled['nice'])
+    if 'ionice' in compiled:
+        libc, nr, ioprio = compiled['ionice']
+        if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+            import ctypes
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
@@ -1,19 +1,125 @@
 import os
 import base64
-import random as rnd
+import contextlib
+import fcntl
+import stat as _stat
 import string
 
 from . import (
     SecretAlreadyExists, SecretDatabaseNotFound, SecretDoesNotExist,
     uid, gid, SECRET_DATABASE_FILE
 )
+from .materialize import write_atomic
+from . import secretd
+
+DEFAULT_CHARSET = string.ascii_letters + string.digits + string.punctuation
+
+
+class SecretStore:
+    """
+    Parsed, cached view of a secret database file.
+
+    The file is parsed once into a dict and kept in memory. Every access
+    compares the file's inode, size and mtime with the cached ones and only
+    parses again when the file was replaced or modified.
+
+    Example::
+
+        from gdockutils.secret import SecretStore
+
+        store = SecretStore('.secret.env')
+        store.get_many(['DB_PASSWORD_DJANGO', 'DB_PASSWORD_POSTGRES'])
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._key = None
+        self._secrets = {}
+
+    def _stat_key(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            raise SecretDatabaseNotFound(
+                'Secret database %s does not exist.' % self.path
+            )
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _parse(self, lines):
+        secrets = {}
+        for line in lines:
+            line = line.strip()
+            if not line or '=' not in line:
+                continue
+            k, v = line.split('=', 1)
+            secrets[k] = v
+        return secrets
+
+    def _load(self):
+        key = self._stat_key()
+        if key == self._key:
+            return self._secrets
+        with open(self.path, 'r') as db:
+            self._secrets = self._parse(db)
+        self._key = key
+        return self._secrets
+
+    def invalidate(self):
+        self._key = None
+        self._secrets = {}
+
+    def encoded(self):
+        """Returns a copy of the raw (base64 encoded) name-value mapping."""
+        return dict(self._load())
+
+    def names(self):
+        return sorted(self._load())
+
+    def __contains__(self, secret):
+        return secret in self._load()
+
+    def get(self, secret):
+        try:
+            v = self._load()[secret]
+        except KeyError:
+            raise SecretDoesNotExist('Secret %s not found.' % secret)
+        return base64.b64decode(v)
+
+    def get_many(self, secrets):
+        """
+        Returns a dict of the decoded values of the given secrets. Raises
+        ``SecretDoesNotExist`` for the first missing one.
+        """
+        db = self._load()
+        ret = {}
+        for secret in secrets:
+            try:
+                ret[secret] = base64.b64decode(db[secret])
+            except KeyError:
+                raise SecretDoesNotExist('Secret %s not found.' % secret)
+        return ret
+
+    def items(self):
+        return [
+            (k, base64.b64decode(v)) for k, v in sorted(self._load().items())
+        ]
+
+
+_stores = {}
+
+
+def get_store(path=None):
+    """Returns the shared ``SecretStore`` of the given (or default) file."""
+    path = path or SECRET_DATABASE_FILE
+    try:
+        return _stores[path]
+    except KeyError:
+        store = _stores[path] = SecretStore(path)
+        return store
 
 
 def existing():
-    with open(SECRET_DATABASE_FILE, 'r') as db:
-        secretlines = db.readlines()
-    secrets = [l.split('=', 1) for l in secretlines if l]
-    return sorted(dict([(k, v.strip()) for [k, v] in secrets]))
+    return get_store().names()
 
 
 def readpart(lst, idx, default=None):
@@ -30,64 +136,145 @@ def readpart(lst, idx, default=None):
     return ret
 
 
-def createsecret(
-        secret, fromfile=None,
-        random=None, value=None, force=None,
-):
-    try:
-        readsecret(secret)
-    except SecretDoesNotExist:
-        pass
-    else:
-        if not force:
-            raise SecretAlreadyExists('Secret %s already exists.' % secret)
+@contextlib.contextmanager
+def transaction(path=None):
+    """
+    Locked read-modify-write of the secret database.
+
+    Yields the (base64 encoded) contents of the database as a dict. When the
+    block exits without an exception and the dict was changed, the database
+    is written to a temporary file, fsynced and renamed over the original,
+    keeping its owner and mode. Concurrent transactions are serialized with
+    an ``fcntl`` lock on ``<path>.lock``.
+
+    Example::
 
-    with open(SECRET_DATABASE_FILE, 'r') as db:
-        secretlines = db.readlines()
-    secrets = [l.split('=', 1) for l in secretlines if l]
-    secrets = dict([(k, v.strip()) for [k, v] in secrets])
+        from gdockutils.secret import transaction
 
+        with transaction() as secrets:
+            secrets.pop('OLD_SECRET', None)
+    """
+    path = path or SECRET_DATABASE_FILE
+    store = get_store(path)
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        store.invalidate()
+        secrets = store.encoded()
+        orig = dict(secrets)
+        yield secrets
+        if secrets == orig:
+            return
+        content = ''.join('%s=%s\n' % (k, v) for k, v in secrets.items())
+        st = os.stat(path)
+        write_atomic(
+            path, content.encode(),
+            st.st_uid, st.st_gid, _stat.S_IMODE(st.st_mode), fsync=True
+        )
+        dirfd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+        store.invalidate()
+
+
+def secretvalue(fromfile=None, random=None, value=None):
     if fromfile is not None:
         with open(fromfile, 'rb') as f:
-            val = f.read()
+            return f.read()
     elif value is not None:
-        val = value.encode()
+        return value.encode()
     elif random is not None:
-        val = ''.join(
-            rnd.choice(
-                string.ascii_letters + string.digits + string.punctuation
-            ) for _ in range(random)
-        ).encode()
+        return randomstrings(1, random)[0].encode()
+    raise Exception('No value given.')
+
 
-    secrets[secret] = base64.b64encode(val).decode()
+def randomstrings(count, length, charset=None):
+    """
+    Returns ``count`` random strings of ``length`` characters taken from
+    ``charset`` (ascii letters, digits and punctuation by default).
 
-    with open(SECRET_DATABASE_FILE, 'w') as f:
-        for k, v in secrets.items():
-            f.write('%s=%s\n' % (k, v))
+    All the strings are cut from ``os.urandom`` buffers. Bytes that would
+    make some characters more likely than others are dropped, the rest are
+    mapped to the charset with a translation table.
+    """
+    charset = charset or DEFAULT_CHARSET
+    n = len(charset)
+    if not 0 < n <= 256:
+        raise Exception('The charset must have 1-256 characters.')
+    try:
+        table = bytes(ord(charset[i % n]) for i in range(256))
+    except ValueError:
+        raise Exception('The charset must contain ascii characters only.')
+    limit = 256 - 256 % n
+    drop = bytes(range(limit, 256))
+    need = count * length
+    buf = b''
+    while len(buf) < need:
+        missing = need - len(buf)
+        buf += os.urandom(missing * 256 // limit + 16).translate(None, drop)
+    buf = buf[:need].translate(table).decode('ascii')
+    return [buf[i * length:(i + 1) * length] for i in range(count)]
 
 
-def readsecret(
-    secret, store=None, decode=False, secret_dir=''
+def createsecrets(specs, force=None):
+    """
+    Creates several secrets in one locked transaction.
+
+    :param dict specs: maps secret names to dicts with exactly one of the
+      ``fromfile``, ``random`` or ``value`` keys (the same as the arguments
+      of ``createsecret``).
+    :param bool force: overwrite existing secrets. Without it, nothing is
+      written if any of the secrets already exists.
+    """
+    values = {}
+    for secret, spec in specs.items():
+        if not isinstance(spec, dict) or len(spec) != 1 or (
+            set(spec) - {'fromfile', 'random', 'value'}
+        ):
+            raise Exception(
+                'Secret %s needs exactly one of fromfile, random or value.'
+                % secret
+            )
+        values[secret] = secretvalue(**spec)
+
+    with transaction() as secrets:
+        if not force:
+            exists = sorted(set(values) & set(secrets))
+            if exists:
+                raise SecretAlreadyExists(
+                    'Secret %s already exists.' % ', '.join(exists)
+                )
+        for secret, val in values.items():
+            secrets[secret] = base64.b64encode(val).decode()
+
+
+def createsecret(
+        secret, fromfile=None,
+        random=None, value=None, force=None,
 ):
-    try:
-        with open(SECRET_DATABASE_FILE, 'r') as db:
-            secretlines = db.readlines()
-    except FileNotFoundError:
-        raise SecretDatabaseNotFound(
-            'Secret database %s does not exist.' % SECRET_DATABASE_FILE
-        )
+    createsecrets({secret: dict(
+        (k, v) for k, v in
+        [('fromfile', fromfile), ('random', random), ('value', value)]
+        if v is not None
+    )}, force=force)
+
+
+def readsecrets(secrets):
+    """
+    Returns a dict of the decoded values of the given secrets, read from
+    ``secretd`` if it is running, from the secret database otherwise.
+    """
+    values = secretd.fetch(secrets)
+    if values is None:
+        values = get_store().get_many(secrets)
+    return values
 
-    value = None
-    for secretdef in secretlines:
-        if not secretdef:
-            continue
-        [s, v] = secretdef.split('=', 1)
-        if s == secret:
-            value = base64.b64decode(v.strip())
-            break
 
-    if value is None:
-        raise SecretDoesNotExist('Secret %s not found.' % secret)
+def readsecret(
+    secret, store=None, decode=False, secret_dir=''
+):
+    value = readsecrets([secret])[secret]
 
     if not store:
         return value if not decode else value.decode()
@@ -100,9 +287,56 @@ def readsecret(
     _gid = gid(readpart(parts, 2, default_gid))
     mode = int(readpart(parts, 3, '400'), 8)
 
-    with open(fn, 'wb') as f:
-        f.write(value)
-
-    os.chown(fn, _uid, _gid)
-    os.chmod(fn, mode)
+    write_atomic(fn, value, _uid, _gid, mode)
     return b''
+
+
+def generate_missing(length=32, charset=None):
+    """
+    Creates a random value for every secret defined in ``conf/secrets.yml``
+    but missing from the secret database, in one transaction. Returns the
+    names of the created secrets.
+    """
+    from .manifest import load_manifest
+
+    defined = load_manifest()['secrets']
+    with transaction() as secrets:
+        missing = sorted(set(defined) - set(secrets))
+        values = randomstrings(len(missing), length, charset)
+        for secret, value in zip(missing, values):
+            secrets[secret] = base64.b64encode(value.encode()).decode()
+    return missing
+
+
+def secretstatus():
+    """
+    Compares the secrets defined in ``conf/secrets.yml`` with the secret
+    database, parsing each file once. Returns a dict of
+
+    * ``defined``: the secrets defined in ``conf/secrets.yml``
+    * ``present``: the defined secrets in the database
+    * ``missing``: the defined secrets not in the database
+    * ``orphaned``: the secrets in the database that are not defined
+    * ``services``: the number of ``secrets`` and ``present`` secrets and
+      the ``missing`` secrets per service
+    """
+    from .manifest import load_manifest
+
+    manifest = load_manifest()
+    existing = set(get_store().names())
+    defined = set(manifest['secrets'])
+    services = {}
+    for service, secrets in sorted(manifest['services'].items()):
+        missing = [s for s in secrets if s not in existing]
+        services[service] = {
+            'secrets': len(secrets),
+            'present': len(secrets) - len(missing),
+            'missing': missing,
+        }
+    return {
+        'defined': sorted(defined),
+        'present': sorted(defined & existing),
+        'missing': sorted(defined - existing),
+        'orphaned': sorted(existing - defined),
+        'services': services,
+    }
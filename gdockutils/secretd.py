@@ -0,0 +1,176 @@
+import base64
+import json
+import os
+import pwd
+import socket
+import socketserver
+import struct
+import threading
+
+from . import (
+    SECRETD_SOCKET, SecretAccessDenied, SecretDoesNotExist, printerr, DEBUG
+)
+
+MAX_REQUEST = 64 * 1024
+
+
+def fetch(secrets, socket_path=None, timeout=2.0):
+    """
+    Fetches the given secrets from a running ``secretd``.
+
+    Returns a dict of the decoded values or ``None`` if no daemon is
+    listening on the socket. Raises ``SecretDoesNotExist`` or
+    ``SecretAccessDenied`` if the daemon refuses the request.
+    """
+    socket_path = SECRETD_SOCKET if socket_path is None else socket_path
+    if not socket_path or not os.path.exists(socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.settimeout(timeout)
+            s.connect(socket_path)
+            s.sendall(json.dumps({'secrets': list(secrets)}).encode() + b'\n')
+            with s.makefile('rb') as f:
+                response = json.loads(f.readline().decode())
+    except (OSError, ValueError) as e:
+        if DEBUG:
+            printerr('secretd is not available: %s' % e)
+        return None
+
+    error = response.get('error')
+    if error == 'not_found':
+        raise SecretDoesNotExist(response['message'])
+    if error == 'denied':
+        raise SecretAccessDenied(response['message'])
+    if error:
+        raise Exception(response['message'])
+    return dict(
+        (k, base64.b64decode(v)) for k, v in response['secrets'].items()
+    )
+
+
+def peercred(sock):
+    """Returns the ``(pid, uid, gid)`` of the process on the other end."""
+    creds = sock.getsockopt(
+        socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')
+    )
+    return struct.unpack('3i', creds)
+
+
+def allowed(uid, secret, manifest):
+    """
+    ``root`` and the user running the daemon may read every secret, other
+    users only the ones assigned to the service of the same name in
+    ``conf/secrets.yml``.
+    """
+    if uid in (0, os.geteuid()):
+        return True
+    try:
+        username = pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return False
+    return username in manifest['secrets'].get(secret, [])
+
+
+class SecretHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline(MAX_REQUEST).decode())
+            secrets = list(request['secrets'])
+        except (ValueError, KeyError, TypeError):
+            return self.reply(error='bad_request', message='Bad request.')
+
+        pid, uid, gid = peercred(self.request)
+        with self.server.lock:
+            manifest = self.server.manifest()
+            denied = [s for s in secrets if not allowed(uid, s, manifest)]
+            if denied:
+                return self.reply(
+                    error='denied',
+                    message='Access denied to secret %s.' % ', '.join(denied)
+                )
+            try:
+                values = self.server.store.encoded()
+            except Exception as e:
+                return self.reply(error='internal', message=str(e))
+        missing = [s for s in secrets if s not in values]
+        if missing:
+            return self.reply(
+                error='not_found',
+                message='Secret %s not found.' % ', '.join(missing)
+            )
+        if DEBUG:
+            printerr('secretd: %s to pid %d (uid %d)' % (secrets, pid, uid))
+        self.reply(secrets=dict((s, values[s]) for s in secrets))
+
+    def reply(self, **response):
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+class SecretServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, store, manifest):
+        self.store = store
+        self.manifest = manifest
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        super().__init__(socket_path, SecretHandler)
+
+
+def serve(socket_path=None, interval=1.0):
+    """
+    Serves the secret database over a Unix domain socket.
+
+    The database and ``conf/secrets.yml`` are parsed once, and parsed again
+    (every ``interval`` seconds, outside of the request path) only when
+    they change. Every request is authorized by the peer credentials of the
+    connecting process.
+
+    Example::
+
+        from gdockutils.secretd import serve
+
+        serve('/run/gdockutils/secretd.sock')
+    """
+    from .secret import get_store
+    from .manifest import load_manifest
+
+    socket_path = socket_path or SECRETD_SOCKET
+    store = get_store()
+    store.names()
+    load_manifest()
+
+    os.makedirs(os.path.dirname(socket_path) or '.', exist_ok=True)
+    try:
+        os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+    server = SecretServer(socket_path, store, load_manifest)
+    # access control is done using the peer credentials
+    os.chmod(socket_path, 0o666)
+
+    def watch():
+        while True:
+            server.stop.wait(interval)
+            if server.stop.is_set():
+                return
+            with server.lock:
+                try:
+                    store.names()
+                    load_manifest()
+                except Exception as e:
+                    printerr('secretd: %s' % e)
+
+    watcher = threading.Thread(target=watch, daemon=True)
+    watcher.start()
+    printerr('secretd listening on %s' % socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.stop.set()
+        server.server_close()
+        try:
+            os.unlink(socket_path)
+        except FileNotFoundError:
+            pass
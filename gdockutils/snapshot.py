@@ -0,0 +1,327 @@
+import json
+import os
+import shutil
+import stat as _stat
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+
+from . import BACKUP_DIR, DATA_FILES_DIR, printerr
+
+# content defined chunking: a boundary is the end of the first run of RUN
+# bytes that all fall into a fixed pseudo random half of the byte values,
+# at least MIN_CHUNK after the previous one (1MB chunks on average for
+# random data). Finding it takes a bytes.translate and a bytes.find, both
+# running at C speed; a rolling hash looping over every byte in Python
+# would do a few MB/s. Data without such runs (e.g. long stretches of the
+# same few bytes) is cut into MAX_CHUNK blocks.
+MIN_CHUNK = 256 << 10
+MAX_CHUNK = 4 << 20
+RUN = 19
+TABLE = bytes(sha256(bytes([i])).digest()[0] & 1 for i in range(256))
+PATTERN = b'\x01' * RUN
+READ_SIZE = 8 << 20
+
+
+def snapshot_dir(backup_dir=None):
+    return os.path.join(backup_dir or BACKUP_DIR, 'snapshots')
+
+
+def chunk_boundaries(data):
+    """
+    Yields the end offsets of the chunks of ``data``. A boundary depends
+    only on the ``RUN`` bytes before it, so inserting or removing bytes
+    only changes the chunks around the change.
+    """
+    bits = data.translate(TABLE)
+    start = 0
+    n = len(data)
+    while n - start > MIN_CHUNK:
+        end = min(start + MAX_CHUNK, n)
+        i = bits.find(PATTERN, start + MIN_CHUNK - RUN, end)
+        cut = end if i < 0 else i + RUN
+        yield cut
+        start = cut
+    if start < n:
+        yield n
+
+
+def _store_chunk(chunks_dir, data):
+    digest = sha256(data).hexdigest()
+    d = os.path.join(chunks_dir, digest[:2])
+    fn = os.path.join(d, digest[2:])
+    if os.path.exists(fn):
+        return digest, 0
+    os.makedirs(d, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix='.chunk.', dir=d)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    # another worker may have stored the same chunk, that is fine
+    os.rename(tmp, fn)
+    return digest, len(data)
+
+
+def store_file(path, chunks_dir):
+    """
+    Cuts the file into chunks and stores the new ones. Returns the list of
+    chunk digests and the number of bytes written.
+    """
+    chunks = []
+    written = 0
+    tail = b''
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            buf = tail + data
+            if not buf:
+                break
+            start = 0
+            for end in chunk_boundaries(buf):
+                # the last chunk may continue in the next read
+                if end == len(buf) and data:
+                    break
+                digest, n = _store_chunk(chunks_dir, buf[start:end])
+                chunks.append(digest)
+                written += n
+                start = end
+            tail = buf[start:]
+            if not data:
+                break
+    return chunks, written
+
+
+def _store_file(args):
+    return store_file(*args)
+
+
+def _scan(root):
+    """Yields ``(relative path, lstat)`` of everything under ``root``."""
+    pending = ['']
+    while pending:
+        rel = pending.pop()
+        with os.scandir(os.path.join(root, rel)) as it:
+            for entry in it:
+                path = os.path.join(rel, entry.name)
+                st = entry.stat(follow_symlinks=False)
+                yield path, st
+                if _stat.S_ISDIR(st.st_mode):
+                    pending.append(path)
+
+
+def _write_json(fn, obj):
+    from .materialize import write_atomic
+    write_atomic(fn, json.dumps(obj, sort_keys=True).encode(), mode=0o600)
+
+
+def _read_json(fn, default=None):
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+
+
+def create(source=None, backup_dir=None, jobs=None):
+    """
+    Takes a snapshot of ``source`` (``DATA_FILES_DIR`` by default) into
+    ``BACKUP_DIR/snapshots`` and returns its manifest.
+
+    Files are cut into content defined chunks stored under their sha256,
+    so only new chunks are written. The files are chunked and hashed by a
+    pool of ``jobs`` processes. Files whose inode, size and mtime are the
+    same as in the previous snapshot are not read at all.
+
+    Example::
+
+        from gdockutils.snapshot import create
+
+        print(create()['id'])
+    """
+    source = source or DATA_FILES_DIR
+    root = snapshot_dir(backup_dir)
+    chunks_dir = os.path.join(root, 'chunks')
+    manifests_dir = os.path.join(root, 'manifests')
+    os.makedirs(chunks_dir, exist_ok=True)
+    os.makedirs(manifests_dir, exist_ok=True)
+    index_fn = os.path.join(root, 'index.json')
+    index = _read_json(index_fn, {})
+
+    start = time.monotonic()
+    snapshot_id = base_id = time.strftime('%Y-%m-%d-%H-%M-%S', time.gmtime())
+    n = 0
+    while os.path.exists(os.path.join(manifests_dir, snapshot_id + '.json')):
+        n += 1
+        snapshot_id = '%s-%d' % (base_id, n)
+    entries = []
+    todo = []
+    new_index = {}
+    for path, st in sorted(_scan(source)):
+        entry = {'path': path, 'mode': _stat.S_IMODE(st.st_mode)}
+        if _stat.S_ISDIR(st.st_mode):
+            entry['type'] = 'dir'
+        elif _stat.S_ISLNK(st.st_mode):
+            entry['type'] = 'symlink'
+            entry['target'] = os.readlink(os.path.join(source, path))
+        elif _stat.S_ISREG(st.st_mode):
+            entry.update(type='file', size=st.st_size, mtime=st.st_mtime_ns)
+            key = [st.st_ino, st.st_size, st.st_mtime_ns]
+            cached = index.get(path)
+            if cached and cached[0] == key:
+                entry['chunks'] = cached[1]
+            else:
+                todo.append(entry)
+            new_index[path] = [key, None]
+        else:
+            continue
+        entries.append(entry)
+
+    written = 0
+    if todo:
+        with ProcessPoolExecutor(jobs) as executor:
+            results = executor.map(
+                _store_file,
+                [(os.path.join(source, e['path']), chunks_dir) for e in todo],
+                chunksize=16
+            )
+            for entry, (chunks, n) in zip(todo, results):
+                entry['chunks'] = chunks
+                written += n
+    for entry in entries:
+        if entry['type'] == 'file':
+            new_index[entry['path']][1] = entry['chunks']
+
+    manifest = {
+        'id': snapshot_id,
+        'source': os.path.abspath(source),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'entries': entries,
+        'stats': {
+            'files': len(new_index),
+            'hashed': len(todo),
+            'bytes_written': written,
+            'seconds': round(time.monotonic() - start, 3),
+        },
+    }
+    _write_json(os.path.join(manifests_dir, snapshot_id + '.json'), manifest)
+    _write_json(index_fn, new_index)
+    printerr(
+        'snapshot %(id)s: %(files)d files, %(hashed)d read, '
+        '%(bytes_written)d bytes written in %(seconds).2fs' % dict(
+            manifest['stats'], id=snapshot_id
+        )
+    )
+    return manifest
+
+
+def list_snapshots(backup_dir=None):
+    """Returns the ids of the snapshots, oldest first."""
+    try:
+        names = os.listdir(os.path.join(snapshot_dir(backup_dir), 'manifests'))
+    except FileNotFoundError:
+        return []
+    return sorted(n[:-len('.json')] for n in names if n.endswith('.json'))
+
+
+def _rebuild_file(args):
+    fn, chunks, chunks_dir, mode, mtime = args
+    d, name = os.path.split(fn)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, dir=d)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for digest in chunks:
+                with open(
+                    os.path.join(chunks_dir, digest[:2], digest[2:]), 'rb'
+                ) as c:
+                    f.write(c.read())
+            os.fchmod(f.fileno(), mode)
+        os.utime(tmp, ns=(mtime, mtime))
+        os.rename(tmp, fn)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def _chunk_ok(args):
+    chunks_dir, digest = args
+    try:
+        with open(os.path.join(chunks_dir, digest[:2], digest[2:]), 'rb') as f:
+            return sha256(f.read()).hexdigest() == digest
+    except FileNotFoundError:
+        return False
+
+
+def restore(snapshot_id, target=None, backup_dir=None, jobs=None):
+    """
+    Makes ``target`` (``DATA_FILES_DIR`` by default) identical to the
+    snapshot: files are rebuilt from the chunks by a pool of ``jobs``
+    processes, files not in the snapshot are deleted. Files with the size
+    and mtime recorded in the snapshot are left alone.
+
+    The chunks of the files to rebuild are checked before anything is
+    deleted; if one is missing or corrupted, ``target`` is not touched.
+    """
+    target = target or DATA_FILES_DIR
+    root = snapshot_dir(backup_dir)
+    chunks_dir = os.path.join(root, 'chunks')
+    manifest = _read_json(
+        os.path.join(root, 'manifests', snapshot_id + '.json')
+    )
+    if manifest is None:
+        raise Exception('snapshot %r does not exist' % snapshot_id)
+
+    start = time.monotonic()
+    os.makedirs(target, exist_ok=True)
+    current = dict(_scan(target))
+
+    def unchanged(entry):
+        st = current.get(entry['path'])
+        return st is not None and _stat.S_ISREG(st.st_mode) and (
+            st.st_size, st.st_mtime_ns
+        ) == (entry['size'], entry['mtime'])
+
+    files = [
+        e for e in manifest['entries']
+        if e['type'] == 'file' and not unchanged(e)
+    ]
+    digests = sorted(set(d for e in files for d in e['chunks']))
+    with ProcessPoolExecutor(jobs) as executor:
+        ok = executor.map(
+            _chunk_ok, [(chunks_dir, d) for d in digests], chunksize=64
+        )
+        bad = [d for d, good in zip(digests, ok) if not good]
+        if bad:
+            raise Exception(
+                'snapshot %r is damaged: %d chunks are missing or corrupted, '
+                'nothing was restored' % (snapshot_id, len(bad))
+            )
+
+        wanted = dict((e['path'], e) for e in manifest['entries'])
+        # remove what is not in the snapshot, has another type or has
+        # changed, deepest first
+        for path, st in sorted(current.items(), reverse=True):
+            entry = wanted.get(path)
+            fn = os.path.join(target, path)
+            if _stat.S_ISDIR(st.st_mode):
+                if not entry or entry['type'] != 'dir':
+                    shutil.rmtree(fn)
+            elif not entry or entry['type'] != 'file' or not unchanged(entry):
+                os.unlink(fn)
+
+        for entry in manifest['entries']:
+            fn = os.path.join(target, entry['path'])
+            if entry['type'] == 'dir':
+                os.makedirs(fn, exist_ok=True)
+                os.chmod(fn, entry['mode'])
+            elif entry['type'] == 'symlink':
+                os.symlink(entry['target'], fn)
+        list(executor.map(_rebuild_file, [
+            (
+                os.path.join(target, e['path']), e['chunks'], chunks_dir,
+                e['mode'], e['mtime']
+            )
+            for e in files
+        ], chunksize=16))
+    printerr('snapshot %s restored: %d files written in %.2fs' % (
+        snapshot_id, len(files), time.monotonic() - start
+    ))
@@ -0,0 +1,268 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+
+from . import printerr
+
+CHUNK_SIZE = 8 << 20
+# every chunk is compressed to a complete gzip member / xz stream / zstd
+# frame, the concatenation of them is a valid file for the usual tools
+EXTENSIONS = {'gzip': '.gz', 'xz': '.xz', 'zstd': '.zst'}
+DEFAULT_LEVELS = {'gzip': 6, 'xz': 6, 'zstd': 3}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception(
+            'zstd compression needs the zstandard package '
+            '(pip install gdockutils[zstd])'
+        )
+    return zstandard
+
+
+def codec_of(path):
+    """Returns the codec of a file by its extension (``None``: raw)."""
+    for codec, ext in EXTENSIONS.items():
+        if path.endswith(ext):
+            return codec
+    return None
+
+
+def manifest_path(path):
+    return path + '.json'
+
+
+def read_manifest(path):
+    """
+    Returns the sidecar manifest of ``path``, or ``None`` if it is missing
+    or unreadable (e.g. truncated).
+    """
+    try:
+        with open(manifest_path(path)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        printerr('%s: ignoring the unreadable manifest: %s' % (path, e))
+        return None
+
+
+def compress_chunk(codec, level, data):
+    if codec == 'gzip':
+        import gzip
+        import io
+        # gzip.compress has no mtime argument before Python 3.8
+        buf = io.BytesIO()
+        with gzip.GzipFile(
+            fileobj=buf, mode='wb', compresslevel=level, mtime=0
+        ) as f:
+            f.write(data)
+        return buf.getvalue()
+    if codec == 'xz':
+        import lzma
+        return lzma.compress(data, preset=level)
+    if codec == 'zstd':
+        return _zstandard().ZstdCompressor(level=level).compress(data)
+    raise Exception('unknown compression: %r' % codec)
+
+
+def _chunks(src, chunk_size):
+    while True:
+        data = src.read(chunk_size)
+        if not data:
+            return
+        yield data
+
+
+def write_manifest(path, manifest, uid=None, gid=None, mode=0o600):
+    from .materialize import write_atomic
+
+    write_atomic(
+        manifest_path(path),
+        json.dumps(manifest, indent=2, sort_keys=True).encode(),
+        uid, gid, mode
+    )
+
+
+def file_sha256(path):
+    h = sha256()
+    with open(path, 'rb') as f:
+        for data in _chunks(f, 1 << 20):
+            h.update(data)
+    return h.hexdigest()
+
+
+def verify(path):
+    """
+    Checks ``path`` against the checksum in its manifest before it is used.
+    Raises an ``Exception`` on a mismatch, returns ``False`` if there is no
+    manifest to check against.
+    """
+    manifest = read_manifest(path)
+    if not manifest or not manifest.get('sha256'):
+        return False
+    if file_sha256(path) != manifest['sha256']:
+        raise Exception('%s is corrupted: checksum mismatch' % path)
+    return True
+
+
+def describe(path, seconds, uid=None, gid=None, mode=0o600):
+    """
+    Writes the manifest of a file that was not written by ``write_stream``
+    (hashing it once more). Returns the manifest.
+    """
+    size = os.path.getsize(path)
+    manifest = {
+        'file': os.path.basename(path),
+        'compression': None,
+        'size': size,
+        'raw_size': size,
+        'sha256': file_sha256(path),
+        'seconds': round(seconds, 3),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+    write_manifest(path, manifest, uid, gid, mode)
+    return manifest
+
+
+def write_stream(
+    src, path, codec=None, jobs=None, chunk_size=CHUNK_SIZE, level=None,
+    uid=None, gid=None, mode=0o600, check=None
+):
+    """
+    Reads ``src`` (a binary file object, e.g. the stdout of ``pg_dump``)
+    until EOF and writes it to ``path``, compressed with ``codec`` (``gzip``,
+    ``xz``, ``zstd`` or ``None``).
+
+    The stream is cut into ``chunk_size`` chunks which are compressed by a
+    pool of ``jobs`` processes, while the output is hashed as it is written.
+    ``path`` only appears when it is complete, together with the sidecar
+    manifest ``path.json`` holding its size, sha256 and the duration.
+    ``check`` is called before that; if it raises, nothing is created.
+    Returns the manifest.
+    """
+    if codec is not None and codec not in EXTENSIONS:
+        raise Exception('unknown compression: %r' % codec)
+    if codec == 'zstd':
+        _zstandard()
+    level = DEFAULT_LEVELS.get(codec) if level is None else level
+    start = time.monotonic()
+    h = sha256()
+    size = raw_size = 0
+    d, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, dir=d or '.')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            if codec is None:
+                compressed = (
+                    (data, len(data)) for data in _chunks(src, chunk_size)
+                )
+                executor = None
+            else:
+                executor = ProcessPoolExecutor(jobs)
+                compressed = _compress_ordered(
+                    executor, codec, level, src, chunk_size, jobs
+                )
+            try:
+                for data, raw in compressed:
+                    raw_size += raw
+                    size += len(data)
+                    h.update(data)
+                    out.write(data)
+            finally:
+                if executor:
+                    executor.shutdown()
+            if uid is not None or gid is not None:
+                os.fchown(
+                    out.fileno(),
+                    -1 if uid is None else uid, -1 if gid is None else gid
+                )
+            os.fchmod(out.fileno(), mode)
+            out.flush()
+            os.fsync(out.fileno())
+        manifest = {
+            'file': name,
+            'compression': codec,
+            'size': size,
+            'raw_size': raw_size,
+            'sha256': h.hexdigest(),
+            'seconds': round(time.monotonic() - start, 3),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        }
+        if check is not None:
+            check()
+        os.rename(tmp, path)
+        write_manifest(path, manifest, uid, gid, mode)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    return manifest
+
+
+def _compress_ordered(executor, codec, level, src, chunk_size, jobs):
+    """
+    Yields the ``(compressed, raw size)`` of the chunks in order, keeping a
+    bounded number of chunks in flight.
+    """
+    in_flight = []
+    limit = 2 * (jobs or os.cpu_count() or 1)
+    for data in _chunks(src, chunk_size):
+        in_flight.append((
+            executor.submit(compress_chunk, codec, level, data), len(data)
+        ))
+        if len(in_flight) >= limit:
+            future, raw = in_flight.pop(0)
+            yield future.result(), raw
+    for future, raw in in_flight:
+        yield future.result(), raw
+
+
+class _HashingReader:
+    def __init__(self, f):
+        self.f = f
+        self.hash = sha256()
+
+    def read(self, n=-1):
+        data = self.f.read(n)
+        self.hash.update(data)
+        return data
+
+
+def read_stream(path, dst):
+    """
+    Writes the decompressed content of ``path`` to ``dst`` (a binary file
+    object, e.g. the stdin of ``psql``). The checksum in the manifest, if
+    there is one, is verified on the way; a mismatch raises an
+    ``Exception`` after the whole stream was written.
+    """
+    manifest = read_manifest(path)
+    with open(path, 'rb') as raw:
+        hashing = _HashingReader(raw)
+        codec = codec_of(path)
+        if codec == 'gzip':
+            import gzip
+            f = gzip.GzipFile(fileobj=hashing, mode='rb')
+        elif codec == 'xz':
+            import lzma
+            f = lzma.LZMAFile(hashing, 'rb')
+        elif codec == 'zstd':
+            f = _zstandard().ZstdDecompressor().stream_reader(
+                hashing, read_across_frames=True
+            )
+        else:
+            f = hashing
+        shutil.copyfileobj(f, dst, 1 << 20)
+        # the decompressors may leave the end of the file unread
+        while hashing.read(1 << 20):
+            pass
+    if manifest and manifest['sha256'] != hashing.hash.hexdigest():
+        raise Exception('%s is corrupted: checksum mismatch' % path)
@@ -0,0 +1,301 @@
+import os
+import select
+import shlex
+import signal
+import sys
+import time
+
+from . import DEBUG, printerr, load_yaml, METRICS_FILE, METRICS_INTERVAL
+from .gprun import spawn, get_signal, parse_stop_sequence, Stopper
+from .metrics import Sampler, collect, exitcode, write
+from .resources import compile_profile, load_profile
+
+RESTART_POLICIES = ('always', 'on-failure', 'never')
+
+
+class Program:
+    """
+    A supervised process.
+
+    :param str name: the name used in the log messages.
+    :param list command: the command to run.
+    :param str userspec: the user/group to run the command as.
+    :param str stopsignal: the signal to send to the process group of the
+      program when the supervisor is stopped (default: the received one).
+    :param str stop_sequence: a stop escalation sequence like
+      ``SIGINT:10,SIGTERM:5,SIGKILL`` (see ``gprun``), used instead of
+      ``stopsignal``.
+    :param str restart: ``always``, ``on-failure`` (default) or ``never``.
+    :param list secrets: the secrets to pass in file descriptors.
+    :param resources: a resource profile (a dict, see ``gprun``) or the name
+      of a profile in ``conf/resources.yml``.
+    :param float backoff: the delay of the first restart. It is doubled on
+      every restart of a program that failed within ``backoff_reset``
+      seconds, up to ``max_backoff``.
+    """
+
+    def __init__(
+        self, name, command, userspec=None, stopsignal=None,
+        stop_sequence=None, restart='on-failure', secrets=None, resources=None,
+        backoff=1.0, max_backoff=60.0, backoff_reset=10.0
+    ):
+        if restart not in RESTART_POLICIES:
+            raise Exception('bad restart policy: %r' % restart)
+        if isinstance(command, str):
+            command = shlex.split(command)
+        if not command:
+            raise Exception('no command given for %s' % name)
+        self.name = name
+        self.command = command
+        self.userspec = userspec
+        self.stopsignal = get_signal(stopsignal)
+        self.stop_sequence = parse_stop_sequence(stop_sequence)
+        if self.stopsignal is not None and self.stop_sequence:
+            raise Exception(
+                'stopsignal and stop_sequence cannot be used together'
+            )
+        self.stopper = None
+        self.restart = restart
+        self.secrets = secrets
+        if isinstance(resources, str):
+            resources = load_profile(resources)
+        if resources:
+            # fail early on a bad profile, not at every (re)start
+            compile_profile(resources)
+        self.resources = resources
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.backoff_reset = backoff_reset
+        self.proc = None
+        self.sampler = None
+        self.started = None
+        self.failures = 0
+        self.next_start = None
+        self.returncode = None
+
+    def start(self, metrics_interval=None):
+        self.proc = spawn(
+            self.command, self.userspec,
+            start_new_session=True, secrets=self.secrets,
+            resources=self.resources
+        )
+        self.started = time.monotonic()
+        self.next_start = None
+        if metrics_interval:
+            self.sampler = Sampler(self.proc.pid, metrics_interval).start()
+        printerr('%s started (pid %d)' % (self.name, self.proc.pid))
+
+    def send_signal(self, signum):
+        if self.proc is None:
+            return
+        if self.stop_sequence:
+            # further signals do not restart the sequence
+            if self.stopper is None:
+                self.stopper = Stopper(
+                    self.stop_sequence, self.kill, self.name
+                )
+                self.stopper.next()
+            return
+        sig = self.stopsignal if self.stopsignal is not None else signum
+        try:
+            self.kill(sig)
+        except ProcessLookupError:
+            pass
+
+    def kill(self, signum):
+        # every program runs in its own session / process group
+        os.killpg(self.proc.pid, signum)
+
+    def exited(self, status, stopping, rusage=None, metrics=None):
+        """
+        Handles the exit of the process; returns its exit code. The resource
+        usage is written to the ``metrics`` file, if given.
+        """
+        returncode = exitcode(status)
+        # the process was reaped by us, Popen must not wait for it
+        self.proc.returncode = returncode
+        self.proc = None
+        self.returncode = returncode
+        sampled = self.sampler.stop() if self.sampler else None
+        self.sampler = None
+        printerr('%s exited with %d' % (self.name, returncode))
+        phases = None
+        if self.stopper:
+            phases = self.stopper.report()
+            self.stopper = None
+        if metrics and rusage is not None:
+            record = collect(
+                self.name, self.command, returncode,
+                time.monotonic() - self.started, rusage, sampled
+            )
+            if phases:
+                record['stop_phases'] = phases
+                record['stop_seconds'] = round(sum(s for _, s in phases), 3)
+            write(record, metrics)
+
+        if stopping or self.restart == 'never' or (
+            self.restart == 'on-failure' and returncode == 0
+        ):
+            return returncode
+        self.schedule_restart()
+        return returncode
+
+    def schedule_restart(self):
+        now = time.monotonic()
+        if self.started is not None and now - self.started >= (
+            self.backoff_reset
+        ):
+            self.failures = 0
+        self.failures += 1
+        delay = min(
+            self.backoff * 2 ** (self.failures - 1), self.max_backoff
+        )
+        self.next_start = now + delay
+        printerr('%s will be restarted in %.1fs' % (self.name, delay))
+
+
+def load_programs(path):
+    """
+    Loads the programs from the ``programs`` section of a yaml file::
+
+        programs:
+          nginx:
+            command: nginx -g 'daemon off;'
+            stopsignal: SIGQUIT
+            restart: always
+          postgres:
+            command: [postgres]
+            userspec: postgres
+            stop_sequence: SIGINT:30,SIGQUIT:5,SIGKILL
+          worker:
+            command: [python, worker.py]
+            userspec: django
+            resources: batch
+    """
+    doc = load_yaml(path) or {}
+    return [
+        Program(name, **(conf or {}))
+        for name, conf in (doc.get('programs') or {}).items()
+    ]
+
+
+def supervise(
+    programs, sys_exit=True, metrics=None, metrics_interval=None
+):
+    """
+    Runs several programs as a PID 1 style supervisor.
+
+    Every program runs in its own process group. ``SIGTERM``, ``SIGINT``
+    and ``SIGHUP`` are forwarded to all of the process groups (using the
+    ``stopsignal`` or the ``stop_sequence`` of the program, if set) and the
+    supervisor exits when all of them are gone. All the children are reaped
+    with ``os.wait4(-1)``, including orphaned processes re-parented to us.
+    Programs are restarted according to their restart policy.
+
+    Returns (or exits with) ``1`` if a program failed before the supervisor
+    was stopped, ``0`` otherwise.
+
+    Every run of a program is recorded in the ``metrics`` file (see
+    ``gprun``), with the name of the program as the job name.
+
+    Example::
+
+        from gdockutils.supervisor import Program, supervise
+
+        supervise([
+            Program('app', ['uwsgi', 'uwsgi.ini'], userspec='django'),
+            Program('nginx', ['nginx'], stopsignal='SIGQUIT'),
+        ])
+    """
+    rfd, wfd = os.pipe()
+    os.set_blocking(rfd, False)
+    os.set_blocking(wfd, False)
+    stopsignals = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+    handlers = {}
+    for signum in (signal.SIGCHLD,) + stopsignals:
+        # the handler does nothing, the signals arrive through the pipe
+        handlers[signum] = signal.signal(signum, lambda signum, frame: None)
+    signal.set_wakeup_fd(wfd)
+
+    metrics = METRICS_FILE if metrics is None else metrics
+    if metrics_interval is None:
+        metrics_interval = float(METRICS_INTERVAL or 0)
+    stopping = False
+    failed = False
+    running = {}
+    for program in programs:
+        program.next_start = time.monotonic()
+
+    while True:
+        now = time.monotonic()
+        for program in programs:
+            if program.next_start is not None and program.next_start <= now:
+                try:
+                    program.start(metrics and metrics_interval)
+                except Exception as e:
+                    # e.g. a missing command, an unknown user or a secret
+                    # that cannot be read: the others keep running
+                    printerr('%s could not be started: %s' % (program.name, e))
+                    failed = True
+                    program.started = None
+                    program.next_start = None
+                    if program.restart != 'never':
+                        program.schedule_restart()
+                else:
+                    running[program.proc.pid] = program
+        for program in running.values():
+            stopper = program.stopper
+            if stopper and stopper.deadline and stopper.deadline <= now:
+                stopper.next(now)
+        pending = [p for p in programs if p.next_start is not None]
+        if not running and not pending:
+            break
+        deadlines = [p.next_start for p in pending] + [
+            p.stopper.deadline for p in running.values()
+            if p.stopper and p.stopper.deadline
+        ]
+        timeout = None
+        if deadlines:
+            timeout = max(0, min(deadlines) - now)
+
+        select.select([rfd], [], [], timeout)
+        try:
+            signums = os.read(rfd, 1024)
+        except BlockingIOError:
+            signums = b''
+
+        for signum in signums:
+            if signum in stopsignals:
+                if not stopping:
+                    printerr('stopping all programs')
+                stopping = True
+                for program in programs:
+                    program.next_start = None
+                    program.send_signal(signum)
+
+        # reap every child that exited, ours or orphaned
+        while True:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            program = running.pop(pid, None)
+            if program is None:
+                if DEBUG:
+                    printerr('reaped orphaned process %d' % pid)
+                continue
+            returncode = program.exited(status, stopping, rusage, metrics)
+            if returncode != 0 and not stopping:
+                failed = True
+
+    signal.set_wakeup_fd(-1)
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+    os.close(rfd)
+    os.close(wfd)
+    returncode = 1 if failed else 0
+    if sys_exit:
+        sys.exit(returncode)
+    return returncode
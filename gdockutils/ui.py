@@ -5,12 +5,6 @@ import sys
 import os
 
 from . import printerr, NoChoiceError, SECRET_SOURCE_DIR, SECRET_DATABASE_FILE
-from . import BACKUP_DIR
-from .db import restore, backup
-from .secret import (
-    readsecret, SecretDoesNotExist, createsecret, existing
-)
-from .prepare import defined_secrets
 
 
 def ask_cli():
@@ -164,6 +158,15 @@ def backup_ui():
         '--backup_gid',
         help='the gid of the backup user',
     )
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='the number of parallel jobs of a directory format backup',
+    )
+    parser.add_argument(
+        '-s', '--snapshot',
+        help='take a snapshot of the files instead of mirroring them',
+        action='store_true'
+    )
 
     args = parser.parse_args()
 
@@ -186,16 +189,48 @@ def backup_ui():
     database_format = None
     if args.database:
         database_format = ask(
-            ['custom', 'plain'],
+            ['custom', 'plain', 'directory'],
             prompt='Which db backup format do you want to use?'
         )
+    compression = None
+    if database_format in ('custom', 'plain'):
+        compression = ask(
+            ['none', 'gzip', 'xz', 'zstd'], default='none',
+            prompt='How would you like to compress the backup?'
+        )
+        if compression == 'none':
+            compression = None
+
+    from .db import backup
 
     backup(
         database_format, 'files' in typ,
-        args.backup_uid, args.backup_gid
+        args.backup_uid, args.backup_gid, args.jobs, compression,
+        args.snapshot
     )
 
 
+def _human_size(n):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if n < 1024:
+            break
+        n /= 1024
+    else:
+        unit = 'TB'
+    return '%.1f%s' % (n, unit) if unit != 'B' else '%dB' % n
+
+
+def _describe(backup):
+    parts = [backup['name'], backup['created'], _human_size(backup['size'])]
+    if backup['compression']:
+        parts.append(backup['compression'])
+    if backup['server_version']:
+        parts.append('PostgreSQL %s' % backup['server_version'])
+    if backup['seconds'] is not None:
+        parts.append('took %.0fs' % backup['seconds'])
+    return '  '.join(parts)
+
+
 def restore_ui():
     parser = argparse.ArgumentParser(
         description=(
@@ -224,6 +259,10 @@ def restore_ui():
         '--owner',
         help='the owner of the created database',
     )
+    parser.add_argument(
+        '-j', '--jobs', type=int,
+        help='the number of parallel restore jobs',
+    )
 
     args = parser.parse_args()
 
@@ -245,46 +284,51 @@ def restore_ui():
 
     db_backup_file = None
     if 'database' in typ:
-        db_backup_dir = os.path.join(BACKUP_DIR, 'db')
-        entries = os.listdir(db_backup_dir)
-        entries = sorted([
-            e
-            for e in entries
-            if os.path.isfile(os.path.join(db_backup_dir, e))
-        ])
+        from .catalog import sync
+        # newest first, described by the catalog; only the backups copied
+        # into BACKUP_DIR/db by hand are looked at
+        entries = [(b['name'], _describe(b)) for b in reversed(sync())]
         db_backup_file = ask(
             entries, prompt='Which db backup file would you like to use?'
         )
 
+    snapshot = None
+    if 'files' in typ:
+        from .snapshot import list_snapshots
+        snapshots = list_snapshots()
+        if snapshots:
+            snapshot = ask(
+                ['mirror'] + snapshots[::-1], default='mirror',
+                prompt='Restore the files from the BACKUP_DIR/files mirror '
+                       'or from a snapshot?'
+            )
+            if snapshot == 'mirror':
+                snapshot = None
+
+    from .db import restore
+
     restore(
         db_backup_file, 'files' in typ,
-        args.drop_db, args.create_db, args.owner
+        args.drop_db, args.create_db, args.owner, args.jobs, snapshot
     )
 
 
 def createsecret_ui():
+    from .secret import createsecret, secretstatus
+
     with open(SECRET_DATABASE_FILE, 'a'):
         pass
     os.chmod(SECRET_DATABASE_FILE, 0o600)
-    possible_secrets = defined_secrets()
-    marks = []
-    for i, s in enumerate(possible_secrets):
-        try:
-            readsecret(s)
-        except SecretDoesNotExist:
-            pass
-        else:
-            marks.append(i)
+    status = secretstatus()
+    possible_secrets = status['defined']
+    present = set(status['present'])
+    marks = [i for i, s in enumerate(possible_secrets) if s in present]
     secret = ask(
         possible_secrets,
         prompt='Which secret would you like to create?',
         marks=marks
     )
-    try:
-        readsecret(secret)
-    except SecretDoesNotExist:
-        pass
-    else:
+    if secret in present:
         prompt = '%s already exists. Would you like to recreate it?' % secret
         if not ask(
             prompt=prompt,
@@ -332,7 +376,14 @@ def createsecret_ui():
 
 
 def readsecret_ui():
-    secrets = existing()
+    from .secret import readsecret, secretstatus
+
+    status = secretstatus()
+    secrets = sorted(
+        status['present'] +
+        [(s, '%s (not defined)' % s) for s in status['orphaned']],
+        key=lambda s: s if isinstance(s, str) else s[0]
+    )
     if not secrets:
         return
     secret = ask(
@@ -28,6 +28,9 @@ setup(
     install_requires=[
         'pyyaml >= 3.13',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+    },
     entry_points={
         'console_scripts': [
             'createcerts=gdockutils.cli:createcerts',
@@ -35,10 +38,13 @@ setup(
             'ensure_db=gdockutils.cli:ensure_db',
             'backup=gdockutils.cli:backup',
             'restore=gdockutils.cli:restore',
+            'prune=gdockutils.cli:prune',
             'ask=gdockutils.ui:ask_cli',
             'createsecret=gdockutils.cli:createsecret',
             'readsecret=gdockutils.cli:readsecret',
             'prepare=gdockutils.cli:prepare',
+            'secretd=gdockutils.cli:secretd',
+            'secretstatus=gdockutils.cli:secretstatus',
             'createsecret_ui=gdockutils.ui:createsecret_ui',
             'readsecret_ui=gdockutils.ui:readsecret_ui',
             'backup_ui=gdockutils.ui:backup_ui',
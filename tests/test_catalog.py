@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+
+from gdockutils import catalog
+
+
+def _backup(created, name=None):
+    return {
+        'name': name or 'db-%s.backup' % created, 'created': created,
+        'format': 'custom', 'compression': None, 'size': 1, 'sha256': None,
+        'seconds': 1.0, 'server_version': None,
+    }
+
+
+class TestSelect(unittest.TestCase):
+    def setUp(self):
+        # two backups a day from 2020-01-01 to 2020-03-31
+        self.backups = []
+        for month, days in [(1, 31), (2, 29), (3, 31)]:
+            for day in range(1, days + 1):
+                for hour in (6, 18):
+                    self.backups.append(_backup(
+                        '2020-%02d-%02dT%02d:00:00Z' % (month, day, hour)
+                    ))
+
+    def test_last(self):
+        keep = catalog.select(self.backups, last=3)
+        self.assertEqual(sorted(keep), [
+            'db-2020-03-30T18:00:00Z.backup',
+            'db-2020-03-31T06:00:00Z.backup',
+            'db-2020-03-31T18:00:00Z.backup',
+        ])
+
+    def test_buckets(self):
+        keep = catalog.select(
+            self.backups, last=1, daily=2, weekly=2, monthly=2
+        )
+        self.assertEqual(keep, {
+            'db-2020-03-31T18:00:00Z.backup': [
+                'last', 'daily', 'weekly', 'monthly'
+            ],
+            'db-2020-03-30T18:00:00Z.backup': ['daily'],
+            # sunday of the previous ISO week
+            'db-2020-03-29T18:00:00Z.backup': ['weekly'],
+            'db-2020-02-29T18:00:00Z.backup': ['monthly'],
+        })
+
+    def test_nothing(self):
+        self.assertEqual(catalog.select(self.backups), {})
+
+
+class TestCatalog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.db = os.path.join(self.tmp.name, 'db')
+        os.makedirs(os.path.join(self.db, 'x-2020-01-01.backup.d'))
+        for name in [
+            'x-2020-01-02.backup', 'x-2020-01-03.backup.sql.gz', 'notes.txt'
+        ]:
+            with open(os.path.join(self.db, name), 'wb') as f:
+                f.write(b'1234')
+
+    def test_rebuild_add_prune(self):
+        backups = catalog.load(self.tmp.name)
+        self.assertEqual(
+            sorted((b['name'], b['format']) for b in backups), [
+                ('x-2020-01-01.backup.d', 'directory'),
+                ('x-2020-01-02.backup', 'custom'),
+                ('x-2020-01-03.backup.sql.gz', 'plain'),
+            ]
+        )
+        item = _backup('2030-01-01T00:00:00Z', 'new.backup')
+        with open(os.path.join(self.db, 'new.backup'), 'wb') as f:
+            f.write(b'new')
+        with open(os.path.join(self.db, 'new.backup.json'), 'w') as f:
+            f.write('{}')
+        catalog.add(item, self.tmp.name)
+        self.assertEqual(catalog.load(self.tmp.name)[-1], item)
+
+        removed = catalog.prune(last=1, dry_run=True, backup_dir=self.tmp.name)
+        self.assertEqual(len(removed), 3)
+        self.assertEqual(len(catalog.load(self.tmp.name)), 4)
+        self.assertEqual(len(os.listdir(self.db)), 6)
+
+        catalog.prune(last=1, backup_dir=self.tmp.name)
+        self.assertEqual(catalog.load(self.tmp.name), [item])
+        self.assertEqual(
+            sorted(os.listdir(self.db)),
+            ['new.backup', 'new.backup.json', 'notes.txt']
+        )
+
+    def test_sync(self):
+        catalog.load(self.tmp.name)
+        # copied in and deleted by hand
+        with open(os.path.join(self.db, 'prod.backup.sql'), 'wb') as f:
+            f.write(b'SELECT 1;')
+        os.unlink(os.path.join(self.db, 'x-2020-01-02.backup'))
+        backups = dict(
+            (b['name'], b) for b in catalog.sync(self.tmp.name)
+        )
+        self.assertEqual(sorted(backups), [
+            'prod.backup.sql', 'x-2020-01-01.backup.d',
+            'x-2020-01-03.backup.sql.gz',
+        ])
+        self.assertEqual(backups['prod.backup.sql']['format'], 'plain')
+        self.assertEqual(backups['prod.backup.sql']['size'], 9)
+        self.assertEqual(
+            catalog.load(self.tmp.name), catalog.sync(self.tmp.name)
+        )
@@ -0,0 +1,186 @@
+import os
+import subprocess
+import tempfile
+import unittest
+import unittest.mock
+
+from gdockutils import db
+
+
+class TestEnsureDb(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        d = self.tmp.name
+        pgdata = os.path.join(d, 'pgdata')
+        os.makedirs(pgdata)
+        with open(os.path.join(pgdata, 'PG_VERSION'), 'w') as f:
+            f.write('12\n')
+        for name in ('pg_hba.conf', 'postgresql.conf'):
+            with open(os.path.join(d, name), 'w') as f:
+                f.write('# %s\n' % name)
+        self.passwords = {
+            'DB_PASSWORD_POSTGRES': b'a', 'DB_PASSWORD_DJANGO': b'b',
+            'DB_PASSWORD_EXPLORER': b'c',
+        }
+        self.gprun = unittest.mock.Mock()
+        self.run = unittest.mock.Mock()
+        patcher = unittest.mock.patch.multiple(
+            db, PGDATA=pgdata,
+            PG_HBA_ORIG=os.path.join(d, 'pg_hba.conf'),
+            POSTGRESCONF_ORIG=os.path.join(d, 'postgresql.conf'),
+            uid=lambda name: os.getuid(), gid=lambda name: os.getgid(),
+            prepare=unittest.mock.Mock(),
+            set_files_perms=unittest.mock.Mock(),
+            readsecrets=lambda secrets: self.passwords,
+            gprun=self.gprun, run=self.run,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmp.cleanup)
+
+    def psql_commands(self):
+        return [
+            args[0][i + 1]
+            for args, _ in self.run.call_args_list
+            for i, a in enumerate(args[0]) if a == '-c'
+        ]
+
+    def test_fingerprint(self):
+        db.ensure_db('django', 'django')
+        self.assertEqual(self.gprun.call_count, 2)
+        self.assertEqual(len(self.psql_commands()), 11)
+
+        self.gprun.reset_mock()
+        self.run.reset_mock()
+        db.ensure_db('django', 'django')
+        self.gprun.assert_not_called()
+        self.run.assert_not_called()
+
+        self.passwords['DB_PASSWORD_EXPLORER'] = b'd'
+        db.ensure_db('django', 'django')
+        self.assertEqual(self.gprun.call_count, 2)
+        commands = self.psql_commands()
+        self.assertEqual(len(commands), 2)
+        self.assertTrue(commands[1].startswith('ALTER ROLE explorer'))
+
+    def test_failed_steps_are_retried(self):
+        def psql(cmd, **kwargs):
+            if 'ALTER ROLE postgres' in ' '.join(cmd):
+                raise subprocess.CalledProcessError(1, cmd)
+
+        self.run.side_effect = psql
+        with self.assertRaises(Exception):
+            db.ensure_db('django', 'django')
+        # postgres is stopped anyway
+        self.assertIn('stop', self.gprun.call_args[1]['command'])
+        for args, _ in self.run.call_args_list:
+            if any(a.startswith('ALTER') for a in args[0]):
+                self.assertIn('ON_ERROR_STOP=1', args[0])
+
+        self.run.reset_mock()
+        self.run.side_effect = None
+        db.ensure_db('django', 'django')
+        self.assertEqual(self.psql_commands(), [
+            'ALTER ROLE postgres ENCRYPTED PASSWORD %s' % (
+                "'md5%s'" % db.md5('apostgres')
+            )
+        ])
+
+    def test_config_copied_when_changed(self):
+        db.ensure_db('django', 'django')
+        dest = os.path.join(db.PGDATA, 'postgresql.conf')
+        mtime = os.stat(dest).st_mtime_ns
+        db.ensure_db('django', 'django')
+        self.assertEqual(os.stat(dest).st_mtime_ns, mtime)
+        with open(db.POSTGRESCONF_ORIG, 'a') as f:
+            f.write('work_mem = 8MB\n')
+        db.ensure_db('django', 'django')
+        with open(dest) as f:
+            self.assertIn('work_mem', f.read())
+
+    def test_auto_conf_pg10(self):
+        with open(os.path.join(db.PGDATA, 'PG_VERSION'), 'w') as f:
+            f.write('10\n')
+        with unittest.mock.patch.multiple(
+            db, cpu_count=lambda: 8, POSTGRES_AUTOTUNE=True
+        ):
+            db.ensure_db('django', 'django')
+        with open(os.path.join(db.PGDATA, db.AUTO_CONF_FILE)) as f:
+            settings = f.read()
+        self.assertIn('max_parallel_workers = 8', settings)
+        self.assertNotIn('max_parallel_maintenance_workers', settings)
+
+
+class TestBackup(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.run = unittest.mock.Mock()
+        patcher = unittest.mock.patch.multiple(
+            db, BACKUP_DIR=self.tmp.name, run=self.run,
+            wait_for_db=unittest.mock.Mock(),
+            get_db_env=unittest.mock.Mock(return_value={}),
+            set_backup_perms=unittest.mock.Mock(),
+            cpu_count=lambda: 3,
+            server_version=lambda: '13.4',
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_directory_format(self):
+        def pg_dump(cmd, **kwargs):
+            d = cmd[cmd.index('-f') + 1]
+            os.makedirs(d)
+            with open(os.path.join(d, 'toc.dat'), 'wb') as f:
+                f.write(b'x' * 100)
+
+        self.run.side_effect = pg_dump
+        db.backup('directory', backup_uid=0, backup_gid=0)
+        self.run.side_effect = None
+        cmd = self.run.call_args[0][0]
+        self.assertEqual(cmd[cmd.index('-F') + 1], 'directory')
+        self.assertEqual(cmd[cmd.index('-j') + 1], '3')
+        self.assertTrue(cmd[cmd.index('-f') + 1].endswith('.backup.d'))
+        backups = db.catalog.load(self.tmp.name)
+        self.assertEqual(len(backups), 1)
+        self.assertEqual(backups[0]['name'], os.path.basename(
+            cmd[cmd.index('-f') + 1]
+        ))
+        self.assertEqual(backups[0]['format'], 'directory')
+        self.assertEqual(backups[0]['size'], 100)
+        self.assertEqual(backups[0]['server_version'], '13.4')
+
+        os.makedirs(os.path.join(self.tmp.name, 'db', 'x.backup.d'))
+        db.restore('x.backup.d', jobs=5)
+        cmd = self.run.call_args[0][0]
+        self.assertEqual(cmd[0], 'pg_restore')
+        self.assertEqual(cmd[cmd.index('-j') + 1], '5')
+
+    def test_streaming(self):
+        fn = os.path.join(self.tmp.name, 'dump.backup.sql.gz')
+        out = os.path.join(self.tmp.name, 'out')
+        db._dump_to(
+            ['sh', '-c', 'seq 100000'], fn, None, codec='gzip', jobs=2
+        )
+        db._restore_from(['sh', '-c', 'cat > %s' % out], fn, None)
+        with open(out) as f:
+            self.assertEqual(f.read().split()[-1], '100000')
+        fn = os.path.join(self.tmp.name, 'failed.backup.gz')
+        with self.assertRaises(Exception):
+            db._dump_to(['sh', '-c', 'echo x; exit 1'], fn, None, codec='gzip')
+        self.assertFalse(os.path.exists(fn))
+        with self.assertRaises(Exception):
+            db._restore_from(['false'], out, None)
+
+    def test_corrupted_backup_is_not_restored(self):
+        os.makedirs(os.path.join(self.tmp.name, 'db'))
+        fn = os.path.join(self.tmp.name, 'db', 'x.backup.sql.gz')
+        db._dump_to(
+            ['sh', '-c', 'echo "SELECT 1;"'], fn, None, codec='gzip'
+        )
+        with open(fn, 'ab') as f:
+            f.write(b'garbage')
+        with self.assertRaises(Exception):
+            db.restore('x.backup.sql.gz')
+        # nothing was dropped
+        self.run.assert_not_called()
@@ -4,6 +4,8 @@ import sys
 import os
 
 from gdockutils.cli import gprun
+from gdockutils import gprun as gprun_module
+from gdockutils.gprun import gprun as _gprun, get_userspec
 
 
 class TestCertificates(unittest.TestCase):
@@ -16,3 +18,106 @@ class TestCertificates(unittest.TestCase):
         stat = os.stat('/tmp/x')
         self.assertEqual(stat.st_uid, 1234)
         self.assertEqual(stat.st_gid, 2345)
+
+    def test_single_group(self):
+        # the options of a single command group are not part of the command
+        fn = '/tmp/gprun_group'
+        if os.path.exists(fn):
+            os.unlink(fn)
+        with unittest.mock.patch.object(
+            sys, 'argv', ['gprun', '--', '-u', '1234:2345', 'touch', fn]
+        ):
+            with self.assertRaises(SystemExit) as cm:
+                gprun()
+        self.assertEqual(cm.exception.code, 0)
+        self.assertEqual(os.stat(fn).st_uid, 1234)
+
+    def test_modes(self):
+        for mode in ['preexec', 'exec']:
+            fn = '/tmp/gprun_%s' % mode
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    _gprun(
+                        userspec='1234:2345', command=['touch', fn],
+                        mode=mode
+                    )
+                except SystemExit as e:
+                    os._exit(e.code)
+                finally:
+                    os._exit(1)
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(os.WEXITSTATUS(status), 0)
+            stat = os.stat(fn)
+            self.assertEqual((stat.st_uid, stat.st_gid), (1234, 2345))
+            os.remove(fn)
+
+    def test_get_userspec(self):
+        uid, username, homedir, gid, groups = get_userspec('root')
+        self.assertEqual((uid, username, gid), (0, 'root', 0))
+        self.assertIn(0, groups)
+        self.assertEqual(get_userspec('0:12')[3:], (12, [12]))
+
+    def test_secrets_in_fds(self):
+        out = '/tmp/gprun_secrets'
+        script = 'cat $A_FILE $B_PATH /dev/fd/$C_FD > %s' % out
+        with unittest.mock.patch(
+            'gdockutils.secret.readsecrets',
+            return_value={'A': b'a', 'B': b'b', 'C': b'c'}
+        ):
+            _gprun(
+                command=['sh', '-c', script], sys_exit=False,
+                secrets=['A', 'B:B_PATH', 'C:fd']
+            )
+        with open(out, 'rb') as f:
+            self.assertEqual(f.read(), b'abc')
+        os.remove(out)
+
+    def test_secrets_with_userspec(self):
+        out = '/tmp/gprun_secrets_user'
+        readsecrets = unittest.mock.patch(
+            'gdockutils.secret.readsecrets',
+            return_value={'A': b'a', 'C': b'c'}
+        )
+        with readsecrets:
+            if gprun_module.HAS_MEMFD:
+                _gprun(
+                    userspec='1234:2345', sys_exit=False,
+                    command=['sh', '-c', 'cat $A_FILE > %s' % out],
+                    secrets=['A']
+                )
+                with open(out, 'rb') as f:
+                    self.assertEqual(f.read(), b'a')
+                os.remove(out)
+            with unittest.mock.patch.object(gprun_module, 'HAS_MEMFD', False):
+                # a pipe cannot be reopened by another user
+                with self.assertRaises(Exception):
+                    _gprun(
+                        userspec='1234:2345', sys_exit=False,
+                        command=['true'], secrets=['A']
+                    )
+                _gprun(
+                    userspec='1234:2345', sys_exit=False,
+                    command=['bash', '-c', 'cat <&$C_FD > %s' % out],
+                    secrets=['C:fd']
+                )
+        with open(out, 'rb') as f:
+            self.assertEqual(f.read(), b'c')
+        os.remove(out)
+
+    def test_resources(self):
+        out = '/tmp/gprun_resources'
+        script = 'ulimit -n > %s; cat /proc/self/oom_score_adj >> %s' % (
+            out, out
+        )
+        _gprun(
+            command=['sh', '-c', script], sys_exit=False,
+            resources={'nofile': '512:1024', 'nice': 5, 'oom_score_adj': 100}
+        )
+        with open(out) as f:
+            self.assertEqual(f.read().split(), ['512', '100'])
+        os.remove(out)
+        with self.assertRaises(Exception):
+            _gprun(
+                command=['true'], sys_exit=False, resources={'bad': 1}
+            )
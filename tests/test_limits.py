@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+from gdockutils.limits import memory_limit, cpu_limit, cpu_count
+from gdockutils.db import postgres_settings
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+class TestLimits(unittest.TestCase):
+    def test_cgroup_v2(self):
+        with tempfile.TemporaryDirectory() as d:
+            proc = os.path.join(d, 'cgroup')
+            write(proc, '0::/app\n')
+            root = os.path.join(d, 'fs')
+            write(os.path.join(root, 'app', 'memory.max'), '%d\n' % (1 << 30))
+            write(os.path.join(root, 'app', 'cpu.max'), '150000 100000\n')
+            self.assertEqual(memory_limit(root, proc), 1 << 30)
+            self.assertEqual(
+                cpu_limit(root, proc), min(1.5, len(os.sched_getaffinity(0)))
+            )
+            write(os.path.join(root, 'app', 'memory.max'), 'max\n')
+            write(os.path.join(root, 'app', 'cpu.max'), 'max 100000\n')
+            self.assertGreater(memory_limit(root, proc), 1 << 30)
+            self.assertEqual(
+                cpu_count(root, proc), len(os.sched_getaffinity(0))
+            )
+
+    def test_cgroup_v1(self):
+        with tempfile.TemporaryDirectory() as d:
+            proc = os.path.join(d, 'cgroup')
+            write(proc, '4:memory:/docker/x\n2:cpu,cpuacct:/docker/x\n')
+            root = os.path.join(d, 'fs')
+            # not mounted at the path of /proc/self/cgroup in the container
+            write(
+                os.path.join(root, 'memory', 'memory.limit_in_bytes'),
+                '%d\n' % (512 << 20)
+            )
+            write(os.path.join(root, 'cpu', 'cpu.cfs_quota_us'), '50000\n')
+            write(os.path.join(root, 'cpu', 'cpu.cfs_period_us'), '100000\n')
+            self.assertEqual(memory_limit(root, proc), 512 << 20)
+            self.assertEqual(cpu_limit(root, proc), 0.5)
+            self.assertEqual(cpu_count(root, proc), 1)
+
+    def test_postgres_settings(self):
+        settings = dict(postgres_settings(2 << 30, 1, rotational=True))
+        self.assertEqual(settings['shared_buffers'], '512MB')
+        self.assertEqual(settings['effective_cache_size'], '1536MB')
+        self.assertEqual(settings['work_mem'], '5MB')
+        self.assertEqual(settings['random_page_cost'], '4')
+        self.assertNotIn('max_parallel_workers', settings)
+        settings = dict(postgres_settings(64 << 30, 16))
+        self.assertEqual(settings['shared_buffers'], '16384MB')
+        self.assertEqual(settings['maintenance_work_mem'], '2048MB')
+        self.assertEqual(settings['max_parallel_workers'], '16')
+        self.assertIn('max_parallel_maintenance_workers', settings)
+        self.assertEqual(settings['max_worker_processes'], '16')
+        settings = dict(postgres_settings(16 << 30, 4))
+        self.assertEqual(settings['max_worker_processes'], '8')
+        self.assertEqual(settings['max_parallel_workers'], '4')
+        # unknown parameters keep postgres from starting
+        settings = dict(postgres_settings(64 << 30, 16, version=(10,)))
+        self.assertEqual(settings['max_parallel_workers'], '16')
+        self.assertNotIn('max_parallel_maintenance_workers', settings)
+        settings = dict(postgres_settings(64 << 30, 16, version=(9, 6)))
+        self.assertEqual(settings['max_parallel_workers_per_gather'], '4')
+        self.assertNotIn('max_parallel_workers', settings)
+        self.assertEqual(settings['max_parallel_workers_per_gather'], '4')
+        self.assertEqual(settings['max_wal_size'], '4GB')
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from gdockutils.materialize import materialize
+
+
+class TestMaterialize(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.uid, self.gid = os.getuid(), os.getgid()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def desired(self, **kwargs):
+        return dict(
+            (k, (v, self.uid, self.gid, 0o400)) for k, v in kwargs.items()
+        )
+
+    def test_writes_only_changes(self):
+        d = self.dir.name
+        ret = materialize(self.desired(A=b'a', B=b'b'), d)
+        self.assertEqual(ret['written'], ['A', 'B'])
+        self.assertEqual(os.stat(os.path.join(d, 'A')).st_mode & 0o777, 0o400)
+
+        ret = materialize(self.desired(A=b'a', B=b'x'), d)
+        self.assertEqual(ret['written'], ['B'])
+        self.assertEqual(ret['unchanged'], ['A'])
+        with open(os.path.join(d, 'B'), 'rb') as f:
+            self.assertEqual(f.read(), b'x')
+
+        os.chmod(os.path.join(d, 'A'), 0o644)
+        ret = materialize(self.desired(A=b'a', B=b'x'), d)
+        self.assertEqual(ret['written'], ['A'])
+        self.assertEqual(sorted(os.listdir(d)), ['A', 'B'])
+
+    def test_removes_managed_only(self):
+        d = self.dir.name
+        materialize(self.desired(A=b'a', B=b'b'), d)
+        with open(os.path.join(d, 'other'), 'w'):
+            pass
+        ret = materialize(self.desired(A=b'a'), d, managed=['A', 'B', 'C'])
+        self.assertEqual(ret['removed'], ['B'])
+        self.assertEqual(sorted(os.listdir(d)), ['A', 'other'])
+
+    def test_failed_write_leaves_no_temp_file(self):
+        d = self.dir.name
+        with unittest.mock.patch('os.rename', side_effect=OSError):
+            with self.assertRaises(OSError):
+                materialize(self.desired(A=b'a'), d)
+        self.assertEqual(os.listdir(d), [])
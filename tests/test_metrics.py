@@ -0,0 +1,82 @@
+import json
+import os
+import signal
+import threading
+import tempfile
+import unittest
+
+from gdockutils.gprun import gprun
+from gdockutils.supervisor import Program, supervise
+
+
+def kill_later(delay):
+    threading.Timer(delay, os.kill, (os.getpid(), signal.SIGTERM)).start()
+
+
+class TestMetrics(unittest.TestCase):
+    def test_json_lines(self):
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'metrics.jsonl')
+            for code in (0, 3):
+                gprun(
+                    command=['sh', '-c', 'sleep 0.2; exit %d' % code],
+                    sys_exit=False, metrics=fn, metrics_interval=0.05
+                )
+            with open(fn) as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual([r['exit_code'] for r in records], [0, 3])
+        self.assertEqual(records[0]['job'], 'sh')
+        self.assertGreaterEqual(records[0]['wall_seconds'], 0.2)
+        self.assertGreater(records[0]['max_rss_bytes'], 0)
+        self.assertGreater(records[0]['sampled_rss_peak_bytes'], 0)
+
+    def test_prometheus(self):
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'jobs.prom')
+            gprun(command=['true'], sys_exit=False, metrics=fn, job='a')
+            gprun(command=['false'], sys_exit=False, metrics=fn, job='b')
+            gprun(command=['true'], sys_exit=False, metrics=fn, job='b')
+            supervise(
+                [Program('c', ['sh', '-c', 'exit 2'], restart='never')],
+                sys_exit=False, metrics=fn
+            )
+            with open(fn) as f:
+                lines = f.read().splitlines()
+        codes = [line for line in lines if line.startswith(
+            'gdockutils_job_exit_code{'
+        )]
+        self.assertEqual(codes, [
+            'gdockutils_job_exit_code{job="a"} 0',
+            'gdockutils_job_exit_code{job="b"} 0',
+            'gdockutils_job_exit_code{job="c"} 2',
+        ])
+        self.assertEqual(
+            lines.count('# TYPE gdockutils_job_wall_seconds gauge'), 1
+        )
+
+    def test_stop_sequence(self):
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'metrics.jsonl')
+            kill_later(0.2)
+            gprun(
+                command=['sh', '-c', 'trap "" INT; sleep 10'],
+                sys_exit=False, metrics=fn,
+                stop_sequence='SIGINT:0.3,SIGKILL'
+            )
+            kill_later(0.2)
+            supervise(
+                [Program(
+                    'p', ['sh', '-c', 'trap "" INT; sleep 10'],
+                    stop_sequence='SIGINT:0.3,SIGKILL'
+                )],
+                sys_exit=False, metrics=fn
+            )
+            with open(fn) as f:
+                records = [json.loads(line) for line in f]
+        for record in records:
+            self.assertEqual(record['exit_code'], -signal.SIGKILL)
+            self.assertEqual(
+                [p[0] for p in record['stop_phases']], ['SIGINT', 'SIGKILL']
+            )
+            self.assertGreaterEqual(record['stop_phases'][0][1], 0.3)
+            self.assertLess(record['stop_seconds'], 2)
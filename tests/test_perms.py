@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+from gdockutils.perms import chown_tree, normalize, Rules, OWNER_MARKER
+
+
+class TestPerms(unittest.TestCase):
+    def owner(self, path):
+        st = os.lstat(path)
+        return st.st_uid, st.st_gid
+
+    def test_chown_tree(self):
+        with tempfile.TemporaryDirectory() as d, \
+                tempfile.NamedTemporaryFile() as outside:
+            for i in range(5):
+                os.makedirs(os.path.join(d, 'base', str(i)))
+                with open(os.path.join(d, 'base', str(i), 'f'), 'w'):
+                    pass
+            os.chown(os.path.join(d, 'base', '3', 'f'), 1234, 1234)
+            os.symlink(outside.name, os.path.join(d, 'link'))
+            for jobs in (1, 4):
+                self.assertEqual(chown_tree(d, 1000, 1001, jobs=jobs), 13)
+                self.assertEqual(self.owner(os.path.join(d, 'link')), (
+                    1000, 1001
+                ))
+                self.assertEqual(self.owner(outside.name), (0, 0))
+                self.assertEqual(chown_tree(d, 1000, 1001, jobs=jobs), 0)
+                chown_tree(d, 0, 0)
+
+    def test_marker(self):
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'f')
+            with open(fn, 'w'):
+                pass
+            self.assertEqual(chown_tree(d, 1000, 1000, marker=True), 2)
+            self.assertTrue(os.path.isfile(os.path.join(d, OWNER_MARKER)))
+            os.chown(fn, 0, 0)
+            self.assertEqual(chown_tree(d, 1000, 1000, marker=True), 0)
+            self.assertEqual(self.owner(fn), (0, 0))
+            # the marker is not trusted for another owner
+            self.assertEqual(chown_tree(d, 1001, 1001, marker=True), 3)
+
+    def test_normalize(self):
+        with tempfile.TemporaryDirectory() as d:
+            os.makedirs(os.path.join(d, 'a', 'b'))
+            for fn in ('f', 'a/f', 'a/b/f'):
+                with open(os.path.join(d, fn), 'w'):
+                    pass
+            os.chmod(os.path.join(d, 'a', 'f'), 0o640)
+            rules = Rules(1000, 1001, 0o2750, 0o640, 0o755)
+            stats = normalize(d, rules, jobs=2)
+            self.assertEqual((stats.scanned, stats.changed), (6, 6))
+            self.assertEqual(os.stat(d).st_mode & 0o7777, 0o755)
+            self.assertEqual(
+                os.stat(os.path.join(d, 'a', 'b')).st_mode & 0o7777, 0o2750
+            )
+            self.assertEqual(
+                os.stat(os.path.join(d, 'a', 'b', 'f')).st_mode & 0o7777,
+                0o640
+            )
+            stats = normalize(d, rules, jobs=2)
+            self.assertEqual((stats.scanned, stats.changed), (6, 0))
+            os.chmod(os.path.join(d, 'a', 'f'), 0o644)
+            stats = normalize(d, Rules(file_mode=0o640), jobs=1)
+            self.assertEqual((stats.scanned, stats.changed), (6, 1))
@@ -0,0 +1,79 @@
+import socket
+import struct
+import threading
+import unittest
+
+from gdockutils.pgprobe import probe, wait, READY, STARTING, UNAVAILABLE
+
+
+def error_response(code):
+    fields = b'SFATAL\0C' + code + b'\0Mthe database system is starting\0\0'
+    return b'E' + struct.pack('!i', 4 + len(fields)) + fields
+
+
+class FakeServer:
+    """Answers ``starting`` times with 57P03, then asks for a password."""
+
+    def __init__(self, starting=0):
+        self.starting = starting
+        self.startup_packets = []
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def close(self):
+        # wakes up the blocked accept()
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                conn.recv(8)
+                conn.sendall(b'N')
+                length, = struct.unpack('!i', conn.recv(4))
+                self.startup_packets.append(conn.recv(length - 4))
+                if self.starting:
+                    self.starting -= 1
+                    conn.sendall(error_response(b'57P03'))
+                else:
+                    conn.sendall(b'R' + struct.pack('!ii', 12, 5) + b'salt')
+
+
+class TestPgProbe(unittest.TestCase):
+    def test_probe(self):
+        server = FakeServer(starting=1)
+        self.assertEqual(probe('127.0.0.1', server.port), STARTING)
+        self.assertEqual(
+            probe('127.0.0.1', server.port, 'django', 'db'), READY
+        )
+        self.assertEqual(
+            server.startup_packets[-1],
+            struct.pack('!i', 3 << 16) + b'user\0django\0database\0db\0\0'
+        )
+        server.close()
+        self.assertEqual(probe('127.0.0.1', server.port), UNAVAILABLE)
+
+    def test_wait(self):
+        server = FakeServer(starting=3)
+        checks = []
+
+        def check():
+            checks.append(1)
+            if len(checks) == 1:
+                raise Exception('password authentication failed')
+
+        elapsed = wait(
+            '127.0.0.1', server.port, check=check, initial_delay=0.01
+        )
+        self.assertEqual(len(checks), 2)
+        self.assertLess(elapsed, 1)
+        server.close()
+        with self.assertRaises(Exception):
+            wait('127.0.0.1', server.port, timeout=0.1, initial_delay=0.01)
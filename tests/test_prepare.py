@@ -0,0 +1,130 @@
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+from gdockutils import manifest
+from gdockutils.prepare import prepare_services, defined_secrets
+from gdockutils.secret import secretstatus
+
+SECRETS_YML = '''\
+A: [x, y]
+B: [y]
+C: [z]
+D:
+'''
+
+
+class TestPrepare(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        d = self.dir.name
+        self.conf = os.path.join(d, 'secrets.yml')
+        with open(self.conf, 'w') as f:
+            f.write(SECRETS_YML)
+        db = os.path.join(d, '.secret.env')
+        with open(db, 'w') as f:
+            f.write('A=YQ==\nB=Yg==\nC=Yw==\nO=bw==\n')
+        self.secret_dir = os.path.join(d, 'secrets')
+        self.cache = os.path.join(d, 'manifest.json')
+        for target, value in [
+            ('gdockutils.manifest.SECRET_CONF_FILE', self.conf),
+            ('gdockutils.manifest.SECRET_MANIFEST_CACHE_FILE', self.cache),
+            ('gdockutils.prepare.SECRET_DIR', self.secret_dir),
+            ('gdockutils.secret.SECRET_DATABASE_FILE', db),
+        ]:
+            patcher = unittest.mock.patch(target, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        manifest._cache.clear()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_manifest(self):
+        self.assertEqual(defined_secrets(), ['A', 'B', 'C', 'D'])
+        m = manifest.load_manifest()
+        self.assertEqual(
+            m['services'], {'x': ['A'], 'y': ['A', 'B'], 'z': ['C']}
+        )
+        self.assertTrue(os.path.isfile(self.cache))
+
+        # a fresh process uses the cache file instead of parsing the yaml
+        manifest._cache.clear()
+        with unittest.mock.patch('yaml.load') as load:
+            self.assertEqual(manifest.load_manifest(), m)
+            load.assert_not_called()
+
+        with open(self.conf, 'a') as f:
+            f.write('E: [x]\n')
+        self.assertEqual(
+            manifest.load_manifest()['services']['x'], ['A', 'E']
+        )
+
+    def _secret_files(self):
+        return sorted(
+            n for n in os.listdir(self.secret_dir) if not n.startswith('.')
+        )
+
+    def test_prepare_services(self):
+        prepare_services(['x', 'y'], user='0:0')
+        self.assertEqual(self._secret_files(), ['A', 'B'])
+        # preparing a service keeps the secrets of the others
+        prepare_services(['z'], user='0:0')
+        self.assertEqual(self._secret_files(), ['A', 'B', 'C'])
+
+        # y does not need A and B anymore, x still needs A
+        with open(self.conf, 'w') as f:
+            f.write('A: [x]\nB:\nC: [z]\n')
+        prepare_services(['y'], user='0:0')
+        self.assertEqual(self._secret_files(), ['A', 'C'])
+        prepare_services(['x'], user='0:0')
+        self.assertEqual(self._secret_files(), ['A', 'C'])
+
+        with open(self.conf, 'w') as f:
+            f.write('A:\nB:\nC: [z]\n')
+        prepare_services(['x'], user='0:0')
+        self.assertEqual(self._secret_files(), ['C'])
+
+    def test_prepare_services_locked(self):
+        os.makedirs(self.secret_dir)
+        claims = os.path.join(self.secret_dir, '.gdockutils-services.json')
+        with open(claims + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            t = threading.Thread(
+                target=prepare_services, args=(['z'],), kwargs={'user': '0:0'}
+            )
+            t.start()
+            t.join(0.5)
+            # waits for the lock before reading the claims
+            self.assertTrue(t.is_alive())
+            self.assertFalse(os.path.exists(claims))
+        t.join()
+        with open(claims) as f:
+            self.assertEqual(json.load(f), {'z': ['C']})
+
+    def test_prepare_services_split(self):
+        prepare_services(
+            ['x', 'y'], user='0:0', user_map={'y': '5:5'}, split=True, jobs=2
+        )
+        y = os.path.join(self.secret_dir, 'y')
+        self.assertEqual(sorted(os.listdir(y)), ['A', 'B'])
+        self.assertEqual(os.stat(os.path.join(y, 'A')).st_uid, 5)
+        with self.assertRaises(Exception):
+            prepare_services(['x', 'y'], user='0:0', user_map={'y': '5:5'})
+
+    def test_secretstatus(self):
+        self.assertEqual(secretstatus(), {
+            'defined': ['A', 'B', 'C', 'D'],
+            'present': ['A', 'B', 'C'],
+            'missing': ['D'],
+            'orphaned': ['O'],
+            'services': {
+                'x': {'secrets': 1, 'present': 1, 'missing': []},
+                'y': {'secrets': 2, 'present': 2, 'missing': []},
+                'z': {'secrets': 1, 'present': 1, 'missing': []},
+            },
+        })
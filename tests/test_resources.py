@@ -0,0 +1,32 @@
+import resource
+import unittest
+
+from gdockutils.resources import (
+    parse_cpus, parse_limit, parse_ionice, compile_profile
+)
+
+
+class TestResources(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(parse_cpus('0-3,6'), {0, 1, 2, 3, 6})
+        self.assertEqual(parse_limit('1024'), (1024, 1024))
+        self.assertEqual(parse_limit('64k:1m'), (65536, 1 << 20))
+        self.assertEqual(
+            parse_limit('unlimited'),
+            (resource.RLIM_INFINITY, resource.RLIM_INFINITY)
+        )
+        self.assertEqual(parse_ionice('idle'), 3 << 13)
+        self.assertEqual(parse_ionice('best-effort:7'), (2 << 13) | 7)
+        for f, spec in [
+            (parse_cpus, '0-x'), (parse_limit, 'lots'), (parse_ionice, 'x')
+        ]:
+            with self.assertRaises(Exception):
+                f(spec)
+
+    def test_compile_profile(self):
+        self.assertEqual(
+            compile_profile({'nofile': 65536, 'nice': '10'}),
+            {'nofile': (65536, 65536), 'nice': 10}
+        )
+        with self.assertRaises(Exception):
+            compile_profile({'cpu': '0'})
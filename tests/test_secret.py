@@ -0,0 +1,133 @@
+import base64
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+from gdockutils import (
+    SecretAlreadyExists, SecretDoesNotExist, SecretDatabaseNotFound
+)
+from gdockutils.secret import (
+    SecretStore, createsecret, createsecrets, generate_missing, randomstrings
+)
+
+
+def write_db(path, secrets):
+    with open(path, 'w') as f:
+        for k, v in secrets.items():
+            f.write('%s=%s\n' % (k, base64.b64encode(v).decode()))
+
+
+class TestSecretStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, '.secret.env')
+        write_db(self.path, {'A': b'a', 'B': b'b=b\n'})
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_get(self):
+        store = SecretStore(self.path)
+        self.assertEqual(store.get('A'), b'a')
+        self.assertEqual(
+            store.get_many(['A', 'B']), {'A': b'a', 'B': b'b=b\n'}
+        )
+        self.assertEqual(store.names(), ['A', 'B'])
+        self.assertEqual(store.items(), [('A', b'a'), ('B', b'b=b\n')])
+        with self.assertRaises(SecretDoesNotExist):
+            store.get('C')
+        with self.assertRaises(SecretDoesNotExist):
+            store.get_many(['A', 'C'])
+
+    def test_parses_once(self):
+        store = SecretStore(self.path)
+        store.get('A')
+        with unittest.mock.patch.object(store, '_parse') as parse:
+            store.get('B')
+            store.names()
+            parse.assert_not_called()
+
+    def test_reloads_when_replaced(self):
+        store = SecretStore(self.path)
+        store.get('A')
+        tmp = self.path + '.tmp'
+        write_db(tmp, {'C': b'c'})
+        os.rename(tmp, self.path)
+        self.assertEqual(store.names(), ['C'])
+
+    def test_missing_database(self):
+        store = SecretStore(os.path.join(self.dir.name, 'nope'))
+        with self.assertRaises(SecretDatabaseNotFound):
+            store.get('A')
+
+
+class TestCreateSecret(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, '.secret.env')
+        write_db(self.path, {'A': b'a'})
+        os.chmod(self.path, 0o600)
+        patcher = unittest.mock.patch(
+            'gdockutils.secret.SECRET_DATABASE_FILE', self.path
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_batch(self):
+        createsecrets({'B': {'value': 'b'}, 'C': {'random': 10}})
+        store = SecretStore(self.path)
+        self.assertEqual(store.names(), ['A', 'B', 'C'])
+        self.assertEqual(store.get('B'), b'b')
+        self.assertEqual(len(store.get('C')), 10)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_batch_is_all_or_nothing(self):
+        with self.assertRaises(SecretAlreadyExists):
+            createsecrets({'A': {'value': 'x'}, 'B': {'value': 'b'}})
+        self.assertEqual(SecretStore(self.path).names(), ['A'])
+        createsecrets({'A': {'value': 'x'}}, force=True)
+        self.assertEqual(SecretStore(self.path).get('A'), b'x')
+
+    def test_generate_missing(self):
+        manifest = {'secrets': {'A': [], 'X': [], 'Y': []}, 'services': {}}
+        with unittest.mock.patch(
+            'gdockutils.manifest.load_manifest', return_value=manifest
+        ):
+            self.assertEqual(generate_missing(20, 'ab'), ['X', 'Y'])
+            self.assertEqual(generate_missing(), [])
+        store = SecretStore(self.path)
+        self.assertEqual(store.get('A'), b'a')
+        self.assertEqual(len(store.get('X')), 20)
+        self.assertLessEqual(set(store.get('Y')), set(b'ab'))
+
+    def test_concurrent_createsecret(self):
+        pids = []
+        for i in range(8):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    createsecret('S%d' % i, value=str(i))
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        self.assertEqual(
+            SecretStore(self.path).names(),
+            ['A'] + ['S%d' % i for i in range(8)]
+        )
+
+
+class TestRandomStrings(unittest.TestCase):
+    def test_randomstrings(self):
+        values = randomstrings(100, 30, 'abc')
+        self.assertEqual(len(values), 100)
+        self.assertEqual(set(len(v) for v in values), {30})
+        self.assertEqual(set(''.join(values)), set('abc'))
+        self.assertEqual(len(set(values)), 100)
+        with self.assertRaises(Exception):
+            randomstrings(1, 1, '\u00e1')
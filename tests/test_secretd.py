@@ -0,0 +1,64 @@
+import base64
+import os
+import tempfile
+import threading
+import unittest
+
+from gdockutils import SecretAccessDenied, SecretDoesNotExist
+from gdockutils.secret import SecretStore
+from gdockutils.secretd import SecretServer, fetch
+
+MANIFEST = {'secrets': {'A': ['nobody'], 'B': []}, 'services': {}}
+
+
+class TestSecretd(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        db = os.path.join(self.dir.name, '.secret.env')
+        with open(db, 'w') as f:
+            for k, v in [('A', b'a'), ('B', b'b')]:
+                f.write('%s=%s\n' % (k, base64.b64encode(v).decode()))
+        self.socket = os.path.join(self.dir.name, 'secretd.sock')
+        self.server = SecretServer(
+            self.socket, SecretStore(db), lambda: MANIFEST
+        )
+        os.chmod(self.socket, 0o666)
+        os.chmod(self.dir.name, 0o755)
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def test_fetch(self):
+        self.assertEqual(
+            fetch(['A', 'B'], self.socket), {'A': b'a', 'B': b'b'}
+        )
+        with self.assertRaises(SecretDoesNotExist):
+            fetch(['C'], self.socket)
+
+    def test_no_daemon(self):
+        self.assertIsNone(fetch(['A'], os.path.join(self.dir.name, 'nope')))
+
+    def test_peer_credentials(self):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            try:
+                os.setuid(65534)
+                ok = fetch(['A'], self.socket) == {'A': b'a'}
+                try:
+                    fetch(['B'], self.socket)
+                    ok = False
+                except SecretAccessDenied:
+                    pass
+                os.write(w, b'1' if ok else b'0')
+            finally:
+                os._exit(0)
+        os.close(w)
+        with os.fdopen(r, 'rb') as f:
+            result = f.read()
+        os.waitpid(pid, 0)
+        self.assertEqual(result, b'1')
@@ -0,0 +1,133 @@
+import os
+import random
+import tempfile
+import unittest
+import unittest.mock
+from concurrent.futures import ThreadPoolExecutor
+
+from gdockutils import snapshot
+
+
+def _read_tree(root):
+    ret = {}
+    for path, st in snapshot._scan(root):
+        fn = os.path.join(root, path)
+        if os.path.islink(fn):
+            ret[path] = ('symlink', os.readlink(fn))
+        elif os.path.isdir(fn):
+            ret[path] = ('dir',)
+        else:
+            with open(fn, 'rb') as f:
+                ret[path] = ('file', f.read())
+    return ret
+
+
+class TestChunking(unittest.TestCase):
+    def test_boundaries(self):
+        n = 5 << 20
+        data = random.Random(1).getrandbits(8 * n).to_bytes(n, 'little')
+        ends = list(snapshot.chunk_boundaries(data))
+        self.assertEqual(ends[-1], len(data))
+        starts = [0] + ends[:-1]
+        for start, end in zip(starts, ends[:-1]):
+            self.assertGreaterEqual(end - start, snapshot.MIN_CHUNK)
+            self.assertLessEqual(end - start, snapshot.MAX_CHUNK)
+        # boundaries depend on the content, not on the offset
+        shifted = list(snapshot.chunk_boundaries(b'x' * 1000 + data))
+        self.assertEqual(
+            set(e + 1000 for e in ends[1:]), set(shifted[1:])
+        )
+
+    def test_average_size(self):
+        # 1MB chunks on average
+        n = 64 << 20
+        data = random.Random(3).getrandbits(8 * n).to_bytes(n, 'little')
+        ends = list(snapshot.chunk_boundaries(data))
+        self.assertTrue(32 < len(ends) < 128)
+        # without runs, data is cut into MAX_CHUNK blocks
+        ends = list(snapshot.chunk_boundaries(b'\0' * (9 << 20)))
+        self.assertEqual(ends, [4 << 20, 8 << 20, 9 << 20])
+
+    def test_small(self):
+        self.assertEqual(list(snapshot.chunk_boundaries(b'')), [])
+        self.assertEqual(list(snapshot.chunk_boundaries(b'abc')), [3])
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.src = os.path.join(self.tmp.name, 'files')
+        self.backup = os.path.join(self.tmp.name, 'backup')
+        os.makedirs(os.path.join(self.src, 'sub', 'deep'))
+        n = 8 << 20
+        self.big = random.Random(2).getrandbits(8 * n).to_bytes(n, 'little')
+        with open(os.path.join(self.src, 'big'), 'wb') as f:
+            f.write(self.big)
+        with open(os.path.join(self.src, 'sub', 'small.txt'), 'wb') as f:
+            f.write(b'hello')
+        os.symlink('small.txt', os.path.join(self.src, 'sub', 'link'))
+
+    def test_roundtrip(self):
+        first = snapshot.create(self.src, self.backup, jobs=2)
+        self.assertEqual(first['stats']['hashed'], 2)
+        self.assertEqual(
+            first['stats']['bytes_written'], len(self.big) + len(b'hello')
+        )
+        expected = _read_tree(self.src)
+
+        # unchanged files are not read again, new content is deduplicated
+        with open(os.path.join(self.src, 'big2'), 'wb') as f:
+            f.write(b'prefix' + self.big)
+        os.unlink(os.path.join(self.src, 'sub', 'small.txt'))
+        # in threads, so that the calls are seen here
+        with unittest.mock.patch(
+            'gdockutils.snapshot.ProcessPoolExecutor', ThreadPoolExecutor
+        ), unittest.mock.patch(
+            'gdockutils.snapshot.store_file', wraps=snapshot.store_file
+        ) as store_file:
+            second = snapshot.create(self.src, self.backup, jobs=2)
+        self.assertEqual(
+            [c[0][0] for c in store_file.call_args_list],
+            [os.path.join(self.src, 'big2')]
+        )
+        self.assertEqual(second['stats']['hashed'], 1)
+        self.assertLess(second['stats']['bytes_written'], len(self.big) / 2)
+        self.assertEqual(
+            snapshot.list_snapshots(self.backup), [first['id'], second['id']]
+        )
+
+        # restore over the changed tree
+        snapshot.restore(first['id'], self.src, self.backup, jobs=2)
+        self.assertEqual(_read_tree(self.src), expected)
+
+        # and into an empty directory
+        target = os.path.join(self.tmp.name, 'restored')
+        snapshot.restore(second['id'], target, self.backup, jobs=2)
+        tree = _read_tree(target)
+        self.assertEqual(tree['big2'], ('file', b'prefix' + self.big))
+        self.assertNotIn('sub/small.txt', tree)
+
+    def test_damaged(self):
+        first = snapshot.create(self.src, self.backup, jobs=2)
+        chunk = first['entries'][0]['chunks'][1]
+        fn = os.path.join(
+            self.backup, 'snapshots', 'chunks', chunk[:2], chunk[2:]
+        )
+        with open(fn, 'r+b') as f:
+            f.write(b'corrupted')
+        os.unlink(os.path.join(self.src, 'big'))
+        with open(os.path.join(self.src, 'new'), 'wb') as f:
+            f.write(b'new')
+        with self.assertRaises(Exception):
+            snapshot.restore(first['id'], self.src, self.backup)
+        # nothing was deleted
+        self.assertTrue(os.path.exists(os.path.join(self.src, 'new')))
+        os.unlink(fn)
+        with self.assertRaises(Exception):
+            snapshot.restore(first['id'], self.src, self.backup)
+        self.assertTrue(os.path.exists(os.path.join(self.src, 'new')))
+
+    def test_missing(self):
+        with self.assertRaises(Exception):
+            snapshot.restore('nope', self.src, self.backup)
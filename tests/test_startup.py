@@ -0,0 +1,20 @@
+import subprocess
+import sys
+import unittest
+
+CODE = '''
+import sys
+from gdockutils.cli import gprun, readsecret
+from gdockutils.ui import ask_cli
+print(' '.join(sorted(sys.modules)))
+'''
+
+
+class TestStartup(unittest.TestCase):
+    def test_entry_points_import_lazily(self):
+        out = subprocess.check_output(
+            [sys.executable, '-c', CODE], universal_newlines=True
+        )
+        modules = out.split()
+        for m in ['yaml', 'gdockutils.db', 'gdockutils.prepare']:
+            self.assertNotIn(m, modules)
@@ -0,0 +1,121 @@
+import gzip
+import hashlib
+import io
+import lzma
+import os
+import tempfile
+import threading
+import unittest
+import unittest.mock
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from gdockutils.stream import (
+    write_stream, read_stream, read_manifest, describe, verify,
+    compress_chunk
+)
+
+
+class TestStream(unittest.TestCase):
+    def setUp(self):
+        self.data = b''.join(
+            b'%d some compressible line\n' % i for i in range(200000)
+        )
+
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as d:
+            for codec, decompress in [
+                (None, lambda b: b), ('gzip', gzip.decompress),
+                ('xz', lzma.decompress),
+            ]:
+                fn = os.path.join(d, 'dump.sql%s' % (
+                    {'gzip': '.gz', 'xz': '.xz'}.get(codec, '')
+                ))
+                manifest = write_stream(
+                    io.BytesIO(self.data), fn, codec, jobs=2,
+                    chunk_size=1 << 20
+                )
+                with open(fn, 'rb') as f:
+                    content = f.read()
+                # readable by the usual tools
+                self.assertEqual(decompress(content), self.data)
+                self.assertEqual(manifest, read_manifest(fn))
+                self.assertEqual(manifest['size'], len(content))
+                self.assertEqual(manifest['raw_size'], len(self.data))
+                self.assertEqual(
+                    manifest['sha256'], hashlib.sha256(content).hexdigest()
+                )
+                out = io.BytesIO()
+                read_stream(fn, out)
+                self.assertEqual(out.getvalue(), self.data)
+            self.assertEqual(sorted(os.listdir(d)), [
+                'dump.sql', 'dump.sql.gz', 'dump.sql.gz.json',
+                'dump.sql.json', 'dump.sql.xz', 'dump.sql.xz.json'
+            ])
+
+    def test_parallel(self):
+        # a chunk is only compressed while another one is, too
+        barrier = threading.Barrier(2, timeout=10)
+        sizes = []
+
+        def compress(codec, level, data):
+            sizes.append(len(data))
+            barrier.wait()
+            return compress_chunk(codec, level, data)
+
+        chunk_size = len(self.data) // 4 + 1
+        with tempfile.TemporaryDirectory() as d, unittest.mock.patch(
+            'gdockutils.stream.ProcessPoolExecutor', ThreadPoolExecutor
+        ), unittest.mock.patch('gdockutils.stream.compress_chunk', compress):
+            fn = os.path.join(d, 'dump.sql.gz')
+            write_stream(
+                io.BytesIO(self.data), fn, 'gzip', jobs=2,
+                chunk_size=chunk_size
+            )
+            with open(fn, 'rb') as f:
+                content = f.read()
+        self.assertEqual(sorted(sizes), sorted(
+            [chunk_size] * 3 + [len(self.data) - 3 * chunk_size]
+        ))
+        # one gzip member per chunk
+        members = []
+        while content:
+            z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            members.append(z.decompress(content))
+            content = z.unused_data
+        self.assertEqual(sorted(len(m) for m in members), sorted(sizes))
+        self.assertEqual(b''.join(members), self.data)
+
+    def test_failed_check_leaves_nothing(self):
+        def check():
+            raise Exception('pg_dump failed')
+
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'dump.sql.gz')
+            with self.assertRaises(Exception):
+                write_stream(io.BytesIO(self.data), fn, 'gzip', check=check)
+            self.assertEqual(os.listdir(d), [])
+
+    def test_truncated_manifest(self):
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'dump.sql')
+            with open(fn, 'wb') as f:
+                f.write(self.data)
+            with open(fn + '.json', 'w') as f:
+                f.write('{"file": "dump.sql", "si')
+            self.assertIsNone(read_manifest(fn))
+            self.assertFalse(verify(fn))
+            out = io.BytesIO()
+            read_stream(fn, out)
+            self.assertEqual(out.getvalue(), self.data)
+
+    def test_corruption_detected(self):
+        with tempfile.TemporaryDirectory() as d:
+            fn = os.path.join(d, 'dump.sql')
+            with open(fn, 'wb') as f:
+                f.write(self.data)
+            describe(fn, 1.0)
+            with open(fn, 'r+b') as f:
+                f.write(b'X')
+            with self.assertRaises(Exception):
+                read_stream(fn, io.BytesIO())
@@ -0,0 +1,71 @@
+import os
+import signal
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from gdockutils.supervisor import Program, supervise
+
+
+def kill_later(delay, signum=signal.SIGTERM):
+    pid = os.getpid()
+    timer = threading.Timer(delay, os.kill, (pid, signum))
+    timer.start()
+    return timer
+
+
+class TestSupervisor(unittest.TestCase):
+    def test_exits_when_all_done(self):
+        returncode = supervise([
+            Program('ok', ['true'], restart='never'),
+            Program('fail', ['sh', '-c', 'exit 3'], restart='never'),
+        ], sys_exit=False)
+        self.assertEqual(returncode, 1)
+
+    def test_start_errors(self):
+        with tempfile.TemporaryDirectory() as d:
+            db = os.path.join(d, '.secret.env')
+            with open(db, 'w') as f:
+                f.write('A=YQ==\n')
+            kill_later(0.5)
+            with unittest.mock.patch(
+                'gdockutils.secret.SECRET_DATABASE_FILE', db
+            ):
+                returncode = supervise([
+                    Program('sleep', ['sleep', '10']),
+                    Program(
+                        'nouser', ['true'], userspec='nosuchuser',
+                        backoff=0.05
+                    ),
+                    Program(
+                        'nosecret', ['true'], secrets=['NOSUCHSECRET'],
+                        restart='never'
+                    ),
+                ], sys_exit=False)
+        self.assertEqual(returncode, 1)
+
+    def test_stop_and_restart(self):
+        with tempfile.TemporaryDirectory() as d:
+            log = os.path.join(d, 'log')
+            kill_later(0.5)
+            start = time.monotonic()
+            returncode = supervise([
+                Program('sleep', ['sleep', '10'], stopsignal='SIGINT'),
+                Program(
+                    'crash', ['sh', '-c', 'echo x >> %s; exit 1' % log],
+                    backoff=0.05
+                ),
+            ], sys_exit=False)
+            self.assertLess(time.monotonic() - start, 5)
+            with open(log) as f:
+                self.assertGreater(len(f.readlines()), 1)
+        self.assertEqual(returncode, 1)
+
+    def test_signal_reaches_process_group(self):
+        kill_later(0.3)
+        returncode = supervise([
+            Program('group', ['sh', '-c', 'sleep 10 & sleep 10; wait']),
+        ], sys_exit=False)
+        self.assertEqual(returncode, 0)